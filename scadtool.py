@@ -20,10 +20,58 @@
 if __name__ == "__main__":
     # import statements: We use pythons included batteries!
     import os
-    import json
     import scadtoolLib as lib
     import argparse
     import collections
+    import sys
+
+    # Options that don't change the generated output.
+    cacheIrrelevantOptions = frozenset(["verbose", "quiet", "profile", "profile_dump", "metrics_json", "output", "override", "dont_override", "ask", "cache_dir", "cache_stats", "depfile", "write_if_changed", "jobs", "size_report", "size_report_json", "memory_report", "memory_report_json", "INPUT_FILE"])  # the input file is part of the key anyway
+
+    def output_cache_lookup(args, inputFile, libraryPaths=(), outFileName=None):
+        """Open the output cache (if --cache-dir is given) and look for the
+        output of a previous run with the same options and input.
+        outFileName: the output file, if its name is part of the output
+        (the @filename tag of a built library).
+        Returns a tuple (cache, key, cachedEntry) (see OutputCache.lookup)."""
+        if args.cache_dir is None:
+            return (None, None, None)
+        cache = lib.OutputCache(args.cache_dir)
+        options = dict((key, value) for key, value in vars(args).items() if key not in cacheIrrelevantOptions)
+        options["OPENSCADPATH"] = os.environ.get("OPENSCADPATH")  # decides which files are included, like --lib-path
+        if getattr(args, "sharded", False):
+            options["output"] = args.output  # the shards are use<>d relative to the output file
+        if outFileName is not None:
+            options["outFileName"] = outFileName
+        key = lib.OutputCache.fingerprint(options, os.getcwd(), os.path.abspath(inputFile), cache.hashFile(inputFile), [os.path.abspath(path) for path in libraryPaths])
+        if size_report_requested(args):  # a size report needs the entities, so the output is made again (and stored)
+            return (cache, key, None)
+        cachedEntry = cache.lookup(key)
+        if cachedEntry is not None:
+            lib.printConsole("PROGRESS: CACHE: Nothing changed since a previous run. Reusing its output.", 1)
+        return (cache, key, cachedEntry)
+
+    def output_cache_stats(args, cache):
+        if cache is not None and args.cache_stats:
+            print(cache.statsAsText(), file=sys.stderr)
+
+    def size_report_requested(args):
+        return getattr(args, "size_report", False) or getattr(args, "size_report_json", None) is not None
+
+    def output_size_reports(args, results):
+        reports = [result.sizeReport for result in results if result.sizeReport is not None]
+        if args.size_report:
+            for report in reports:
+                print(report.asText(), file=sys.stderr)
+        if args.size_report_json is not None:
+            import json
+            with open(args.size_report_json, 'w') as f:
+                json.dump([report.asDict() for report in reports], f, indent=4)
+                f.write("\n")
+
+    def write_depfile(args, outFileName, contributorPaths, assetPaths):
+        if args.depfile is not None:
+            lib.writeDepfile(args.depfile, outFileName, lib.uniquePaths(list(contributorPaths) + list(assetPaths)))
 
     def cmd_info_handler(args):
         lib.printConsole("PROGRESS: Collecting Information about these sources:\nPROGRESS:         {}\nPROGRESS:     recursively: '{}'\nPROGRESS:     traversing through dirs: '{}'".format(repr(args.INPUT_FILE_OR_DIR), args.recursive, args.traverse_dirs), 1)
@@ -53,6 +101,12 @@ if __name__ == "__main__":
         if args.uses:
             toOutput.extend(scadLibrary.getUsedFiles())
 
+        if args.dependents:
+            for name in args.dependents:
+                lib.printConsole("PROGRESS: Looking for everything that depends on '{}' (transitive: '{}')".format(name, args.transitive), 1)
+                with context.profiler.phase("resolution"), context.memory.measure("resolution"):
+                    toOutput.extend(scadLibrary.findDependents(name, args.transitive, args.infer_dependencies))
+
         if args.filter:
             # TODO define a json syntax that allows searching for entities
             # based on information given in the ScadDoc.
@@ -60,27 +114,28 @@ if __name__ == "__main__":
             # toOutput.extend(scadLibrary.findEntity(description))
             pass
 
-        outString = ""
+        with context.profiler.phase("emission"), context.memory.measure("emission"):
+            outString = ""
 
-        for out in toOutput:
-            if args.as_scad:
-                if isinstance(out, lib.ScadFile):
-                    outString = outString + out.asScad(args.recursive) + "\n" + "\n"
-                else:
-                    outString = outString + out.asScad() + "\n" + "\n"
-            elif args.as_json:
-                if isinstance(out, lib.ScadFile):
-                    outString = outString + out.asJson() + "\n" + "\n"
-                else:
-                    outString = outString + out.asJson() + "\n" + "\n"
-            elif args.as_dump:
+            for out in toOutput:
+                if args.as_scad:
+                    if isinstance(out, lib.ScadFile):
+                        outString = outString + out.asScad(args.recursive) + "\n" + "\n"
+                    else:
+                        outString = outString + out.asScad() + "\n" + "\n"
+                elif args.as_json:
+                    if isinstance(out, lib.ScadFile):
+                        outString = outString + out.asJson() + "\n" + "\n"
+                    else:
+                        outString = outString + out.asJson() + "\n" + "\n"
+                elif args.as_dump:
 
-                if isinstance(out, lib.ScadFile):
-                    outString = outString + out.asDump(args.recursive) + "\n" + "\n"
+                    if isinstance(out, lib.ScadFile):
+                        outString = outString + out.asDump(args.recursive) + "\n" + "\n"
+                    else:
+                        outString = outString + out.asDump() + "\n" + "\n"
                 else:
-                    outString = outString + out.asDump() + "\n" + "\n"
-            else:
-                outString = outString + str(out) + "\n" + "\n"
+                    outString = outString + str(out) + "\n" + "\n"
 
         if args.as_scad:
             outFile = lib.determineOutFile(args.INPUT_FILE_OR_DIR[0], "scad.info.", "scad")
@@ -95,32 +150,55 @@ if __name__ == "__main__":
 
     def cmd_map_handler(args):
         lib.printConsole("PROGRESS: Creating a mapping...", 1)
+        inputFileDependencies = None  # scadEntityType -> the names of the dependencies of that type (in order)
         if args.input_file is not None:
             lib.printConsole("PROGRESS: Creating the mapping only for entities needed by '{}'".format(args.input_file), 1)
-            inputFile = lib.ScadFileFromFile.buildFromFile(path=args.input_file, recursive=False, referencedFromScadFile=None)
+            inputFile = context.registry.getScadFile(args.input_file, recursive=False)
 
             if inputFile.metaDataIsAutoGenerated:
-                raise ValueError("'{}' did not have a @filename tag with the correct name. IS THE FILENAME TAG CORRECT? We can't build a library without knowing the dependencies.".format(args.INPUT_FILE))
+                raise ValueError("'{}' did not have a @filename tag with the correct name. IS THE FILENAME TAG CORRECT? We can't build a library without knowing the dependencies.".format(args.input_file))
 
             lib.printConsole(str(inputFile) + "\n", 1)
-            inputFileDependencyNames = list()
+            inputFileDependencyNames = set()
+            inputFileDependencies = dict((scadEntityType, collections.OrderedDict()) for scadEntityType in (lib.ScadModule, lib.ScadFunction, lib.ScadVariable))
 
             for entity in inputFile.getAvailableEntities():
                 for dependency in entity.getDependencies():
-                    inputFileDependencyNames.append(dependency.name)
-
-        if os.path.isfile(args.MAPPING):
-            with open(args.MAPPING, 'r') as f:
-                jsonMapping = json.load(f, object_pairs_hook=collections.OrderedDict)
-        else:
-            jsonMapping = json.loads(args.MAPPING, object_pairs_hook=collections.OrderedDict)
+                    inputFileDependencyNames.add(dependency.name)
+                    inputFileDependencies[dependency.scadEntityType][dependency.name] = None
+
+        import json
+        with context.profiler.phase("read"):
+            if os.path.isfile(args.MAPPING):
+                with open(args.MAPPING, 'r') as f:
+                    jsonMapping = json.load(f, object_pairs_hook=collections.OrderedDict)
+            else:
+                jsonMapping = json.loads(args.MAPPING, object_pairs_hook=collections.OrderedDict)
 
         lib.printConsole("INFO: JSON-Mapping:" + lib.txt_prefix_each_line(lib.txt_pretty_print(jsonMapping), "    ") + "\n", 2)
 
+        entityTypes = {"modules": lib.ScadModule, "functions": lib.ScadFunction, "variables": lib.ScadVariable}
+        dependencyTags = {lib.ScadModule: "module-dependency", lib.ScadFunction: "function-dependency", lib.ScadVariable: "variable-dependency"}
+
+        def mappingEntity(scadEntityType, sourceName, targetName, targetDescription):
+            """Create the entity sourceName that uses targetName."""
+            tags = [("description", "A Mapping from '{}' to '{}'".format(sourceName, targetName)), (dependencyTags[scadEntityType], targetName)]
+            if scadEntityType is lib.ScadVariable:
+                return lib.ScadVariable(name=sourceName, value=targetName, metaData=lib.ScadDoc.fromTags(tags, lib.ScadVariable))
+            tags.extend(("argument", sourceArgument) for sourceArgument in targetDescription["arguments"].keys())
+            arguments = ", ".join(targetDescription["arguments"].keys())
+            content = "{}({});".format(targetName, ", ".join(targetDescription["targetSignature"]))
+            return scadEntityType(name=sourceName, arguments=arguments, content=content, metaData=lib.ScadDoc.fromTags(tags, scadEntityType))
+
         mappingFile = lib.ScadFile()
 
         for entityType, mapping in jsonMapping.items():
             lib.printConsole("INFO: MAP: entityType='{}'".format(entityType), 2)
+            if entityType not in entityTypes:
+                raise ValueError("The entity types in a mapping must be 'modules', 'functions' or 'variables' but one is '{}'.".format(entityType))
+            scadEntityType = entityTypes[entityType]
+            rules = lib.ScadNameMappingRules()  # "PREFIX*", "*SUFFIX" and "/REGEX/" source names
+            mappedNames = set()
 
             for sourceName, targetDescription in mapping.items():
                 if isinstance(targetDescription, str):
@@ -155,205 +233,296 @@ if __name__ == "__main__":
                 else:
                     raise ValueError("targetDescription must either be a json-string or a json-object.")
 
-                if entityType == "modules":
-                    meta = lib.ScadDoc("A Mapping from '{}' to '{}'".format(sourceName, targetDescription["name"]), lib.ScadModule)
-                    meta.add("module-dependency", targetDescription["name"])
-                    for sourceArgument in targetDescription["arguments"].keys():
-                        meta.add("argument", sourceArgument)
-                    arguments = ", ".join(targetDescription["arguments"].keys())
-                    content = "{}({});".format(targetDescription["name"], ", ".join(targetDescription["targetSignature"]))
-                    entity = lib.ScadModule(name=sourceName, arguments=arguments, content=content, metaData=meta)
-                elif entityType == "functions":
-                    meta = lib.ScadDoc("A Mapping from '{}' to '{}'".format(sourceName, targetDescription["name"]), lib.ScadFunction)
-                    meta.add("function-dependency", targetDescription["name"])
-                    for sourceArgument in targetDescription["arguments"].keys():
-                        meta.add("argument", sourceArgument)
-                    arguments = ", ".join(targetDescription["arguments"].keys())
-                    content = "{}({});".format(targetDescription["name"], ", ".join(targetDescription["targetSignature"]))
-                    entity = lib.ScadFunction(name=sourceName, arguments=arguments, content=content, metaData=meta)
-                elif entityType == "variables":
-                    meta = lib.ScadDoc("A Mapping from '{}' to '{}'".format(sourceName, targetDescription["name"]), lib.ScadVariable)
-                    meta.add("variable-dependency", targetDescription["name"])
-                    entity = lib.ScadVariable(name=sourceName, value=targetDescription["name"], metaData=meta)
+                if lib.ScadNameMappingRules.isRule(sourceName):
+                    rules.add(sourceName, targetDescription["name"], targetDescription)
+                    continue
 
             # if there is an input file and the created entity is needed for the input file
-                if args.input_file is None or entity.name in inputFileDependencyNames:
-                    mappingFile.addDefinedEntity(entity)
+                if args.input_file is None or sourceName in inputFileDependencyNames:
+                    mappingFile.addDefinedEntity(mappingEntity(scadEntityType, sourceName, targetDescription["name"], targetDescription))
+                    mappedNames.add(sourceName)
+
+            if len(rules) > 0:
+                if inputFileDependencies is None:
+                    lib.printConsole("NOTICE: The rules for {} are only applied to the dependencies of an --input-file.".format(entityType), 1)
+                    continue
+                with context.profiler.phase("resolution"):
+                    mapped = rules.mapNames(name for name in inputFileDependencies[scadEntityType] if name not in mappedNames)
+                for sourceName, (targetName, targetDescription) in mapped.items():
+                    mappingFile.addDefinedEntity(mappingEntity(scadEntityType, sourceName, targetName, targetDescription))
 
         lib.printConsole("INFO: Mapping-Entities:\n" + lib.txt_prefix_each_line(lib.txt_pretty_print(mappingFile.getDefinedEntities()), "    ") + "\n", 2)
         outFileName = lib.determineOutFile(args.input_file, "mapping", ".scad")
 
         mappingFile.metaData = lib.ScadDoc("@filename: " + str(outFileName), lib.ScadFile, None)
-        lib.outputHelper(mappingFile.asScad(recursive=False, excludeList=[], dummiesFirst=False), outFileName)
+        with context.profiler.phase("emission"), context.memory.measure("emission"):
+            outString = mappingFile.asScad(recursive=False, excludeList=[], dummiesFirst=False)
+        lib.outputHelper(outString, outFileName)
 
     def cmd_build_handler(args):
         lib.printConsole("PROGRESS: Building a library based on these sources:\nPROGRESS:         {}\nPROGRESS:     recursively: '{}'\nPROGRESS:     traversing through dirs: '{}'".format(repr(args.LIBRARY_FILE_OR_DIR), args.recursive, args.traverse_dirs), 1)
         if args.recursive and args.traverse_dirs:
             lib.printConsole("NOTICE: You've set --recursive and --traverse-dirs. This might lead to problems if a file is referenced in a source file and found by traversing.", 1)
-        scadLibrary = lib.ScadLibrary(args.LIBRARY_FILE_OR_DIR, args.recursive, args.traverse_dirs)
-
-        lib.printConsole("PROGRESS: Building the library for: '{}'".format(repr(args.INPUT_FILE)), 1)
-        inputFile = lib.ScadFileFromFile.buildFromFile(path=args.INPUT_FILE, recursive=True, referencedFromScadFile=None)
-
-        if inputFile.metaDataIsAutoGenerated:
-            raise ValueError("'{}' did not have a @filename tag with the correct name. IS THE FILENAME TAG CORRECT? We can't build a library without knowing the dependencies.".format(args.INPUT_FILE))
-
-        lib.printConsole("PROGRESS: Checking the internal structure of the input file. Trying to resolve dependencies internally...", 1)
-
-        dependencyTree, unresolvedDependencies = inputFile.getDependencyTreeAndUnresolvedDependencies([inputFile])
-        lib.printConsole("INFO: Internal Dependency Tree:\n" + lib.txt_pretty_print(dependencyTree, kvsep=" depends on: "), 2)
-        lib.printConsole("INFO: Internally Unresolved Dependencies:\n" + lib.txt_pretty_print(unresolvedDependencies), 2)
-
-        if unresolvedDependencies:  # unresolvedDependencies is not empty
-            lib.printConsole("PROGRESS: Resolving the dependencies by searching the library...", 2)
-            t, u = scadLibrary.findResolutions(unresolvedDependencies)
-            if t is not None:
-                dependencyTree.update(t)
-            unresolvedDependencies = u
-
-        if dependencyTree is None:
-            lib.printConsole("""\nWARNING: The dependency tree is empty!
-    This means NONE of the defined dependencies could be resolved.
-
-    Possible Reason 0: There are no models for the given entities.
-        That would be sad...
-
-    Possible Reason 1: No dependencies are defined.
-        Is there a @module-dependency tag in the input file?
-
-    Possible Reason 2: The library is empty
-        Often the --traverse (-t) flag is forgotten. This flag makes
-        sure sub-directories are used to create the library.
-
-    Possible Reason 3: The mapping is missing
-        Is there a file containing the mapping to the module names used
-        in the library?
-
-    Possible Reason 4: Some includes are missing.
-        I once forgot t include the file that defines the model and
-        therefore all the dependencies.
-
-    Dummies will be created...""", 1)
-            dependencyTree = dict()
-
-        lib.printConsole("INFO: Complete Dependency Tree:\n" + lib.txt_pretty_print(dependencyTree, kvsep=" depends on: "), 2)
-
-        neededEntities = lib.ScadLibrary.reduceRedundanciesInDependencyTree(dependencyTree)
-
-        if len(unresolvedDependencies) > 0:
-            lib.printConsole("INFO: Still Unresolved Dependencies:\n" + lib.txt_pretty_print(unresolvedDependencies), 2)
-            dummyResolutions = list()
-            if not args.dont_create_dummies:
-                lib.printConsole("INFO: Creating Dummies for the Unresolved Dependencies", 2)
-                for dependency in unresolvedDependencies:
-                    dummyResolutions.append(dependency.getDummyResolution())
-            lib.printConsole(lib.txt_prefix_each_line(lib.txt_pretty_print(dummyResolutions), "    "), 3)
-            neededEntities = neededEntities + dummyResolutions
-            neededEntities = list(set(neededEntities))  # should be unnecessary as there should be no duplicates.
-
-        # remove entities that are defined in the input file
-        neededEntities = list(filter(lambda entity: entity not in inputFile.getAvailableEntities(), neededEntities))
-        lib.printConsole("INFO: Entities in library:\n" + lib.txt_prefix_each_line(lib.txt_pretty_print(neededEntities), "    "), 2)
 
         outFileName = lib.determineOutFile(args.INPUT_FILE, "lib.", "scad")
-        outScadFile = lib.ScadFile(definedEntities=neededEntities)
-        if outFileName is not None:
-            outScadFile.metaData.add("filename", outFileName)
-        outString = outScadFile.asScad(dummiesFirst=True)
-
-        lib.outputHelper(outString, outFileName)
+        if args.sharded and args.shard_dir is None:
+            args.shard_dir = os.path.join(os.path.dirname(outFileName), "shards")
+        scadLibrary = None
+        cache, cacheKey, cachedEntry = (None, None, None)
+        if args.cache_dir is not None:
+            sourceFiles = lib.ScadLibrary.findSourceFiles(args.LIBRARY_FILE_OR_DIR, args.traverse_dirs)
+            cache, cacheKey, cachedEntry = output_cache_lookup(args, args.INPUT_FILE, sourceFiles, outFileName)
+            if cachedEntry is None:  # don't walk the library directories again
+                scadLibrary = lib.ScadLibrary(recursive=args.recursive, sourceFiles=sourceFiles)
+        if cachedEntry is not None:
+            lib.writeShards(cachedEntry.get("shards", {}))
+            lib.outputHelper(cachedEntry["output"], outFileName)
+            write_depfile(args, outFileName, cachedEntry["contributors"], cachedEntry.get("assets", ()))
+            output_cache_stats(args, cache)
+            return
+
+        shardDir = args.shard_dir if args.sharded else None
+        result = lib.buildLibrary(args.INPUT_FILE, args.LIBRARY_FILE_OR_DIR, args.recursive, args.traverse_dirs, args.infer_dependencies, not args.dont_create_dummies, outFileName, scadLibrary=scadLibrary, compactNumbers=args.compact_numbers, precision=args.precision, dedupeVertices=args.dedupe_vertices, minify=args.minify, shardDir=shardDir, sizeReport=size_report_requested(args))
+        if cache is not None:
+            cache.store(cacheKey, result.output, result.contributorPaths, result.assetPaths, result.shards)
+
+        if result.shards is not None:
+            lib.writeShards(result.shards)
+        lib.outputHelper(result.output, outFileName)
+        write_depfile(args, outFileName, result.contributorPaths, result.assetPaths)
+        output_cache_stats(args, cache)
+        output_size_reports(args, [result])
 
     def cmd_compile_handler(args):
-        lib.printConsole("PROGRESS: Compiling all references in '{}' to a single file".format(args.INPUT_FILE), 1)
-        inputFile = lib.ScadFileFromFile.buildFromFile(path=args.INPUT_FILE, recursive=True, referencedFromScadFile=None)
-        outFileName = lib.determineOutFile(args.INPUT_FILE, "comp.", "scad")
-        outString = inputFile.asDump(recursive=True)
-        lib.outputHelper(outString, outFileName)
+        cache = None
+        toCompile = list()  # (input file, output file, cache key) of the inputs that are not in the cache
+        for inputFile in args.INPUT_FILE:
+            lib.printConsole("PROGRESS: Compiling all references in '{}' to a single file".format(inputFile), 1)
+            outFileName = lib.determineOutFile(inputFile, "comp.", "scad")
+            cache, cacheKey, cachedEntry = output_cache_lookup(args, inputFile)
+            if cachedEntry is not None:
+                lib.outputHelper(cachedEntry["output"], outFileName)
+                write_depfile(args, outFileName, cachedEntry["contributors"], cachedEntry.get("assets", ()))
+            else:
+                toCompile.append((inputFile, outFileName, cacheKey))
+
+        options = dict(minimal=args.minimal, compactNumbers=args.compact_numbers, precision=args.precision, dedupeVertices=args.dedupe_vertices, minify=args.minify, sizeReport=size_report_requested(args))
+        if len(toCompile) == 1:
+            results = [lib.compileFile(toCompile[0][0], **options)]
+        else:
+            results = lib.compileFiles([inputFile for inputFile, _, _ in toCompile], jobs=args.jobs, **options)
+
+        for (inputFile, outFileName, cacheKey), result in zip(toCompile, results):
+            if cache is not None:
+                cache.store(cacheKey, result.output, result.contributorPaths, result.assetPaths)
+            lib.outputHelper(result.output, outFileName)
+            write_depfile(args, outFileName, result.contributorPaths, result.assetPaths)
+        output_cache_stats(args, cache)
+        output_size_reports(args, results)
 
     # Argument parsing
-    parser = argparse.ArgumentParser(description="Collect and Extract Information, Manipulate and Compile .scad Files or Collections of .scad Files.")
+    # Only the arguments of the requested subcommand are set up, setting up
+    # all of them takes a noticeable part of the time of a short run.
+    def setup_info_parser(parser_info):
+        parser_info_group_input = parser_info.add_argument_group(title="input", description="How to handle the input files.")
+        parser_info_group_input.add_argument("INPUT_FILE_OR_DIR", nargs="+", help="The files/directories that should be searched.")
+        parser_info_group_input.add_argument("-t", "--traverse-dirs", action="store_true", help="If a directory is given traverse through the sub directories. (This is what you probably want to do if you are extracting information from a library file structure.)  You probably don't want to combine this with --recursive")
+        parser_info_group_input.add_argument("-r", "--recursive", action="store_true", help="look for information recursively (look in included and used files). You probably don't want to combine this with --traverse-dirs")
+
+        parser_info_group_output = parser_info.add_argument_group(title="output", description="What should the output look line?")
+        parser_info_group_output.add_argument("-o", "--output", nargs="?", default=None, const="", help="write output to an .scad File instead to console. (if not defined further 'foo.scad' becomes 'foo.info.scad'.)")
+
+        parser_info_group_output_override = parser_info_group_output.add_mutually_exclusive_group()
+        parser_info_group_output_override.add_argument("--override", action="store_true", help="Override existing output files without asking.")
+        parser_info_group_output_override.add_argument("--dont-override", action="store_true", help="Do not override any existing output files - Print to console instead.")
+        parser_info_group_output_override.add_argument("--ask", default="true", action="store_true", help="Ask if an existing file should be overwritten. (default)")
+        parser_info_group_output_override.add_argument("--write-if-changed", action="store_true", help="Only write the output file if its content changed (so its mtime doesn't change otherwise). The file is replaced atomically, without asking.")
+
+        parser_info_group_output_type = parser_info_group_output.add_mutually_exclusive_group()
+        parser_info_group_output_type.add_argument("--as-scad", action="store_true", help="give output that can be used in .scad files.")
+        parser_info_group_output_type.add_argument("--as-json", action="store_true", help="give output that is json encoded. Useful for creating tools that depend on the data in the library. (NOT IMPLEMENTED YET).")
+        parser_info_group_output_type.add_argument("--as-dump", action="store_true", help="dump the relevant sections from the content. If recursive, included or used sections will be copied.")
+
+        parser_info_group_selection = parser_info.add_argument_group(title="selection", description="Which information should be extracted?")
+        parser_info_group_selection.add_argument("-s", "--self", action="store_true", help="show information about the file itself.")
+        parser_info_group_selection.add_argument("-m", "--modules", action="store_true", help="list the modules in the given file.")
+        parser_info_group_selection.add_argument("-v", "--variables", action="store_true", help="list the variables in the given file.")
+        parser_info_group_selection.add_argument("-f", "--functions", action="store_true", help="list the functions in the given file.")
+        parser_info_group_selection.add_argument("-i", "--includes", action="store_true", help="list the files that are included in this file.")
+        parser_info_group_selection.add_argument("-u", "--uses", action="store_true", help="list the files that are used by this file.")
+        parser_info_group_selection.add_argument("--dependents", metavar="NAME", action="append", help="list the entities and files that depend on the module, function or variable NAME. May be given multiple times.")
+        parser_info_group_selection.add_argument("--transitive", action="store_true", help="with --dependents: also list what depends on the dependents.")
+        parser_info_group_selection.add_argument("--infer-dependencies", nargs="?", default=None, const="merge", choices=["merge", "only"], help="with --dependents: also find dependencies by looking at the code, see 'build -h'.")
+
+        parser_info_group_filter = parser_info.add_argument_group(title="filter", description="Filter the entities. (NOT IMPLEMENTED YET!)")
+        parser_info_group_filter.add_argument("--filter", help="A json string or file, that defines what to look for. (NOT IMPLEMENTED YET!)")
+        parser_info_group_filter.add_argument("--with-meta", help="Only show results with the given metadata field. May be defined multiple times in order to limit the amount of results. (NOT IMPLEMENTED YET!)")
+        parser_info_group_filter.add_argument("--with-meta-key-value", nargs=2, help="Only show results where the given metadata field has the given value, or item.  May be defined multiple times in order to limit the amount of results. (NOT IMPLEMENTED YET!)")
+
+    def setup_map_parser(parser_map):
+        parser_map.add_argument("MAPPING", help="A json file or a json string that specifies name mappings for modules, variables and functions. Simple Example:" + """'{ "modules": { "moduleName" : "implementingModuleName" } }'""" + ". Names of the form 'PREFIX*', '*SUFFIX' and '/REGEX/' are rules that map all the matching dependencies of the --input-file.")
+        parser_map.add_argument("-i", "--input-file", nargs="?", default=None, const="", help="If given, only the entities needed for the modules in this file are mapped.")
+        parser_map.add_argument("-o", "--output", nargs="?", default=None, const="", help="write output to an .scad File instead to console. (if not defined further 'foo.scad' becomes 'foo.lib.scad'.)")
+        parser_map_group_output_override = parser_map.add_mutually_exclusive_group()
+        parser_map_group_output_override.add_argument("--override", action="store_true", help="Override existing output files without asking.")
+        parser_map_group_output_override.add_argument("--dont-override", action="store_true", help="Do not override any existing output files - Print to console instead.")
+        parser_map_group_output_override.add_argument("--ask", default="true", action="store_true", help="Ask if an existing file should be overwritten. (default)")
+        parser_map_group_output_override.add_argument("--write-if-changed", action="store_true", help="Only write the output file if its content changed (so its mtime doesn't change otherwise). The file is replaced atomically, without asking.")
+
+    def setup_numeric_data_arguments(parser):
+        group = parser.add_argument_group(title="numeric data", description="How vectors that only contain numbers (like the points and faces of a polyhedron or lookup tables) are written.")
+        group.add_argument("--compact-numbers", action="store_true", help="Write numeric vectors without whitespace and with the shortest numbers ('2' instead of '2.000').")
+        group.add_argument("--precision", metavar="N", type=int, default=None, help="Round the numbers in numeric vectors to N decimal places. (implies --compact-numbers)")
+        group.add_argument("--dedupe-vertices", action="store_true", help="Remove repeated points of polyhedrons and renumber their faces, if the points and faces are literals or variables that are not used elsewhere. (implies --compact-numbers)")
+
+    def setup_size_report_arguments(parser):
+        group = parser.add_argument_group(title="size report", description="Which entities and source files the output is made of.")
+        group.add_argument("--size-report", action="store_true", help="Print the bytes and lines of the output that come from each entity (with the size of its dependency closure) and each source file, the biggest first, to stderr.")
+        group.add_argument("--size-report-json", metavar="PATH", default=None, help="Write the size report as json to PATH (a list with a report for each output).")
+
+    def setup_build_parser(parser_build):
+        parser_build_group_input = parser_build.add_argument_group(title="input", description="How to handle the input files.")
+
+        parser_build_group_input.add_argument("INPUT_FILE", help="The file to create the library for.")
+        parser_build_group_input.add_argument("LIBRARY_FILE_OR_DIR", nargs="+", help="The files/directories that should be searched for the needed entities to create this library.")
+
+        parser_build_group_input.add_argument("-t", "--traverse-dirs", action="store_true", help="If a directory is given traverse through the sub directories to find .scad files.")
+        parser_build_group_input.add_argument("-r", "--recursive", action="store_true", help="look for entities recursively (look in included and used files).")
+        parser_build_group_input.add_argument("--infer-dependencies", nargs="?", default=None, const="merge", choices=["merge", "only"], help="Find dependencies by looking at the modules, functions and variables used in the code. 'merge' (default) adds them to the dependencies defined by -dependency tags, 'only' ignores the tags.")
+
+        parser_build_group_output = parser_build.add_argument_group(title="output", description=None)
+        parser_build_group_output.add_argument("-o", "--output", nargs="?", default=None, const="", help="write output to an .scad File instead to console. (if not defined further 'foo.scad' becomes 'foo.lib.scad'.)")
+        parser_build_group_output_override = parser_build_group_output.add_mutually_exclusive_group()
+        parser_build_group_output_override.add_argument("--override", action="store_true", help="Override existing output files without asking.")
+        parser_build_group_output_override.add_argument("--dont-override", action="store_true", help="Do not override any existing output files - Print to console instead.")
+        parser_build_group_output_override.add_argument("--ask", default="true", action="store_true", help="Ask if an existing file should be overwritten. (default)")
+        parser_build_group_output_override.add_argument("--write-if-changed", action="store_true", help="Only write the output file if its content changed (so its mtime doesn't change otherwise). The file is replaced atomically, without asking.")
+        parser_build_group_output.add_argument("--dont-create-dummies", action="store_true", help="Don't create dummies for unresolved dependencies.")
+        parser_build_group_output.add_argument("--cache-dir", metavar="DIR", default=None, help="Store the output in DIR and reuse it (without parsing and resolving) as long as the options, the input file and the library files that contributed to it don't change.")
+        parser_build_group_output.add_argument("--cache-stats", action="store_true", help="with --cache-dir: print the hits and misses and the size of the cache to stderr.")
+        parser_build_group_output.add_argument("-M", "--depfile", metavar="PATH", default=None, help="with -o: write a gcc style dependency file (for make or ninja) to PATH. It lists the input file, the files it references, the library files the entities come from and the files they import() (.stl, .dxf ...).")
+        parser_build_group_output.add_argument("--sharded", action="store_true", help="with -o: Split the output into shards: one file for the needed entities of each library file, written to the --shard-dir, and the output file that use<>s them. The names of the shards are content-addressed, so parts that need the same entities share the shards and existing shards are not written again.")
+        parser_build_group_output.add_argument("--shard-dir", metavar="DIR", default=None, help="with --sharded: the directory for the shards. (default: 'shards' next to the output file)")
+        parser_build_group_output.add_argument("--minify", action="store_true", help="Remove the comments and the whitespace that is not needed from the output. It is checked that the output still defines the same entities.")
+        setup_numeric_data_arguments(parser_build)
+        setup_size_report_arguments(parser_build)
+
+    def setup_compile_parser(parser_compile):
+        parser_compile.add_argument("INPUT_FILE", nargs="+", help="The files to compile. The files referenced by several of them are only read once.")
+        parser_compile.add_argument("-o", "--output", nargs="?", default=None, const="", help="write output to an .scad File instead to console. (if not defined further 'foo.scad' becomes 'foo.comp.scad'. With several INPUT_FILEs the names can't be defined further.)")
+        parser_compile.add_argument("-j", "--jobs", type=int, default=None, help="with several INPUT_FILEs: the number of worker processes that produce the outputs. (default: the number of CPUs)")
+        parser_compile.add_argument("--cache-dir", metavar="DIR", default=None, help="Store the output in DIR and reuse it (without parsing) as long as the options and the compiled files don't change.")
+        parser_compile.add_argument("--cache-stats", action="store_true", help="with --cache-dir: print the hits and misses and the size of the cache to stderr.")
+        parser_compile.add_argument("-M", "--depfile", metavar="PATH", default=None, help="with -o: write a gcc style dependency file (for make or ninja) to PATH. It lists the compiled files and the files they import() (.stl, .dxf ...).")
+        parser_compile.add_argument("--minimal", action="store_true", help="Only copy the entities from referenced files that are reachable from the statements of the input file (following the -dependency tags and the modules, functions and variables used in the code) in dependency order.")
+        parser_compile_group_output_override = parser_compile.add_mutually_exclusive_group()
+        parser_compile_group_output_override.add_argument("--override", action="store_true", help="Override existing output files without asking.")
+        parser_compile_group_output_override.add_argument("--dont-override", action="store_true", help="Do not override any existing output files - Print to console instead.")
+        parser_compile_group_output_override.add_argument("--ask", default="true", action="store_true", help="Ask if an existing file should be overwritten. (default)")
+        parser_compile_group_output_override.add_argument("--write-if-changed", action="store_true", help="Only write the output file if its content changed (so its mtime doesn't change otherwise). The file is replaced atomically, without asking.")
+        parser_compile.add_argument("--minify", action="store_true", help="Remove the comments and the whitespace that is not needed from the output. It is checked that the output still defines the same entities.")
+        setup_numeric_data_arguments(parser_compile)
+        setup_size_report_arguments(parser_compile)
+
+    subcommands = collections.OrderedDict([  # name -> (description, setup function, handler)
+        ("info", ("Show information about the given file or set of files. You may get information about a single file or whole directories (library).", setup_info_parser, cmd_info_handler)),
+        ("map", ("Creates a file that maps between different entity names, using a json encoded mapping file or string.", setup_map_parser, cmd_map_handler)),
+        ("build", ("Builds a Library for a file: Finds all unresolved dependencies in a file and creates a so-called library file, that resolves these dependencies using models from a library (a collection of .scad files).", setup_build_parser, cmd_build_handler)),
+        ("compile", ("Compile the referenced files to a single file. Useful for debugging, when OpenSCAD complains on line numbers you can't know.", setup_compile_parser, cmd_compile_handler))])
+
+    def setup_global_arguments(parser):
+        parser.add_argument("-v", "--verbose", action="count", default=0, help="-v -vv- -vvv increase output verbosity")
+        parser.add_argument("-q", "--quiet", action="store_true", help="suppress any output except for final results.")
+        parser.add_argument('-V', '--version', action='version', version="%(prog)s " + str(lib.VERSION))
+        parser.add_argument("--profile", action="store_true", help="measure the time spent in each phase (discovery, read, parse, metadata, resolution, dummy creation, emission, write) and print a table to stderr.")
+        parser.add_argument("--metrics-json", metavar="PATH", default=None, help="write counters (files, bytes, regex matches, resolution lookups, dummies, output bytes ...) and the wall and cpu time of the run and of each phase as json to PATH.")
+        parser.add_argument("--profile-dump", metavar="PSTATS_FILE", default=None, help="run the whole command under cProfile and write the statistics to PSTATS_FILE (readable with the pstats module). Implies --profile.")
+
+        parser.add_argument("--lib-path", metavar="DIR", action="append", default=[], help="a library directory: include <...> and use <...> look for their targets relative to the file, then in these directories (in the given order), then in the directories of the OPENSCADPATH environment variable. May be given several times.")
+        parser.add_argument("--memory-report", action="store_true", help="trace the memory allocations (with tracemalloc, which makes the run slower) and print to stderr how much memory the steps (reading the library, resolution, emission) retain, which structures of the read files (content, comment positions, ScadDocs, InScadFiles, entity bodies ...) and which files hold it.")
+        parser.add_argument("--memory-report-json", metavar="PATH", default=None, help="write the memory report as json to PATH. Implies tracing the memory allocations.")
+
+    class SubcommandFinder(argparse.ArgumentParser):
+        """A parser with only the global options, to find the subcommand
+        before the full parser is set up. Errors are left to the full parser."""
+        def error(self, message):
+            raise ValueError(message)
+
+    def requested_subcommand(argv):
+        """Find the name of the subcommand in argv without parsing the
+        arguments of the subcommands. The global options are matched like
+        the full parser does (including abbreviations like --lib)."""
+        finder = SubcommandFinder(add_help=False)
+        setup_global_arguments(finder)
+        try:
+            rest = finder.parse_known_args(argv)[1]
+        except ValueError:
+            return None
+        for arg in rest:
+            if arg in subcommands:
+                return arg
+            elif not arg.startswith("-"):
+                return None
+        return None
 
-    parser.add_argument("-v", "--verbose", action="count", default=0, help="-v -vv- -vvv increase output verbosity")
-    parser.add_argument("-q", "--quiet", action="store_true", help="suppress any output except for final results.")
-    parser.add_argument('-V', '--version', action='version', version="%(prog)s " + str(lib.VERSION))
+    parser = argparse.ArgumentParser(description="Collect and Extract Information, Manipulate and Compile .scad Files or Collections of .scad Files.")
+    setup_global_arguments(parser)
 
     subparsers = parser.add_subparsers(dest="cmd")
-    parser_info = subparsers.add_parser("info", description="Show information about the given file or set of files. You may get information about a single file or whole directories (library).")
-    parser_info_group_input = parser_info.add_argument_group(title="input", description="How to handle the input files.")
-    parser_info_group_input.add_argument("INPUT_FILE_OR_DIR", nargs="+", help="The files/directories that should be searched.")
-    parser_info_group_input.add_argument("-t", "--traverse-dirs", action="store_true", help="If a directory is given traverse through the sub directories. (This is what you probably want to do if you are extracting information from a library file structure.)  You probably don't want to combine this with --recursive")
-    parser_info_group_input.add_argument("-r", "--recursive", action="store_true", help="look for information recursively (look in included and used files). You probably don't want to combine this with --traverse-dirs")
-
-    parser_info_group_output = parser_info.add_argument_group(title="output", description="What should the output look line?")
-    parser_info_group_output.add_argument("-o", "--output", nargs="?", default=None, const="", help="write output to an .scad File instead to console. (if not defined further 'foo.scad' becomes 'foo.info.scad'.)")
-
-    parser_info_group_output_override = parser_info_group_output.add_mutually_exclusive_group()
-    parser_info_group_output_override.add_argument("--override", action="store_true", help="Override existing output files without asking.")
-    parser_info_group_output_override.add_argument("--dont-override", action="store_true", help="Do not override any existing output files - Print to console instead.")
-    parser_info_group_output_override.add_argument("--ask", default="true", action="store_true", help="Ask if an existing file should be overwritten. (default)")
-
-    parser_info_group_output_type = parser_info_group_output.add_mutually_exclusive_group()
-    parser_info_group_output_type.add_argument("--as-scad", action="store_true", help="give output that can be used in .scad files.")
-    parser_info_group_output_type.add_argument("--as-json", action="store_true", help="give output that is json encoded. Useful for creating tools that depend on the data in the library. (NOT IMPLEMENTED YET).")
-    parser_info_group_output_type.add_argument("--as-dump", action="store_true", help="dump the relevant sections from the content. If recursive, included or used sections will be copied.")
-
-    parser_info_group_selection = parser_info.add_argument_group(title="selection", description="Which information should be extracted?")
-    parser_info_group_selection.add_argument("-s", "--self", action="store_true", help="show information about the file itself.")
-    parser_info_group_selection.add_argument("-m", "--modules", action="store_true", help="list the modules in the given file.")
-    parser_info_group_selection.add_argument("-v", "--variables", action="store_true", help="list the variables in the given file.")
-    parser_info_group_selection.add_argument("-f", "--functions", action="store_true", help="list the functions in the given file.")
-    parser_info_group_selection.add_argument("-i", "--includes", action="store_true", help="list the files that are included in this file.")
-    parser_info_group_selection.add_argument("-u", "--uses", action="store_true", help="list the files that are used by this file.")
-
-    parser_info_group_filter = parser_info.add_argument_group(title="filter", description="Filter the entities. (NOT IMPLEMENTED YET!)")
-    parser_info_group_filter.add_argument("--filter", help="A json string or file, that defines what to look for. (NOT IMPLEMENTED YET!)")
-    parser_info_group_filter.add_argument("--with-meta", help="Only show results with the given metadata field. May be defined multiple times in order to limit the amount of results. (NOT IMPLEMENTED YET!)")
-    parser_info_group_filter.add_argument("--with-meta-key-value", nargs=2, help="Only show results where the given metadata field has the given value, or item.  May be defined multiple times in order to limit the amount of results. (NOT IMPLEMENTED YET!)")
-
-    parser_map = subparsers.add_parser("map", description="Creates a file that maps between different entity names, using a json encoded mapping file or string.")
-    parser_map.add_argument("MAPPING", help="A json file or a json string that specifies name mappings for modules, variables and functions. Simple Example:" + """'{ "modules": { "moduleName" : "implementingModuleName" } }'""")
-    parser_map.add_argument("-i", "--input-file", nargs="?", default=None, const="", help="If given, only the entities needed for the modules in this file are mapped.")
-    parser_map.add_argument("-o", "--output", nargs="?", default=None, const="", help="write output to an .scad File instead to console. (if not defined further 'foo.scad' becomes 'foo.lib.scad'.)")
-    parser_map_group_output_override = parser_map.add_mutually_exclusive_group()
-    parser_map_group_output_override.add_argument("--override", action="store_true", help="Override existing output files without asking.")
-    parser_map_group_output_override.add_argument("--dont-override", action="store_true", help="Do not override any existing output files - Print to console instead.")
-    parser_map_group_output_override.add_argument("--ask", default="true", action="store_true", help="Ask if an existing file should be overwritten. (default)")
-
-    parser_build = subparsers.add_parser("build", description="Builds a Library for a file: Finds all unresolved dependencies in a file and creates a so-called library file, that resolves these dependencies using models from a library (a collection of .scad files).")
-    parser_build_group_input = parser_build.add_argument_group(title="input", description="How to handle the input files.")
-
-    parser_build_group_input.add_argument("INPUT_FILE", help="The file to create the library for.")
-    parser_build_group_input.add_argument("LIBRARY_FILE_OR_DIR", nargs="+", help="The files/directories that should be searched for the needed entities to create this library.")
-
-    parser_build_group_input.add_argument("-t", "--traverse-dirs", action="store_true", help="If a directory is given traverse through the sub directories to find .scad files.")
-    parser_build_group_input.add_argument("-r", "--recursive", action="store_true", help="look for entities recursively (look in included and used files).")
-
-    parser_build_group_output = parser_build.add_argument_group(title="output", description=None)
-    parser_build_group_output.add_argument("-o", "--output", nargs="?", default=None, const="", help="write output to an .scad File instead to console. (if not defined further 'foo.scad' becomes 'foo.lib.scad'.)")
-    parser_build_group_output_override = parser_build_group_output.add_mutually_exclusive_group()
-    parser_build_group_output_override.add_argument("--override", action="store_true", help="Override existing output files without asking.")
-    parser_build_group_output_override.add_argument("--dont-override", action="store_true", help="Do not override any existing output files - Print to console instead.")
-    parser_build_group_output_override.add_argument("--ask", default="true", action="store_true", help="Ask if an existing file should be overwritten. (default)")
-    parser_build_group_output.add_argument("--dont-create-dummies", action="store_true", help="Don't create dummies for unresolved dependencies.")
-
-    parser_compile = subparsers.add_parser("compile", description="Compile the referenced files to a single file. Useful for debugging, when OpenSCAD complains on line numbers you can't know.")
-    parser_compile.add_argument("INPUT_FILE", help="The file to compile.")
-    parser_compile.add_argument("-o", "--output", nargs="?", default=None, const="", help="write output to an .scad File instead to console. (if not defined further 'foo.scad' becomes 'foo.comp.scad'.)")
-    parser_compile_group_output_override = parser_compile.add_mutually_exclusive_group()
-    parser_compile_group_output_override.add_argument("--override", action="store_true", help="Override existing output files without asking.")
-    parser_compile_group_output_override.add_argument("--dont-override", action="store_true", help="Do not override any existing output files - Print to console instead.")
-    parser_compile_group_output_override.add_argument("--ask", default="true", action="store_true", help="Ask if an existing file should be overwritten. (default)")
+    requestedSubcommand = requested_subcommand(sys.argv[1:])
+    for name, (description, setup_parser, _) in subcommands.items():
+        subparser = subparsers.add_parser(name, description=description)
+        if name == requestedSubcommand:
+            setup_parser(subparser)
 
     args = parser.parse_args()
-    lib.args = args
-
-    if args.cmd == "info":
-        cmd_info_handler(args)
-    elif args.cmd == "map":
-        cmd_map_handler(args)
-    elif args.cmd == "build":
-        cmd_build_handler(args)
-    elif args.cmd == "compile":
-        cmd_compile_handler(args)
+    context = lib.ScadToolContext.fromArgs(args)
+
+    if args.cmd in subcommands:
+        handler = subcommands[args.cmd][2]
     else:
         print(parser.error("a subcommand is required."))
+
+    if getattr(args, "cache_stats", False) and args.cache_dir is None:
+        parser.error("--cache-stats needs --cache-dir.")
+    if getattr(args, "depfile", None) is not None and args.output is None:
+        parser.error("--depfile needs the name of the output file (-o FILE).")
+    if args.cmd == "compile" and len(args.INPUT_FILE) > 1:
+        if args.output:
+            parser.error("With several INPUT_FILEs the output files are named after them, use -o without a FILE.")
+        if args.depfile is not None:
+            parser.error("--depfile can only be written for a single INPUT_FILE.")
+    if getattr(args, "jobs", None) is not None and args.jobs < 1:
+        parser.error("--jobs must be at least 1.")
+    if getattr(args, "sharded", False) and args.output is None:
+        parser.error("--sharded needs the name of the output file (-o FILE).")
+    if getattr(args, "shard_dir", None) is not None and not args.sharded:
+        parser.error("--shard-dir needs --sharded.")
+
+    context.profiler.enabled = args.profile or args.profile_dump is not None or args.metrics_json is not None
+    context.metrics.enabled = args.metrics_json is not None
+    context.metrics.reset()
+    context.memory.enabled = args.memory_report or args.memory_report_json is not None
+    context.memory.start()
+
+    with context.activate():
+        if args.profile_dump is not None:
+            import cProfile
+            cProfiler = cProfile.Profile()
+            cProfiler.runcall(handler, args)
+            cProfiler.dump_stats(args.profile_dump)
+        else:
+            handler(args)
+
+    if args.profile or args.profile_dump is not None:
+        context.profiler.printTable()
+
+    if args.metrics_json is not None:
+        context.metrics.writeJson(args.metrics_json, args.cmd, context.profiler)
+
+    if context.memory.enabled:
+        memoryReport = context.memory.asDict(context.registry)
+        if args.memory_report:
+            context.memory.printReport(memoryReport)
+        if args.memory_report_json is not None:
+            context.memory.writeJson(args.memory_report_json, memoryReport)
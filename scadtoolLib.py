@@ -19,29 +19,35 @@
 # import statements: We use pythons included batteries!
 import re
 import os
+import sys
+import time
+import contextlib
+import collections
+import bisect
+import array
+import itertools
 
 VERSION = 0.1
 
 open_scad_keywords = "module function cube cylinder square circle sphere polyhedron square circle polygon import_dxf import_stl difference union intersection render include use projection translate rotate scale mirror hull multimatrix color minkowski $fn $fs $fa linear_extrude rotate_extrude if else for abs acos asin atan atan2 ceil cos exp floor ln log lookup sqrt tan sin sign round rands pow min max str".split()
+open_scad_builtins = frozenset(open_scad_keywords + "let each echo assert assign children child import surface text offset resize multmatrix intersection_for group true false undef PI len concat norm cross search chr ord version version_num parent_module dxf_dim dxf_cross is_undef is_bool is_num is_string is_list is_function $t $vpr $vpt $vpd $vpf $children $preview $parent_modules".split())
 
 # ####################### I/O HELPER FUNCTIONS ########################
 
 
 def printConsole(s, minimumVerbosityLevel):
     """Write the given string to the console. To be printed
-    args.verbose needs to be >= minimumVerbosityLevel."""
+    context.verbose needs to be >= minimumVerbosityLevel."""
 
-    global args
-    if not args.quiet and args.verbose >= minimumVerbosityLevel:
+    if not context.quiet and context.verbose >= minimumVerbosityLevel:
         print(s)
 
 
 def determineOutFile(defaultFilenameToDeriveFrom=None, defaultExtensionInfix=None, defaultExtensionOverride=None):
-    global args
-    if args.output is None:
+    if context.output is None:
         return None
     else:
-        if args.output == "":
+        if context.output == "":
             if defaultFilenameToDeriveFrom is None:
                 outFile = "out"
                 if defaultExtensionInfix is not None:
@@ -56,18 +62,22 @@ def determineOutFile(defaultFilenameToDeriveFrom=None, defaultExtensionInfix=Non
                     outFile[1] = defaultExtensionOverride
                 outFile = outFile[0] + outFile[1]
         else:
-            outFile = args.output
+            outFile = context.output
         return outFile
 
 
 def outputHelper(fileContent, outFile):
-    global args
     override = True
+    if outFile is not None and context.write_if_changed and fileHasContent(outFile, fileContent):
+        printConsole("PROGRESS: '{}' is up to date. It is not written again.".format(outFile), 1)
+        context.metrics.count("outputsUnchanged")
+        return
+
     if outFile is not None and os.path.exists(outFile):
-        if args.override:
+        if context.override or context.write_if_changed:
             override = True
             pass
-        elif args.dont_override:
+        elif context.dont_override:
             override = False
         else:
             ans = None
@@ -84,27 +94,638 @@ def outputHelper(fileContent, outFile):
             else:
                 override = False
 
-    if outFile is None or override is False:
-        printConsole(fileContent, 0)
-    else:
-        with open(outFile, 'w') as f:
-            f.write(fileContent)
+    context.metrics.count("outputBytes", len(fileContent.encode()))
+    with context.profiler.phase("write"):
+        if outFile is None or override is False:
+            printConsole(fileContent, 0)
+        elif context.write_if_changed:
+            writeFileAtomically(outFile, fileContent)
+        else:
+            with open(outFile, 'w') as f:
+                f.write(fileContent)
+
+
+def fileHasContent(path, content):
+    """Check if the file at path exists and has exactly the given content."""
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'r') as f:
+        return f.read() == content
+
+
+def writeFileAtomically(path, content):
+    """Write the content to a temporary file next to path and rename it to
+    path. Readers see the old or the new file, never a partial one."""
+    directory = os.path.dirname(os.path.abspath(path))
+    import tempfile
+    import shutil
+    fd, tmpPath = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        if os.path.exists(path):
+            shutil.copymode(path, tmpPath)
+        os.replace(tmpPath, path)
+    except BaseException:
+        os.remove(tmpPath)
+        raise
+
+
+def writeShards(shards):
+    """Write the shards (path -> content) that do not exist yet.
+    The names of shards are content-addressed, so an existing shard
+    already has the content."""
+    for path, content in shards.items():
+        if os.path.exists(path):
+            context.metrics.count("shardsReused")
+            continue
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with context.profiler.phase("write"):
+            writeFileAtomically(path, content)
+        context.metrics.count("shardsWritten")
+
+
+def txt_make_escape(path):
+    """Escape a path for the use in a make rule."""
+    return path.replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+
+def txt_depfile(target, dependencies):
+    """Create a gcc style dependency file (like 'gcc -MD -MP'): a rule
+    'target: dependencies' and an empty rule for each dependency, so make
+    doesn't fail if a dependency is deleted."""
+    lines = [txt_make_escape(target) + ":"]
+    for dependency in dependencies:
+        lines[-1] = lines[-1] + " \\"
+        lines.append("  " + txt_make_escape(dependency))
+    ret = "\n".join(lines) + "\n"
+    for dependency in dependencies:
+        ret = ret + "\n" + txt_make_escape(dependency) + ":\n"
+    return ret
+
+
+def writeDepfile(path, target, dependencies):
+    """Write the dependency file for target (see txt_depfile) to path.
+    The file is only written if its content changed."""
+    content = txt_depfile(target, dependencies)
+    with context.profiler.phase("write"):
+        if fileHasContent(path, content):
+            printConsole("PROGRESS: '{}' is up to date. It is not written again.".format(path), 1)
+        else:
+            writeFileAtomically(path, content)
+            printConsole("PROGRESS: Wrote the dependencies of '{}' to '{}'.".format(target, path), 1)
+
+
+# ####################### PROFILING ########################
+
+
+class PhaseProfiler():
+    """Measures how much time is spent in the different phases of a run.
+
+    Phases may be nested. The time of a phase does not include the time
+    spent in phases nested inside of it, so the sum of all phases is the
+    time spent in profiled code. (Parsing a file that includes another
+    file does not count the parsing of the included file twice.)
+
+    When not enabled, phase() does not measure anything."""
+
+    phaseOrder = ["discovery", "read", "parse", "metadata", "resolution", "dummy creation", "emission", "minify check", "write"]
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.phaseSeconds = dict()
+        self.phaseCpuSeconds = dict()
+        self.phaseCalls = dict()
+        self.fileSeconds = dict()
+        self._stack = list()
+
+    @contextlib.contextmanager
+    def phase(self, name, path=None):
+        """Account the time spent in the with-block to the phase 'name'.
+        If path is given the time is also accounted to that file. Nested
+        phases without a path are accounted to the file of the outer phase."""
+        if not self.enabled:
+            yield
+            return
+
+        now, nowCpu = time.perf_counter(), time.process_time()
+        if self._stack:  # pause the outer phase
+            self.__account(self._stack[-1], now, nowCpu)
+            if path is None:
+                path = self._stack[-1][3]
+        self._stack.append([name, now, nowCpu, path])
+        self.phaseCalls[name] = self.phaseCalls.get(name, 0) + 1
+        try:
+            yield
+        finally:
+            now, nowCpu = time.perf_counter(), time.process_time()
+            self.__account(self._stack.pop(), now, nowCpu)
+            if self._stack:  # resume the outer phase
+                self._stack[-1][1] = now
+                self._stack[-1][2] = nowCpu
+
+    def __account(self, stackItem, now, nowCpu):
+        name, start, startCpu, path = stackItem
+        self.phaseSeconds[name] = self.phaseSeconds.get(name, 0.0) + (now - start)
+        self.phaseCpuSeconds[name] = self.phaseCpuSeconds.get(name, 0.0) + (nowCpu - startCpu)
+        if path is not None:
+            self.fileSeconds[path] = self.fileSeconds.get(path, 0.0) + (now - start)
+
+    def getPhases(self):
+        """Get the names of the measured phases in the order they usually occur."""
+        phases = [p for p in PhaseProfiler.phaseOrder if p in self.phaseSeconds]
+        phases.extend(sorted(p for p in self.phaseSeconds if p not in PhaseProfiler.phaseOrder))
+        return phases
+
+    def asTable(self, maxFiles=10):
+        """Return the measured times as a human readable table."""
+        total = sum(self.phaseSeconds.values())
+
+        ret = ["{:<16} {:>8} {:>12} {:>7}".format("PHASE", "CALLS", "SECONDS", "SHARE")]
+        for p in self.getPhases():
+            share = (self.phaseSeconds[p] / total * 100) if total > 0 else 0.0
+            ret.append("{:<16} {:>8} {:>12.6f} {:>6.1f}%".format(p, self.phaseCalls.get(p, 0), self.phaseSeconds[p], share))
+        ret.append("{:<16} {:>8} {:>12.6f}".format("total", "", total))
+
+        if self.fileSeconds:
+            ret.append("")
+            ret.append("{:<49} {:>12}".format("SLOWEST FILES (READ AND PARSE)", "SECONDS"))
+            slowest = sorted(self.fileSeconds.items(), key=(lambda item: item[1]), reverse=True)
+            for path, seconds in slowest[:maxFiles]:
+                ret.append("{:<49} {:>12.6f}".format(os.path.relpath(path, ScadFileFromFile.referencePath), seconds))
+        return "\n".join(ret)
+
+    def merge(self, other):
+        """Add the times measured by another PhaseProfiler (e.g. of a
+        worker process) to this one."""
+        for mine, others in ((self.phaseSeconds, other.phaseSeconds), (self.phaseCpuSeconds, other.phaseCpuSeconds), (self.phaseCalls, other.phaseCalls), (self.fileSeconds, other.fileSeconds)):
+            for key, value in others.items():
+                mine[key] = mine.get(key, 0) + value
+
+    def printTable(self):
+        print("PROFILE:\n" + txt_prefix_each_line(self.asTable(), "    "), file=sys.stderr)
+
+
+class RunMetrics():
+    """Counts what happened during a run (files, bytes, matches, lookups ...)
+    so the numbers can be written as json and graphed over time.
+
+    When not enabled, count() does not count anything."""
+
+    counterNames = [
+        "filesDiscovered",
+        "bytesRead",
+        "filesParsed",
+        "parseCacheHits",
+        "entitiesModules",
+        "entitiesFunctions",
+        "entitiesVariables",
+        "docsParsed",
+        "regexMatchesScanned",
+        "regexMatchesRejectedAsCommented",
+        "resolutionLookups",
+        "resolutionChecks",
+        "unresolvedDependencies",
+        "dummiesCreated",
+        "outputCacheHits",
+        "outputCacheMisses",
+        "outputBytes",
+        "outputsUnchanged",
+        "searchPathLookups",
+        "directoriesListed",
+        "docsAdopted"]
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        self.counters = collections.OrderedDict((name, 0) for name in RunMetrics.counterNames)
+        self.startWall = time.perf_counter()
+        self.startCpu = time.process_time()
+
+    def count(self, name, amount=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, other):
+        """Add the counters of another RunMetrics (e.g. of a worker
+        process) to this one."""
+        for name, amount in other.counters.items():
+            self.count(name, amount)
+
+    def asDict(self, command=None, phaseProfiler=None):
+        """Return the counters, the wall and cpu time of the run and
+        (if a PhaseProfiler is given) the wall and cpu time of each phase."""
+        ret = collections.OrderedDict()
+        ret["tool"] = "scadtool.py"
+        ret["version"] = VERSION
+        ret["command"] = command
+        ret["wallSeconds"] = time.perf_counter() - self.startWall
+        ret["cpuSeconds"] = time.process_time() - self.startCpu
+        ret["counters"] = self.counters
+        if phaseProfiler is not None:
+            phases = collections.OrderedDict()
+            for p in phaseProfiler.getPhases():
+                phases[p] = collections.OrderedDict([
+                    ("calls", phaseProfiler.phaseCalls.get(p, 0)),
+                    ("wallSeconds", phaseProfiler.phaseSeconds[p]),
+                    ("cpuSeconds", phaseProfiler.phaseCpuSeconds.get(p, 0.0))])
+            ret["phases"] = phases
+        return ret
+
+    def writeJson(self, path, command=None, phaseProfiler=None):
+        import json
+        with open(path, 'w') as f:
+            json.dump(self.asDict(command, phaseProfiler), f, indent=4)
+            f.write("\n")
+
+
+class MemoryProfiler():
+    """Measures with tracemalloc how much memory the steps of a run
+    (reading the library, resolution, emission) retain and which
+    structures of the read files the memory is held by.
+
+    measure() records the memory that is retained by the with-block and
+    the peak while it runs. asDict() breaks the memory that is held by the
+    files of a ScadFileRegistry down by structure and by file, and lists
+    the lines of code that allocated most of the memory still in use.
+    When not enabled, measure() does not measure anything and tracemalloc
+    is not started."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.steps = collections.OrderedDict()  # name -> {"calls", "retainedBytes", "peakBytes"}
+
+    def start(self):
+        if self.enabled:
+            import tracemalloc
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        """Account the memory allocated (and not freed) in the with-block
+        to the step 'name'. Steps must not be nested."""
+        if not self.enabled:
+            yield
+            return
+
+        import tracemalloc
+        before = tracemalloc.get_traced_memory()[0]
+        if hasattr(tracemalloc, "reset_peak"):  # python >= 3.9, otherwise the peak is the peak of the run so far
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            current, peak = tracemalloc.get_traced_memory()
+            step = self.steps.setdefault(name, collections.OrderedDict([("calls", 0), ("retainedBytes", 0), ("peakBytes", 0)]))
+            step["calls"] += 1
+            step["retainedBytes"] += current - before
+            step["peakBytes"] = max(step["peakBytes"], peak)
+
+    @staticmethod
+    def sizeOf(obj, seen, stopTypes=()):
+        """The size of obj and of the containers, strings, numbers and
+        objects it references, except for the referenced objects of
+        stopTypes and the objects in seen (the ids of the objects that are
+        already counted)."""
+        size = 0
+        root = obj
+        todo = [obj]
+        while todo:
+            obj = todo.pop()
+            if obj is None or id(obj) in seen or isinstance(obj, type) or (obj is not root and isinstance(obj, stopTypes)):
+                continue
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                todo.extend(obj.keys())
+                todo.extend(obj.values())
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                todo.extend(obj)
+            elif hasattr(obj, "__dict__"):
+                todo.append(obj.__dict__)
+        return size
+
+    @staticmethod
+    def structuresOfFiles(registry):
+        """How much memory each structure of each file in the registry
+        holds: path -> structure -> bytes.
+        The structures are the content of the file, the positions of the
+        comments and the entity content, the ScadDocs, the InScadFiles,
+        the bodies of the entities (their content, arguments or value),
+        the entity objects (with their dependencies) and the rest of the
+        ScadFileFromFile (references, statements, indexes ...)."""
+        seen = set()
+        stopTypes = (ScadType, ScadFileDummy, InScadFile, ScadDoc, PositionSpans, ScadFileRegistry, ScadFileReference)
+        ret = collections.OrderedDict()
+        for scadFile in registry.scadFiles.values():
+            structures = ret.setdefault(scadFile.path, collections.OrderedDict((structure, 0) for structure in MemoryProfiler.structureNames))
+            structures["ScadFileFromFile.content"] += MemoryProfiler.sizeOf(scadFile.content, seen)
+            structures["comment positions"] += MemoryProfiler.sizeOf(scadFile._commentPositions, seen)
+            structures["entity content positions"] += MemoryProfiler.sizeOf(scadFile._entityContentPositions, seen)
+
+            docs = [scadFile.metaData] + [entity.metaData for entity in scadFile.definedEntities]
+            structures["ScadDoc"] += sum(MemoryProfiler.sizeOf(doc, seen, stopTypes[:3]) for doc in docs if doc is not None)
+
+            inScadFiles = [entity.inScadFile for entity in scadFile.definedEntities] + [reference.inScadFile for reference in scadFile.referencedFiles]
+            inScadFiles += [doc.inScadFile for doc in docs if doc is not None]
+            structures["InScadFile"] += sum(MemoryProfiler.sizeOf(inScadFile, seen, (ScadType, ScadFileDummy)) for inScadFile in inScadFiles if inScadFile is not None)
+
+            for entity in scadFile.definedEntities:
+                bodies = [entity.__dict__.get(name) for name in ("_content", "arguments", "_value", "_numericValue")]
+                structures["entity bodies"] += sum(MemoryProfiler.sizeOf(body, seen) for body in bodies if body is not False)
+                structures["entity objects"] += MemoryProfiler.sizeOf(entity, seen, stopTypes)
+
+            structures["other ScadFileFromFile data"] += MemoryProfiler.sizeOf(scadFile, seen, stopTypes)
+        return ret
+
+    structureNames = ["ScadFileFromFile.content", "comment positions", "entity content positions", "ScadDoc", "InScadFile", "entity bodies", "entity objects", "other ScadFileFromFile data"]
+
+    def asDict(self, registry, top=10):
+        """The steps, the memory held by each structure of the files in
+        the registry, the (top) files holding the most memory and the
+        (top) lines of code that allocated the most of the memory in use."""
+        import tracemalloc
+        current, peak = tracemalloc.get_traced_memory()
+        structuresOfFiles = MemoryProfiler.structuresOfFiles(registry)
+
+        ret = collections.OrderedDict()
+        ret["tracedBytes"] = current
+        ret["peakBytes"] = max([peak] + [step["peakBytes"] for step in self.steps.values()])  # measure() resets the peak
+        ret["steps"] = self.steps
+        structures = collections.OrderedDict((structure, sum(fileStructures[structure] for fileStructures in structuresOfFiles.values())) for structure in MemoryProfiler.structureNames)
+        ret["structures"] = structures
+        ret["notInStructures"] = max(0, current - sum(structures.values()))
+        files = sorted(((path, sum(fileStructures.values()), fileStructures) for path, fileStructures in structuresOfFiles.items()), key=(lambda item: -item[1]))
+        ret["files"] = [collections.OrderedDict([("path", os.path.relpath(path, ScadFileFromFile.referencePath)), ("bytes", total), ("structures", fileStructures)]) for path, total, fileStructures in files[:top]]
+        statistics = tracemalloc.take_snapshot().statistics("lineno")
+        ret["allocationSites"] = [collections.OrderedDict([("site", "{}:{}".format(os.path.basename(statistic.traceback[0].filename), statistic.traceback[0].lineno)), ("bytes", statistic.size), ("blocks", statistic.count)]) for statistic in statistics[:top]]
+        return ret
+
+    @staticmethod
+    def asText(data):
+        """The report (see asDict()) as human readable tables."""
+        ret = ["traced: {} bytes, peak: {} bytes".format(data["tracedBytes"], data["peakBytes"]), ""]
+        ret.append("{:<32} {:>8} {:>14} {:>14}".format("STEP", "CALLS", "RETAINED BYTES", "PEAK BYTES"))
+        for name, step in data["steps"].items():
+            ret.append("{:<32} {:>8} {:>14} {:>14}".format(name, step["calls"], step["retainedBytes"], step["peakBytes"]))
+        ret.append("")
+        ret.append("{:<32} {:>14}".format("STRUCTURE", "BYTES"))
+        for structure, size in data["structures"].items():
+            ret.append("{:<32} {:>14}".format(structure, size))
+        ret.append("{:<32} {:>14}".format("(not in these structures)", data["notInStructures"]))
+        ret.append("")
+        ret.append("{:>14}  {}".format("BYTES", "LARGEST FILES"))
+        for entry in data["files"]:
+            ret.append("{:>14}  {}".format(entry["bytes"], entry["path"]))
+        ret.append("")
+        ret.append("{:>14} {:>10}  {}".format("BYTES", "BLOCKS", "ALLOCATED BY"))
+        for entry in data["allocationSites"]:
+            ret.append("{:>14} {:>10}  {}".format(entry["bytes"], entry["blocks"], entry["site"]))
+        return "\n".join(ret)
+
+    @staticmethod
+    def printReport(data):
+        print("MEMORY:\n" + txt_prefix_each_line(MemoryProfiler.asText(data), "    "), file=sys.stderr)
+
+    @staticmethod
+    def writeJson(path, data):
+        import json
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=4)
+            f.write("\n")
+
+
+# ####################### CONTEXT ########################
+
+
+class ScadToolContext():
+    """The settings and the state of a run:
+    How progress is reported and how output is written (the attributes
+    have the names of the command line options), the PhaseProfiler, the
+    RunMetrics, the MemoryProfiler and the ScadFileRegistry the files are
+    read through (with the library directories of lib_path, see
+    ScadSearchPath).
+
+    The library always uses the active context (see activate()). Without
+    activating one, a context with the default settings is used.
+    Applications that embed scadtool can create a context per request, or
+    keep one (and its registry) to reuse the files that were already read.
+    Only one context is active at a time: Don't share the module between
+    threads, use processes."""
+    def __init__(self, verbose=0, quiet=False, output=None, override=False, dont_override=False, write_if_changed=False, lib_path=(), profiler=None, metrics=None, registry=None, memory=None):
+        self.verbose = verbose  # printConsole() prints messages up to this level.
+        self.quiet = quiet  # printConsole() prints nothing.
+        self.output = output  # see determineOutFile()
+        self.override = override  # see outputHelper()
+        self.dont_override = dont_override
+        self.write_if_changed = write_if_changed
+        self.lib_path = list(lib_path or ())  # The library directories searched before OPENSCADPATH.
+        self.profiler = profiler if profiler is not None else PhaseProfiler()
+        self.metrics = metrics if metrics is not None else RunMetrics()
+        self.memory = memory if memory is not None else MemoryProfiler()
+        self._registry = registry
+
+    @staticmethod
+    def fromArgs(args):
+        """Create a context from the parsed command line arguments."""
+        return ScadToolContext(
+            verbose=args.verbose,
+            quiet=args.quiet,
+            output=getattr(args, "output", None),
+            override=getattr(args, "override", False),
+            dont_override=getattr(args, "dont_override", False),
+            write_if_changed=getattr(args, "write_if_changed", False),
+            lib_path=args.lib_path)
+
+    @property
+    def registry(self):
+        if self._registry is None:
+            self._registry = ScadFileRegistry(ScadSearchPath.fromEnvironment(self.lib_path))
+        return self._registry
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Make this the active context inside the with block."""
+        global context
+        previousContext = context
+        context = self
+        try:
+            yield self
+        finally:
+            context = previousContext
+
+
+context = ScadToolContext()  # The active context, see ScadToolContext.activate()
+
+
+def getActiveContext():
+    return context
+
+
+# ####################### OUTPUT CACHE ########################
+
+
+def hashFile(path):
+    """Get the sha256 hex digest of the content of the file at path."""
+    import hashlib
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class OutputCache():
+    """Stores generated outputs, so they can be reused without parsing
+    and resolving again.
+
+    The key (fingerprint) of an entry is made from the tool version, the
+    options and the hash of the input file. Each entry records the hashes
+    of the files that contributed to the output. An entry is only used if
+    all these files are unchanged.
+
+    Each entry is a json file in the cache directory. stats.json keeps the
+    hit/miss counts over all runs."""
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._fileHashes = dict()
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def hashFile(self, path):
+        """Like hashFile(), but each file is only hashed once by this cache."""
+        path = os.path.abspath(path)
+        if path not in self._fileHashes:
+            self._fileHashes[path] = hashFile(path)
+        return self._fileHashes[path]
+
+    @staticmethod
+    def fingerprint(*parts):
+        """Create a key from the given (json serializable) parts."""
+        import json
+        import hashlib
+        parts = [VERSION] + list(parts)
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+    def __entryPath(self, key):
+        return os.path.join(self.cacheDir, key + ".json")
+
+    def lookup(self, key):
+        """Get the cache entry (a dict with "output", "contributors" and
+        "assets") for the given key, or None if there is no entry or a
+        contributing file changed."""
+        import json
+        entry = None
+        if os.path.isfile(self.__entryPath(key)):
+            with open(self.__entryPath(key), 'r') as f:
+                entry = json.load(f)
+            for path, contentHash in entry["contributors"].items():
+                if not os.path.isfile(path) or self.hashFile(path) != contentHash:
+                    printConsole("INFO: CACHE: '{}' changed.".format(path), 2)
+                    entry = None
+                    break
+
+        if entry is None:
+            self.misses = self.misses + 1
+            context.metrics.count("outputCacheMisses")
+            return None
+        self.hits = self.hits + 1
+        context.metrics.count("outputCacheHits")
+        return entry
+
+    def store(self, key, output, contributorPaths, assetPaths=(), shards=None):
+        """Store the output together with the hashes of the files that
+        contributed to it and the assets (.stl, .dxf ...) that are imported
+        by its code (for --depfile) and the shards (path -> content) of a
+        sharded output."""
+        import json
+        entry = collections.OrderedDict()
+        entry["version"] = VERSION
+        entry["contributors"] = collections.OrderedDict((os.path.abspath(path), self.hashFile(path)) for path in contributorPaths)
+        entry["assets"] = list(assetPaths)
+        entry["output"] = output
+        if shards is not None:
+            entry["shards"] = shards
+        with open(self.__entryPath(key), 'w') as f:
+            json.dump(entry, f)
+        self.stores = self.stores + 1
+
+    def getStats(self):
+        """Get the numbers of this run and of all runs (stats.json is updated)."""
+        import json
+        statsPath = os.path.join(self.cacheDir, "stats.json")
+        total = {"hits": 0, "misses": 0}
+        if os.path.isfile(statsPath):
+            with open(statsPath, 'r') as f:
+                total.update(json.load(f))
+        total["hits"] = total["hits"] + self.hits
+        total["misses"] = total["misses"] + self.misses
+        with open(statsPath, 'w') as f:
+            json.dump(total, f)
+        self.hits = self.misses = 0  # they are part of the total now.
+
+        entries = [entry for entry in os.listdir(self.cacheDir) if entry.endswith(".json") and entry != "stats.json"]
+        size = sum(os.path.getsize(os.path.join(self.cacheDir, entry)) for entry in entries)
+        return {"entries": len(entries), "bytes": size, "totalHits": total["hits"], "totalMisses": total["misses"]}
+
+    def statsAsText(self):
+        runHits, runMisses, runStores = self.hits, self.misses, self.stores
+        stats = self.getStats()
+        return "\n".join([
+            "CACHE: '{}'".format(self.cacheDir),
+            "    this run:   {} hits, {} misses, {} stored".format(runHits, runMisses, runStores),
+            "    all runs:   {} hits, {} misses".format(stats["totalHits"], stats["totalMisses"]),
+            "    entries:    {} ({} bytes)".format(stats["entries"], stats["bytes"])])
 
 
 # ####################### re HELPERS/PATTERN ########################
 
 
-re_pattern_multilinecomment_info = re.compile(r"(?P<info>/\*\*.*?\*/)", re.MULTILINE + re.DOTALL)
+class LazyPattern():
+    """A regular expression that is compiled when it is used the first
+    time. (Most runs only need some of the patterns below, compiling all
+    of them on import slows down the start of every run.)
+    Behaves like the compiled pattern (re.Pattern)."""
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        self._compiled = None
 
-re_pattern_comment = re.compile(r"^.*?(?P<ignore>//.*)$", re.MULTILINE)  # Matches a single line comment
-re_pattern_multilinecomment = re.compile(r"(?P<ignore>/\*.*?\*/)", re.MULTILINE + re.DOTALL)  # Matches a multiline comment
+    def __getattr__(self, name):
+        """Only called for the attributes LazyPattern doesn't have."""
+        if "pattern" not in self.__dict__:  # not initialized (yet), e.g. while unpickling
+            raise AttributeError(name)
+        if self._compiled is None:
+            self._compiled = re.compile(self.pattern, self.flags)
+        return getattr(self._compiled, name)
 
-re_pattern_include = re.compile(r"include\s*\<(?P<includePath>.*?)\>", re.MULTILINE)
-re_pattern_use = re.compile(r"use\s*\<(?P<usePath>.*?)\>", re.MULTILINE)
 
-re_pattern_module_definition = re.compile(r"module\s+(?P<name>\w+)\s*\((?P<arguments>.*?)\).*?(?P<startBracket>\{)", re.MULTILINE + re.DOTALL)
-re_pattern_variable_definition = re.compile(r"(?P<name>\w+)\s*\=\s*(?P<value>.*?);", re.MULTILINE)
-re_pattern_function_definition = re.compile(r"function\s+(?P<name>\w+)\s*\((?P<arguments>.*?)\).*?\=\s*(?P<statememts>.*);", re.MULTILINE + re.DOTALL)
+re_pattern_multilinecomment_info = LazyPattern(r"(?P<info>/\*\*.*?\*/)", re.MULTILINE + re.DOTALL)
+
+re_pattern_comment = LazyPattern(r"(?P<ignore>//.*)")  # Matches a single line comment
+re_pattern_multilinecomment = LazyPattern(r"(?P<ignore>/\*.*?\*/)", re.MULTILINE + re.DOTALL)  # Matches a multiline comment
+re_pattern_comment_outside_string = LazyPattern(r'"(?:\\.|[^"\\])*"|(?P<ignore>//[^\n]*|/\*.*?\*/)', re.DOTALL)  # Matches a string or a comment, only comments have the group 'ignore'
+
+re_pattern_include = LazyPattern(r"include\s*\<(?P<includePath>.*?)\>", re.MULTILINE)
+re_pattern_use = LazyPattern(r"use\s*\<(?P<usePath>.*?)\>", re.MULTILINE)
+
+re_pattern_module_definition = LazyPattern(r"module\s+(?P<name>\w+)\s*\((?P<arguments>.*?)\).*?(?P<startBracket>\{)", re.MULTILINE + re.DOTALL)
+# The definitions of variables and functions are only matched up to the value.
+# Where the value ends is found by txt_get_statement_end_pos().
+re_pattern_variable_definition = LazyPattern(r"\b(?P<name>[A-Za-z_]\w*)\s*\=(?!=)\s*", re.MULTILINE)
+re_pattern_function_definition = LazyPattern(r"function\s+(?P<name>\w+)\s*\(", re.MULTILINE)
+re_pattern_function_assignment = LazyPattern(r"\s*\=\s*")
 
 
 def re_get_occupied_positions_set(inString, patternList, relevantMatchGroup=0):
@@ -114,17 +735,41 @@ def re_get_occupied_positions_set(inString, patternList, relevantMatchGroup=0):
     ret = list()
 
     for pattern in patternList:
-        matchIter = re.finditer(pattern, inString)
+        matchIter = pattern.finditer(inString)
         for match in matchIter:
             span = match.span(relevantMatchGroup)
             ret.extend(range(span[0], span[1]))
 
     return set(ret)
 
+
+def re_get_occupied_spans(inString, patternList, relevantMatchGroup=0):
+    """Like re_get_occupied_positions_set() but returns the positions as
+    PositionSpans."""
+    ret = PositionSpans()
+
+    for pattern in patternList:
+        for match in pattern.finditer(inString):
+            ret.add(*match.span(relevantMatchGroup))
+
+    return ret
+
+
+re_pattern_string_or_comment = LazyPattern(r'"(?:\\.|[^"\\])*"|//[^\n]*|/\*.*?\*/', re.DOTALL)
+re_pattern_identifier_usage = LazyPattern(r"(?<![\w.$])(?P<name>\$?[A-Za-z_]\w*)\s*(?:(?P<call>\()|(?P<assignment>=(?!=)))?")
+re_pattern_call_structure = LazyPattern(r"\[[^\[\](){};]*\]|\([^\[\](){};]*\)|[()\[\]{};]|(?<![=!<>])=(?!=)")  # what decides if a call is a module instantiation: brackets, statement ends and assignments. Brackets without brackets inside (like the [x,y,z] of a point) are skipped as a whole, like in re_pattern_statement_token.
+
+# A token of a statement for txt_get_statement_end_pos(): a run of text
+# without brackets, strings, comments and ';' (this includes brackets
+# that do not contain any of them, like the [x,y,z] of a point), a
+# string, a comment or a single character.
+re_pattern_statement_token = LazyPattern(r'(?:[^\[\](){};"/]|\[[^\[\](){};"/]*\]|\([^\[\](){};"/]*\))+|"(?:\\.|[^"\\])*"|//[^\n]*|/\*.*?\*/|.', re.DOTALL)
+re_pattern_argument_token = LazyPattern(r'(?:[^\[\](){};",/]|\[[^\[\](){};"/]*\]|\([^\[\](){};"/]*\))+|"(?:\\.|[^"\\])*"|//[^\n]*|/\*.*?\*/|.', re.DOTALL)  # like re_pattern_statement_token, but stops at each ','
+
 # ####################### TXT HELPERS ########################
 
 
-def txt_get_bracket_close_pos(inString, startPos, bracketOpenChar, bracketCloseChar, excludedPositions=list()):
+def txt_get_bracket_close_pos(inString, startPos, bracketOpenChar, bracketCloseChar, excludedPositions=frozenset()):
     """Find the position of the bracket that closes the section opened
     by the bracket at the given position."""
     if(inString[startPos] != bracketOpenChar):
@@ -148,6 +793,338 @@ def txt_get_bracket_close_pos(inString, startPos, bracketOpenChar, bracketCloseC
     raise ValueError("The given string does not have balanced brackets.")
 
 
+def txt_get_statement_end_pos(inString, startPos):
+    """Find the position of the ';' that ends the statement starting at
+    startPos, or the position of the closing bracket of the section the
+    statement is in ('(a=1, b=[2, 3])' ends at the last ')' if startPos
+    is after the first '(').
+    A ';' or bracket inside brackets, strings or comments does not end the
+    statement. Returns len(inString) if the statement is not ended.
+
+    Runs in linear time: Long runs of data (like the points of a
+    polyhedron) are skipped as a whole by re_pattern_statement_token."""
+    depth = 0
+    for match in re_pattern_statement_token.finditer(inString, startPos):
+        pos = match.start()
+        if match.end() - pos != 1:
+            continue
+        c = inString[pos]
+        if c in "([{":
+            depth = depth + 1
+        elif c in ")]}":
+            if depth == 0:
+                return pos
+            depth = depth - 1
+        elif c == ";" and depth == 0:
+            return pos
+    return len(inString)
+
+
+class PositionSpans():
+    """A set of positions in a text, stored as sorted, non overlapping
+    spans (start, end) instead of one entry per position.
+    (A set of positions would use several bytes per character of the
+    occupied text, which is a lot for files with megabytes of data.)"""
+    def __init__(self, spans=()):
+        self._starts = list()
+        self._ends = list()
+        for start, end in spans:
+            self.add(start, end)
+
+    def add(self, start, end):
+        """Add the positions range(start, end)."""
+        if start >= end:
+            return
+        first = bisect.bisect_left(self._ends, start)  # the first span that ends at or after start
+        last = bisect.bisect_right(self._starts, end)  # the spans before last start at or before end
+        if first < last:  # merge the overlapping and touching spans
+            start = min(start, self._starts[first])
+            end = max(end, self._ends[last - 1])
+        self._starts[first:last] = [start]
+        self._ends[first:last] = [end]
+
+    def overlaps(self, start, end):
+        """Is any of the positions range(start, end) in this set?"""
+        if start >= end:
+            return False
+        index = bisect.bisect_left(self._starts, end) - 1  # the last span that starts before end
+        return index >= 0 and self._ends[index] > start
+
+    def union(self, other):
+        ret = PositionSpans(self)
+        for start, end in other:
+            ret.add(start, end)
+        return ret
+
+    def gaps(self, length):
+        """The spans in range(0, length) that are not in this set."""
+        pos = 0
+        for start, end in self:
+            if start > pos:
+                yield (pos, min(start, length))
+            pos = max(pos, end)
+            if pos >= length:
+                return
+        if pos < length:
+            yield (pos, length)
+
+    def __contains__(self, pos):
+        return self.overlaps(pos, pos + 1)
+
+    def __iter__(self):
+        return zip(self._starts, self._ends)
+
+
+def txt_find_identifier_usages(code, moduleCalls=True):
+    """Find the identifiers that are used in the given piece of code.
+    Returns a tuple of three lists (without duplicates, in the order of
+    appearance): the names of the instantiated modules, the names of the
+    called functions and the names of the variables that are read.
+
+    A call is a module instantiation if it is a statement: it is not inside
+    '(' or '[' (like the arguments of a call or a list comprehension) and
+    not in the expression of an assignment ('x = f(1) * g(2);'). So
+    'translate(v) foo();', 'if (a) foo(); else bar();' and '%foo();'
+    instantiate modules. Otherwise it is a function call.
+    With moduleCalls=False (for the code of functions and variables, which
+    can't instantiate modules) every call is a function call.
+    Comments, strings, builtins (open_scad_builtins), assignments
+    (including named arguments) and the names of local module and function
+    definitions are ignored.
+
+    Runs in linear time: The brackets, ';' and '=' between two identifiers
+    are found with re_pattern_call_structure."""
+    code = re_pattern_string_or_comment.sub(" ", code)
+    modules = dict()
+    functions = dict()
+    variables = dict()
+    depth = 0  # the number of open '(' and '['
+    inExpression = False  # after the '=' of an assignment that is a statement
+    isDefinition = False  # the identifier is the name of a local module or function
+    scanned = 0
+    for match in re_pattern_identifier_usage.finditer(code):
+        for structure in re_pattern_call_structure.finditer(code, scanned, match.start()):
+            c = structure.group(0)
+            if len(c) > 1:  # a closed bracket
+                continue
+            if c in "([":
+                depth = depth + 1
+            elif c in ")]":
+                depth = max(0, depth - 1)
+            elif c == "=":
+                inExpression = inExpression or depth == 0
+            else:  # ';', '{' or '}' end the statement
+                depth = 0
+                inExpression = False
+        scanned = match.end("name")
+
+        name = match.group("name")
+        if isDefinition:
+            isDefinition = False
+            continue
+        if name in ("module", "function"):
+            isDefinition = True
+        if name in open_scad_builtins or match.group("assignment") is not None:
+            continue
+        if match.group("call") is None:
+            variables[name] = None
+        elif moduleCalls and depth == 0 and not inExpression:
+            modules[name] = None
+        else:
+            functions[name] = None
+    return (list(modules), list(functions), list(variables))
+
+
+re_pattern_imported_file = LazyPattern(r'\b(?:import|import_stl|import_dxf|import_off|surface)\s*\(\s*(?:file\s*=\s*)?"(?P<path>(?:\\.|[^"\\])*)"')
+
+
+def txt_find_imported_files(code):
+    """Find the files that are read by import(), import_stl(), import_dxf(),
+    import_off() and surface() in the given piece of code.
+    Returns a list of the paths as they are written in the code (without
+    duplicates, in the order of appearance). Commented imports are ignored."""
+    code = re_pattern_string_or_comment.sub(lambda match: match.group(0) if match.group(0).startswith('"') else " ", code)
+    return list(collections.OrderedDict.fromkeys(match.group("path") for match in re_pattern_imported_file.finditer(code)))
+
+
+re_pattern_numeric_vector_characters = LazyPattern(r"[\s\d.eE+\-,\[\]]*")
+re_pattern_redundant_decimal_zero = LazyPattern(r"\.0(?=[,\]])")  # the '.0' of '2.0' in a formatted vector
+re_pattern_numeric_vector_row_separator = LazyPattern(r"\]\s*,\s*\[")
+re_pattern_numeric_vector_assignment = LazyPattern(r"=(?!=)\s*(?P<startBracket>\[)")  # starts with '=', so it is searched fast
+re_pattern_assigned_name = LazyPattern(r"(?<![\w$])(?P<name>[A-Za-z_]\w*)\s*\Z")  # the name in front of an assignment
+re_pattern_polyhedron_call = LazyPattern(r"polyhedron\s*(?P<startBracket>\()")  # starts with the name, so it is searched fast
+re_pattern_argument = LazyPattern(r"\s*(?:(?P<name>\w+)\s*=(?!=))?\s*(?P<value>.*?)\s*$", re.DOTALL)
+re_pattern_numbered_backreference = LazyPattern(r"\\[1-9]|\(\?\(\d")  # \1 or (?(1)...) in a regex of a ScadNameMappingRules rule
+
+
+def txt_split_arguments(inString, startPos):
+    """Split the arguments of the call whose '(' is at startPos.
+    Returns a list of the spans (start, end) of the arguments or None if
+    the brackets are not closed."""
+    ret = list()
+    depth = 0
+    argumentStart = startPos + 1
+    for match in re_pattern_argument_token.finditer(inString, startPos + 1):
+        pos = match.start()
+        if match.end() - pos != 1:
+            continue
+        c = inString[pos]
+        if c in "([{":
+            depth = depth + 1
+        elif c in ")]}" and depth > 0:
+            depth = depth - 1
+        elif c == ")" or (c == "," and depth == 0):
+            ret.append((argumentStart, pos))
+            argumentStart = pos + 1
+            if c == ")":
+                return ret
+        elif c in "]};":
+            return None
+    return None
+
+
+def txt_compact_numeric_data(code, precision=None, dedupeVertices=False):
+    """Rewrite the vectors that only contain numbers (see
+    ScadNumericVector) and are assigned to a variable, an argument or a
+    function in their shortest form. Comments and strings are not changed.
+    precision: round the numbers to this number of decimal places.
+    dedupeVertices: remove the repeated points of polyhedrons and renumber
+        their faces. Only polyhedrons whose points and faces are literals
+        or variables that are assigned once and are not used elsewhere
+        are changed."""
+    ignoredPositions = re_get_occupied_spans(code, [re_pattern_string_or_comment])
+    vectors = dict()  # start position -> [end position, ScadNumericVector]
+    startOfName = dict()  # variable name -> start position of its value (None if assigned more than once)
+
+    def addVector(start):
+        """Parse the vector literal starting at start. Returns its end or None."""
+        end = txt_get_statement_end_pos(code, start + 1) + 1
+        if code[end - 1:end] != "]":
+            return None
+        vector = ScadNumericVector.fromText(code[start:end])
+        if vector is None:
+            return None
+        vectors[start] = [end, vector.rounded(precision)]
+        return end
+
+    pos = 0
+    while True:
+        match = re_pattern_numeric_vector_assignment.search(code, pos)
+        if match is None:
+            break
+        pos = match.end()
+        start = match.start("startBracket")
+        if code[match.start() - 1:match.start()] in ("=", "!", "<", ">") or ignoredPositions.overlaps(match.start(), pos):
+            continue
+        end = addVector(start)
+        if end is None:
+            continue
+        pos = end
+        nameMatch = re_pattern_assigned_name.search(code, max(0, match.start() - 100), match.start())
+        if nameMatch is not None:
+            name = nameMatch.group("name")
+            startOfName[name] = start if name not in startOfName else None
+
+    if dedupeVertices:
+        # Which points are used with which faces?
+        facesOfPoints = collections.OrderedDict()
+        pointsOfFaces = dict()
+        usedNames = collections.Counter()
+        for match in re_pattern_polyhedron_call.finditer(code):
+            if ignoredPositions.overlaps(*match.span()) or re.match(r"[\w$]", code[match.start() - 1:match.start()]):
+                continue
+            arguments = txt_split_arguments(code, match.start("startBracket"))
+            if arguments is None:
+                continue
+            starts = dict()
+            for index, (argumentStart, argumentEnd) in enumerate(arguments):
+                argument = re_pattern_argument.match(code, argumentStart, argumentEnd)
+                key = argument.group("name")
+                if key is None:
+                    key = ("points", "faces")[index] if index < 2 else None
+                elif key == "triangles":  # the old name of faces
+                    key = "faces"
+                if key not in ("points", "faces"):
+                    continue
+                value = argument.group("value")
+                if value.startswith("["):
+                    valueStart = argument.start("value")
+                    if valueStart not in vectors:
+                        addVector(valueStart)
+                    starts[key] = valueStart if valueStart in vectors else None
+                else:
+                    starts[key] = startOfName.get(value)
+                    usedNames[value] += 1
+            if starts.get("points") is None or starts.get("faces") is None:
+                continue
+            facesOfPoints.setdefault(starts["points"], set()).add(starts["faces"])
+            pointsOfFaces.setdefault(starts["faces"], set()).add(starts["points"])
+
+        # A variable that is used somewhere else would not fit anymore.
+        for name, count in usedNames.items():
+            usages = 0
+            for match in re.finditer(re.escape(name) + r"(?!\w)", code):  # starts with the name, so it is searched fast
+                if not ignoredPositions.overlaps(*match.span()) and not re.match(r"[\w$]", code[match.start() - 1:match.start()]):
+                    usages = usages + 1
+            if usages != count + 1:  # the uses in polyhedron() and the assignment
+                facesOfPoints.pop(startOfName.get(name), None)
+                pointsOfFaces.pop(startOfName.get(name), None)
+
+        for pointsStart, facesStarts in facesOfPoints.items():
+            if any(pointsOfFaces.get(facesStart) != set([pointsStart]) for facesStart in facesStarts):
+                continue  # the faces are used with other points (or elsewhere).
+            deduped = vectors[pointsStart][1].dedupedRows()
+            if deduped is None:
+                continue
+            points, newIndexOfRow = deduped
+            faces = [vectors[facesStart][1].renumbered(newIndexOfRow) for facesStart in facesStarts]
+            if None in faces:
+                continue
+            context.metrics.count("verticesDeduplicated", vectors[pointsStart][1].rowCount() - points.rowCount())
+            vectors[pointsStart][1] = points
+            for facesStart, newFaces in zip(facesStarts, faces):
+                vectors[facesStart][1] = newFaces
+
+    pieces = list()
+    pos = 0
+    for start in sorted(vectors):
+        end, vector = vectors[start]
+        pieces.append(code[pos:start])
+        pieces.append(vector.asScad())
+        pos = end
+    pieces.append(code[pos:])
+    context.metrics.count("numericVectorsCompacted", len(vectors))
+    return "".join(pieces)
+
+
+re_pattern_minify_gap = LazyPattern(r'(?P<keep>"(?:\\.|[^"\\])*"|\b(?:include|use)\s*<[^>\n]*>)|(?:\s|//[^\n]*|/\*.*?\*/)+', re.DOTALL)  # strings and references are kept, whitespace and comments are a gap
+re_pattern_word_character = LazyPattern(r"[\w$.]")
+minify_operator_characters = frozenset("<>=!&|+-*/%?:")
+
+
+def txt_minify(code):
+    """Remove the comments and the whitespace that is not needed from the
+    given code. A gap (whitespace and comments) becomes a single space
+    where it separates two words ('module foo') or two operators
+    ('a - -b'), and is removed otherwise. Strings and the paths in
+    include/use statements are not changed, the statements stay on a line
+    of their own."""
+    def replaceGap(match):
+        keep = match.group("keep")
+        if keep is not None:
+            return keep if keep.startswith('"') else keep + "\n"
+        before = code[match.start() - 1:match.start()]
+        after = code[match.end():match.end() + 1]
+        if before == "" or after == "":
+            return ""
+        if re_pattern_word_character.match(before) and re_pattern_word_character.match(after):
+            return " "
+        if before in minify_operator_characters and after in minify_operator_characters:
+            return " "
+        return ""
+    return re_pattern_minify_gap.sub(replaceGap, code)
+
+
 def txt_text_to_comment(string="", isInfoComment=True):
     """Make the given string a beautiful comment."""
 
@@ -284,10 +1261,12 @@ def txt_prefix_each_line(string, prefix, ignorefirst=False, ignorelast=False):
 
 # ####################### CLASSES ########################
 class ScadDoc():
-    """
-    :TODO: Implement the new tags and behaviour:
+    """The documentation of a file or an entity: a list of @TAG VALUE
+    tags (the text before the first tag is the description).
+
+    Adopting the tags of another entity:
 "@adopt ENTITYNAME"
-    copy the tags from the given module, except for the -dependency, param and return tags.
+    copy the tags from the given entity, except for the -dependency, param and return tags.
 "@adopt-all ENTITYNAME"
     like adopt but with -dependency, param and return tags.
 "@adopt-behavior {replace, append, prepend} (default: replace)"
@@ -317,9 +1296,19 @@ class ScadDoc():
             @author-remove -> (no @author)
             @tag-list-remove oranges, bananas -> @tag-list apples
 
-            @author xyz abc -> ??? (behavior depends on @adopt-behavior, default is replace)
-            @tag-list grapes, pineapple -> ??? (behavior depends on @adopt-behavior, default is replace)
-            @tag-list apples   grapes, pineapple -> ??? (behavior depends on @adopt-behavior, default is replace)
+            @author xyz abc -> (behavior depends on @adopt-behavior, default is replace)
+
+    The entity is looked up by name in the files of the ScadFileRegistry
+    (see ScadDocAdoptions.findSource()). The tags of several @adopt tags
+    are appended in order. Dictionary tags (e.g. @param) are replaced as a
+    whole, -append/-prepend add entries (replacing the ones with the same
+    key), -remove KEY[, KEY ...] removes entries. A @filename is never
+    adopted.
+
+    The adoptions are resolved on first access of the tags (see
+    ScadDocAdoptions.resolve()): The @adopt tags and the operators are
+    replaced by the resulting tags, so they are resolved once and the
+    output contains the adopted tags.
     """
     commonDictionaryTags = frozenset([])
     fileDictionaryTags = frozenset(["variable-dependency", "module-dependency", "function-dependency"] + list(commonDictionaryTags))
@@ -339,9 +1328,17 @@ class ScadDoc():
     functionOfficialTags = commonOfficialTags + ["variable-dependency", "function-dependency", "param", "return"]
     variableOfficialTags = commonOfficialTags + ["variable-dependency", "function-dependency"]
 
+    adoptionTags = frozenset(["adopt", "adopt-all", "adopt-behavior"])
+    adoptionBehaviors = ("replace", "append", "prepend")
+    tagOperators = ("replace", "append", "prepend", "remove")
+
     def __init__(self, text, scadType=None, inScadFile=None):
-        self.__rawMetaDataTupelList = ScadDoc.__metadataListFromText(text)
-        self._metaData = dict()
+        # The text is parsed on first access (see _metaData), most of the
+        # docs in a library are never looked at.
+        self.__text = text
+        self.__rawMetaDataTupelListCache = None
+        self.__metaDataCache = None
+        self.__adoptionsResolved = None  # False if there are @adopt tags that were not resolved yet.
 
         self.inScadFile = inScadFile
 
@@ -353,6 +1350,24 @@ class ScadDoc():
         else:
             self.makeTypeSpecific(scadType)
 
+    @property
+    def __rawMetaDataTupelList(self):
+        if self.__rawMetaDataTupelListCache is None:
+            with context.profiler.phase("metadata"):
+                self.__rawMetaDataTupelListCache = ScadDoc.__metadataListFromText(self.__text)
+                self.__adoptionsResolved = not any(tag in ("adopt", "adopt-all") for tag, value in self.__rawMetaDataTupelListCache)
+            context.metrics.count("docsParsed")
+        return self.__rawMetaDataTupelListCache
+
+    @property
+    def _metaData(self):
+        if self.__metaDataCache is None:
+            with context.profiler.phase("metadata"):
+                if self.type is not None and not self.isAdoptionResolved():  # the type is set once the entity is known
+                    context.registry.adoptions.resolve(self)
+                self.__metaDataCache = self.__buildDicts()
+        return self.__metaDataCache
+
     def getList(self, tag):
         if tag in self._metaData.keys():
             if self.isDict(tag):
@@ -401,7 +1416,7 @@ class ScadDoc():
 
     def add(self, key, value):
         self.__rawMetaDataTupelList.append((key, value))
-        self.__reBuildDicts()
+        self.__metaDataCache = None
 
     def set(self, key, value):
         toRemove = list()
@@ -424,11 +1439,10 @@ class ScadDoc():
         key = "description"
         current = []
         state = READ_VALUE
-        hadNewline = True
-        used = "\n"
+        atLineStart = True  # only spaces and tabs since the last newline
         for c in string:
             if state == READ_VALUE:
-                if c != '@' or not used.rstrip(" \t").endswith("\n"):
+                if c != '@' or not atLineStart:
                     current.append(c)
                 else:
                     val = ("".join(current)).lstrip().rstrip()
@@ -437,50 +1451,173 @@ class ScadDoc():
                     key = None
                     state = READ_KEY
             if state == READ_KEY:
-                if c != ':' and c != ' ':
+                if c != ':' and not c.isspace():
                     current.append(c)
-                else:
+                else:  # a tag without a value (like '@author-remove') ends at the end of the line
                     key = ("".join(current)).lstrip().rstrip()[1:]
                     current = []
                     state = READ_VALUE
 
-            used = used + c
+            if c == "\n":
+                atLineStart = True
+            elif c != " " and c != "\t":
+                atLineStart = False
 
+        if state == READ_KEY:  # the last tag has no value
+            key = ("".join(current)).lstrip().rstrip()[1:]
+            current = []
         val = ("".join(current)).lstrip().rstrip()
         ret.append((key, val))
         return ret
 
-    def __reBuildDicts(self):
-        self._metaData = dict()
-
-        for line in self.__rawMetaDataTupelList:
+    @staticmethod
+    def __groupValues(tupelList, keepEmpty=False):
+        """Group the values of the (tag, value) tuples by tag."""
+        ret = collections.OrderedDict()
+        for line in tupelList:
             tag = line[0].strip()
             value = line[1].strip()
-            if value != "":
-                if self.has(tag):
-                    self._metaData[tag].append(value)
+            if value != "" or keepEmpty:
+                ret.setdefault(tag, []).append(value)
+        return ret
+
+    def __buildDicts(self):
+        ret = dict()
+        for tag, valueList in ScadDoc.__groupValues(self.__rawMetaDataTupelList).items():
+            ret[tag] = self.__structureValues(tag, valueList)
+        return ret
+
+    def __structureValues(self, tag, valueList):
+        """The values of a dictionary tag as a dict, the ones of a list tag
+        as a list of the items, the others as they are."""
+        ret = valueList
+        if self.isDict(tag):
+            insDict = dict()
+            for value in valueList:
+                # TODO: Allow quoting.
+                value = str(value).split(sep=None, maxsplit=1)
+                value[0] = value[0].strip()
+                if len(value) > 1:
+                    value[1] = value[1].strip()
                 else:
-                    self._metaData[tag] = [value]
-        for tag, valueList in self._metaData.items():
-            if self.isDict(tag):
-                insDict = dict()
-                for value in valueList:
-                    # TODO: Allow quoting.
-                    value = str(value).split(sep=None, maxsplit=1)
-                    value[0] = value[0].strip()
-                    if len(value) > 1:
-                        value[1] = value[1].strip()
-                    else:
-                        value.append("")
+                    value.append("")
+
+                insDict[value[0]] = value[1]
+            ret = insDict
+        if self.isList(tag):
+            insList = list()
+            for value in valueList:
+                value = value.split(",")
+                insList.extend(value)
+            ret = insList
+        return ret
+
+    def __unstructureValues(self, tag, structure):
+        """The values (as written after @tag) of the result of __structureValues()."""
+        if self.isList(tag):
+            return [",".join(structure)] if structure else []
+        if self.isDict(tag):
+            return [(key + " " + description) if description != "" else key for key, description in structure.items()]
+        return list(structure)
+
+    # adoption, see ScadDocAdoptions
+    @staticmethod
+    def fromTags(tags, scadType=None, inScadFile=None):
+        """Create a ScadDoc with the given (tag, value) tuples (the
+        description is the "description" tag), without a text to parse."""
+        ret = ScadDoc("", scadType, inScadFile)
+        ret.__rawMetaDataTupelListCache = list(tags)
+        ret.__adoptionsResolved = not any(tag in ("adopt", "adopt-all") for tag, value in ret.__rawMetaDataTupelListCache)
+        return ret
 
-                    insDict[value[0]] = value[1]
-                self._metaData[tag] = insDict
-            if self.isList(tag):
-                insList = list()
-                for value in valueList:
-                    value = value.split(",")
-                    insList.extend(value)
-                self._metaData[tag] = insList
+    def isAdoptionResolved(self):
+        """False if the doc has @adopt tags that were not resolved yet."""
+        self.__rawMetaDataTupelList  # parsing it sets __adoptionsResolved
+        return self.__adoptionsResolved
+
+    def getAdoptions(self):
+        """Get (entity name, adopt all) for the @adopt and @adopt-all tags."""
+        ret = list()
+        for tag, value in self.__rawMetaDataTupelList:
+            if tag in ("adopt", "adopt-all") and value.strip() != "":
+                ret.append((value.split()[0], tag == "adopt-all"))
+        return ret
+
+    def getAdoptionBehavior(self):
+        behavior = "replace"
+        for tag, value in self.__rawMetaDataTupelList:
+            if tag == "adopt-behavior" and value.strip() != "":
+                behavior = value.strip()
+        if behavior not in ScadDoc.adoptionBehaviors:
+            raise ValueError("@adopt-behavior must be one of {} but is '{}'.".format(", ".join(ScadDoc.adoptionBehaviors), behavior))
+        return behavior
+
+    def _adopt(self, sources):
+        """Replace the tags by the tags adopted from sources (a list of
+        (ScadDoc, adopt all)) with the tags of this doc applied to them.
+        The sources need to be resolved already."""
+        behavior = self.getAdoptionBehavior()
+        tags = collections.OrderedDict()  # tag -> structured values
+        for source, adoptAll in sources:
+            for tag, valueList in ScadDoc.__groupValues(source.__rawMetaDataTupelList).items():
+                if tag == "filename" or (not adoptAll and (tag in ("param", "return") or tag.endswith("-dependency"))):
+                    continue
+                self.__applyTagOperator(tags, tag, "append", valueList)
+
+        for tag, valueList in ScadDoc.__groupValues(self.__rawMetaDataTupelList, keepEmpty=True).items():
+            if tag in ScadDoc.adoptionTags:
+                continue
+            operator = behavior
+            for tagOperator in ScadDoc.tagOperators:
+                if tag.endswith("-" + tagOperator):
+                    tag, operator = tag[:-len(tagOperator) - 1], tagOperator
+                    break
+            self.__applyTagOperator(tags, tag, operator, valueList)
+
+        self.__rawMetaDataTupelListCache = [(tag, value) for tag, structure in tags.items() for value in self.__unstructureValues(tag, structure)]
+        self.__metaDataCache = None
+        self.__adoptionsResolved = True
+
+    def __applyTagOperator(self, tags, tag, operator, valueList):
+        """Apply '@tag-operator value' for each value of valueList to the
+        structured values in tags."""
+        valueList = [value for value in valueList if value != ""]
+        old = tags.get(tag)
+        if operator == "remove":
+            if old is None:
+                return
+            if not valueList:
+                del tags[tag]
+                return
+            removed = set(item.strip() for value in valueList for item in value.replace(",", " ").split())
+            if isinstance(old, dict):
+                new = dict((key, description) for key, description in old.items() if key not in removed)
+            else:
+                new = [item for item in old if item.strip() not in removed]
+            if new:
+                tags[tag] = new
+            else:
+                del tags[tag]
+            return
+        if not valueList:
+            return
+
+        if old is not None and operator == "replace" and self.isList(tag) and len(valueList) == 1:
+            itemAndValue = valueList[0].split(None, 1)  # "@tag-list-replace ITEM_TO_REPLACE VALUE[, VALUE, ...]"
+            oldItems = [item.strip() for item in old]
+            if len(itemAndValue) == 2 and "," not in itemAndValue[0] and itemAndValue[0] in oldItems:
+                index = oldItems.index(itemAndValue[0])
+                tags[tag] = old[:index] + self.__structureValues(tag, [itemAndValue[1]]) + old[index + 1:]
+                return
+
+        new = self.__structureValues(tag, valueList)
+        if old is None or operator == "replace":
+            tags[tag] = new
+        elif isinstance(old, dict):
+            kept = [(key, description) for key, description in old.items() if key not in new]
+            tags[tag] = dict(kept + list(new.items()) if operator == "append" else list(new.items()) + kept)
+        else:
+            tags[tag] = old + new if operator == "append" else new + old
 
     def makeTypeSpecific(self, scadType):
         if not issubclass(scadType, ScadType):
@@ -500,35 +1637,35 @@ class ScadDoc():
         self.officialTags = ScadDoc.fileOfficialTags
         self.listTags = ScadDoc.fileListTags
         self.dictionaryTags = ScadDoc.fileDictionaryTags
-        self.__reBuildDicts()
+        self.__metaDataCache = None
 
     def makeModuleDoc(self):
         self.type = ScadModule
         self.officialTags = ScadDoc.moduleOfficialTags
         self.listTags = ScadDoc.moduleListTags
         self.dictionaryTags = ScadDoc.moduleDictionaryTags
-        self.__reBuildDicts()
+        self.__metaDataCache = None
 
     def makeFunctionDoc(self):
         self.type = ScadFunction
         self.officialTags = ScadDoc.functionOfficialTags
         self.listTags = ScadDoc.functionListTags
         self.dictionaryTags = ScadDoc.functionDictionaryTags
-        self.__reBuildDicts()
+        self.__metaDataCache = None
 
     def makeVariableDoc(self):
         self.type = ScadVariable
         self.officialTags = ScadDoc.variableOfficialTags
         self.listTags = ScadDoc.variableListTags
         self.dictionaryTags = ScadDoc.variableDictionaryTags
-        self.__reBuildDicts()
+        self.__metaDataCache = None
 
     def makeUniversalDoc(self):
         self.type = None
         self.officialTags = ScadDoc.commonOfficialTags
         self.listTags = ScadDoc.commonListTags
         self.dictionaryTags = ScadDoc.commonDictionaryTags
-        self.__reBuildDicts()
+        self.__metaDataCache = None
 
     def getDependencies(self):
         ret = list()
@@ -609,8 +1746,10 @@ class ScadEntityDependency():
             raise TypeError("scadEntityType must inherit from ScadEntity. But type is '{}'".format(type))
         self.scadEntityType = scadEntityType
         self.resolution = None
+        self.isInferred = False  # True if found in the code instead of a -dependency tag.
 
-    def findResolution(self, fileList=list()):
+    def findResolution(self, fileList=()):
+        context.metrics.count("resolutionLookups")
         self.resolution = None
         for scadFile in fileList:
             printConsole("Looking for a resolution for '{}' in '{}'".format(repr(self), repr(scadFile)), 2)
@@ -626,6 +1765,7 @@ class ScadEntityDependency():
         return self.resolution is not None
 
     def getDummyResolution(self):
+        context.metrics.count("dummiesCreated")
         meta = ScadDoc("@description !!!!! DUMMY ENTITY !!!!!\n" + self.description, scadType=self.scadEntityType)
         ret = self.scadEntityType(name=self.name, metaData=meta)
         ret.isDummy = True
@@ -649,7 +1789,19 @@ class ScadType():
     :TODO: Use abc to make this actually abstract"""
     def __init__(self, metaData):
         self.metaData = metaData
-        self.entityDependencies = metaData.getDependencies()
+        self._entityDependencies = None
+
+    @property
+    def entityDependencies(self):
+        """The dependencies defined by the -dependency tags. They are read
+        from the metadata on first access."""
+        if getattr(self, "_entityDependencies", None) is None:
+            self._entityDependencies = self.metaData.getDependencies()
+        return self._entityDependencies
+
+    @entityDependencies.setter
+    def entityDependencies(self, entityDependencies):
+        self._entityDependencies = entityDependencies
 
 #    def __getTypeDependencies(self, entityType):
 #        return list(filter(lambda entityDependency: entityDependency.scadEntityType is entityType, self.entityDependencies))
@@ -671,8 +1823,20 @@ class ScadType():
         return list(filter(lambda entityDependency: entityDependency.scadEntityType is ScadVariable, self.entityDependencies))
 #        return self.__getTypeDependencies(ScadVariable)
 
-    def getDependencies(self):
-        return self.entityDependencies
+    def getDependencies(self, inferDependencies=None):
+        """Get the dependencies of this entity/file.
+        inferDependencies: (None) only the dependencies defined by the
+            -dependency tags. ("merge") the tagged dependencies and the
+            ones found in the code (getCallSiteDependencies()).
+            ("only") only the dependencies found in the code."""
+        if not inferDependencies:
+            return self.entityDependencies
+        if inferDependencies == "only":
+            return self.getCallSiteDependencies()
+        if inferDependencies != "merge":
+            raise ValueError("inferDependencies must be None, 'merge' or 'only' but is '{}'.".format(inferDependencies))
+        tagged = set((dependency.scadEntityType, dependency.name) for dependency in self.entityDependencies)
+        return self.entityDependencies + [dependency for dependency in self.getCallSiteDependencies() if (dependency.scadEntityType, dependency.name) not in tagged]
 
     def getDependenciesDeep(self):
         ret = list(self.entityDependencies)
@@ -680,15 +1844,67 @@ class ScadType():
             ret.append(entityDependency.getDependenciesDeep())
         return ret
 
-    def getDependencyTreeAndUnresolvedDependencies(self, fileList):
+    def getCode(self):
+        """Return the code that may use other entities.
+        (Implemented by ScadFile, ScadModule, ScadFunction and ScadVariable)"""
+        return ""
+
+    def _getIdentifierUsages(self):
+        """Get the result of txt_find_identifier_usages() for the code."""
+        return self._findIdentifierUsages()
+
+    def _findIdentifierUsages(self):
+        """Scan the code with txt_find_identifier_usages().
+        (Overridden by ScadFunction and ScadVariable)"""
+        return txt_find_identifier_usages(self.getCode())
+
+    def _getCodeDirectory(self):
+        """The directory relative paths in the code are relative to, or None.
+        (Implemented by ScadEntity and ScadFileFromFile)"""
+        return None
+
+    def getImportedAssets(self):
+        """Get the absolute paths of the files (.stl, .dxf ...) that are
+        imported in the code (see txt_find_imported_files)."""
+        directory = self._getCodeDirectory()
+        if directory is None:
+            return list()
+        return [os.path.normpath(os.path.join(directory, path)) for path in txt_find_imported_files(self.getCode())]
+
+    def getCallSiteDependencies(self):
+        """Get the dependencies that are detected by looking at the
+        identifiers used in the code (see txt_find_identifier_usages).
+        These dependencies are marked with isInferred."""
+        modules, functions, variables = self._getIdentifierUsages()
+        ret = list()
+        for names, scadEntityType in ((modules, ScadModule), (functions, ScadFunction), (variables, ScadVariable)):
+            for name in names:
+                dependency = ScadEntityDependency(name, "Found in the code.", scadEntityType)
+                dependency.isInferred = True
+                ret.append(dependency)
+        return ret
+
+    def getDependencyTreeAndUnresolvedDependencies(self, fileList, inferDependencies=None, _ancestors=frozenset()):
+        """Resolve the dependencies of this entity/file (and the
+        dependencies of the resolutions) with the entities in fileList.
+        Returns a tuple of the dependencyTree and a list of the
+        dependencies that could not be resolved.
+
+        Inferred dependencies on variables without a resolution are
+        dropped, as these usually are local variables or parameters."""
         dependencyTree = dict()
         unresolvedDependencies = list()
-        for dependency in self.getDependencies():
+        _ancestors = _ancestors.union([id(self)])
+        for dependency in self.getDependencies(inferDependencies):
             fileWithResolution = dependency.findResolution(fileList)
             if dependency.hasResolution():
                 resolution = dependency.getResolution()
-                dependencyTree[resolution], unres = resolution.getDependencyTreeAndUnresolvedDependencies([fileWithResolution] + fileList)
+                if id(resolution) in _ancestors:  # recursion, the resolution already is in the tree
+                    continue
+                dependencyTree[resolution], unres = resolution.getDependencyTreeAndUnresolvedDependencies([fileWithResolution] + fileList, inferDependencies, _ancestors)
                 unresolvedDependencies.extend(unres)
+            elif dependency.isInferred and dependency.scadEntityType is ScadVariable:
+                continue
             else:
                 #  raise RuntimeError("No resolution for '{}' found.".format(repr(dependency)))
                 unresolvedDependencies.append(dependency)
@@ -705,12 +1921,30 @@ class ScadEntity(ScadType):
         ScadModule, ScadFunction, ScadVariable
     :TODO: Use abc to make this actually abstract"""
 
-    def __init__(self, name, metaData, inScadFile=None):
-        ScadType.__init__(self, metaData)
+    def __init__(self, name, metaData=None, inScadFile=None):
+        ScadType.__init__(self, metaData if metaData is not None else ScadDoc(""))
         self.name = name
         self.inScadFile = inScadFile
         self.isDummy = False
 
+    def _getIdentifierUsages(self):
+        """Use the call site index of the file this entity is defined in."""
+        if self.inScadFile is not None and isinstance(self.inScadFile.scadFile, ScadFileFromFile):
+            index = self.inScadFile.scadFile.getCallSiteIndex()
+            if id(self) in index:
+                return index[id(self)]
+        return ScadType._getIdentifierUsages(self)
+
+    def _getTextOfSpan(self, span):
+        """Get the text at span (start, end) in the file this entity is
+        defined in."""
+        return self.inScadFile.scadFile.content[span[0]:span[1]]
+
+    def _getCodeDirectory(self):
+        if self.inScadFile is not None and isinstance(self.inScadFile.scadFile, ScadFileFromFile):
+            return self.inScadFile.scadFile._getCodeDirectory()
+        return None
+
     def isResolution(self, dependency):
         if not isinstance(dependency, ScadEntityDependency):
             raise TypeError("dependency needs to be of type 'ScadEntityDependency' but is '{}'".format(type(dependency)))
@@ -752,10 +1986,12 @@ class ScadEntity(ScadType):
 
 class ScadFileDummy(ScadType):
     """fakes an ScadFile to provide ScadFile Functions for non recursive ScadFiles"""
-    def __init__(self, targetPath):
+    def __init__(self, targetPath, printablePath=None):
+        """printablePath: how the path is written (e.g. in use <...>),
+        default: relative to ScadFileFromFile.referencePath."""
         if targetPath == "":
             raise ValueError("The purpose of ScadFileDummy is to store a path, so it must not be None or empty.")
-        self._printablePath = os.path.relpath(targetPath, ScadFileFromFile.referencePath)
+        self._printablePath = printablePath if printablePath is not None else os.path.relpath(targetPath, ScadFileFromFile.referencePath)
 
     def __repr__(self):
         return """ScadFileDummy['{self._printablePath}']""".format(self=self)
@@ -769,10 +2005,10 @@ class ScadFileDummy(ScadType):
 class ScadFile(ScadFileDummy):
     """represents a .scad file."""
 
-    def __init__(self, metaData=ScadDoc(""), definedEntities=list(), referencedFiles=list(), statements="", recursive=False):
-        self.metaData = metaData
-        self.definedEntities = definedEntities
-        self.referencedFiles = referencedFiles
+    def __init__(self, metaData=None, definedEntities=None, referencedFiles=None, statements="", recursive=False):
+        self.metaData = metaData if metaData is not None else ScadDoc("")
+        self.definedEntities = definedEntities if definedEntities is not None else list()
+        self.referencedFiles = referencedFiles if referencedFiles is not None else list()
         self.statements = statements
         self.recursive = recursive
 
@@ -780,6 +2016,7 @@ class ScadFile(ScadFileDummy):
         """Look for a resolution for the given dependency in this file
         and in the files that are referenced in this file."""
         for entity in self.getAvailableEntities():
+            context.metrics.count("resolutionChecks")
             printConsole("Checking if '{ent}' is resolved by '{res}'".format(ent=repr(scadEntityDependency), res=repr(entity)), 2)
             if entity.isResolution(scadEntityDependency):
                 return entity
@@ -791,6 +2028,9 @@ class ScadFile(ScadFileDummy):
     def getStatements(self):
         return self.statements
 
+    def getCode(self):
+        return self.getStatements()
+
     def setStatements(self, statements):
         self.statements = statements
 
@@ -835,6 +2075,26 @@ class ScadFile(ScadFileDummy):
         """get all the files that are used (ScadUseFileReference) in THIS file."""
         return list(filter(lambda reference: isinstance(reference, ScadUseFileReference), self.getReferencedFiles()))
 
+    def getReferencedFilesDeep(self):
+        """If recursive, get all the files (ScadFileFromFile) that are
+        directly or indirectly referenced in this file, depth-first in the
+        order of the references. Each file only once, even if the
+        references form a cycle. The files are loaded when needed."""
+        if not self.recursive:
+            return list()
+        ret = list()
+        seenPaths = set([getattr(self, "path", None)])
+        todo = [reference.toScadFile for reference in reversed(self.referencedFiles)]
+        while todo:
+            scadFile = todo.pop()
+            if not isinstance(scadFile, ScadFileFromFile) or scadFile.path in seenPaths:
+                continue
+            seenPaths.add(scadFile.path)
+            ret.append(scadFile)
+            if scadFile.recursive:
+                todo.extend(reference.toScadFile for reference in reversed(scadFile.referencedFiles))
+        return ret
+
 # Recursion functions that only collect data from the references.
     def _getEntitiesFromReferences(self):
         """If recursive, get all the entities (ScadEntity) that are
@@ -842,16 +2102,16 @@ class ScadFile(ScadFileDummy):
         if not self.recursive:
             raise RuntimeError("Not recursive. In order to find more than defined Entities, this instance needs to be recursive!")
         ret = list()
-        for scadFileReference in self.getReferencedFiles():
-            ret.extend(scadFileReference.toScadFile.getAvailableEntities())
+        for scadFile in self.getReferencedFilesDeep():
+            ret.extend(scadFile.getDefinedEntities())
         return ret
 
     def _getReferencedFilesFromReferences(self):
         if not self.recursive:
             raise RuntimeError("Not recursive. In order to find more than references defined in this file, this instance needs to be recursive!")
         ret = list()
-        for scadFileReference in self.getReferencedFiles():
-            ret.extend(scadFileReference.toScadFile.getAvailableReferences())
+        for scadFile in self.getReferencedFilesDeep():
+            ret.extend(scadFile.getReferencedFiles())
         return ret
 
 # Recursion functions that combine data from references with data from this instance.
@@ -884,8 +2144,46 @@ class ScadFile(ScadFileDummy):
     def getAvailableUsedFiles(self):
         return list(filter(lambda reference: isinstance(reference, ScadUseFileReference), self.getAvailableReferences()))
 
+    def getReachableEntities(self, followCallSites=True):
+        """Get the available entities that are needed by this file:
+        Start with the dependencies of the file and (if followCallSites)
+        the entities used in its statements and follow the dependencies
+        of the entities found.
+
+        Returns a list in dependency order: each entity comes after the
+        entities it depends on. Dependencies without a resolution are
+        ignored."""
+        availableEntities = dict()  # first definition wins, like in getDependencyResolution()
+        for entity in self.getAvailableEntities():
+            availableEntities.setdefault((type(entity), entity.name), entity)
+
+        def neededEntities(scadType):
+            ret = list()
+            for dependency in scadType.getDependencies("merge" if followCallSites else None):
+                entity = availableEntities.get((dependency.scadEntityType, dependency.name))
+                if entity is not None:
+                    ret.append(entity)
+            return ret
+
+        ret = list()
+        visited = set()
+        # depth first search, an entity is added after all its dependencies.
+        stack = [(None, iter(neededEntities(self)))]
+        while stack:
+            entity, todo = stack[-1]
+            for dependency in todo:
+                if id(dependency) not in visited:
+                    visited.add(id(dependency))
+                    stack.append((dependency, iter(neededEntities(dependency))))
+                    break
+            else:
+                stack.pop()
+                if entity is not None:
+                    ret.append(entity)
+        return ret
+
 # Output Functions
-    def asScad(self, recursive=False, excludeList=list(), dummiesFirst=False):
+    def asScad(self, recursive=False, excludeList=(), dummiesFirst=False):
         """Return the content of this File built from the data in this file.
         Not the content (which is the difference from asDump()).
         """
@@ -946,32 +2244,53 @@ class ScadFileFromFile(ScadFile):
     referencePath = os.path.curdir
 
     @staticmethod
-    def buildFromFile(path, recursive, referencedFromScadFile=None):
+    def buildFromFile(path, recursive, referencedFromScadFile=None, registry=None):
         """helper function to instanciate an ScadFile instance from a file.
-        recursive: (True) instanciate all the referenced files (False) Store filenames.
-        referencedFromScadFile: To be used when recursively created from another file."""
-        with open(path, 'r') as f:
-            return ScadFileFromFile(content=f.read(), path=path, referencedFromScadFile=referencedFromScadFile, recursive=recursive)
+        recursive: (True) instanciate all the referenced files (when they are needed) (False) Store filenames.
+        referencedFromScadFile: To be used when recursively created from another file.
+        registry: the ScadFileRegistry the referenced files are loaded
+            through (default: the registry of the active ScadToolContext).
+        (Use ScadFileRegistry.getScadFile() to read each file only once.)"""
+        with context.profiler.phase("read", os.path.abspath(path)):
+            with open(path, 'r') as f:
+                context.metrics.count("bytesRead", os.fstat(f.fileno()).st_size)
+                content = f.read()
+        with context.profiler.phase("parse", os.path.abspath(path)):
+            ret = ScadFileFromFile(content=content, path=path, referencedFromScadFile=referencedFromScadFile, recursive=recursive, registry=registry)
+        context.metrics.count("filesParsed")
+        context.metrics.count("entitiesModules", len(ret.getDefinedModules()))
+        context.metrics.count("entitiesFunctions", len(ret.getDefinedFunctions()))
+        context.metrics.count("entitiesVariables", len(ret.getDefinedVariables()))
+        return ret
 
     @staticmethod
     def buildListFromDirectory(dirName, recursive, traverseSub):
         """helper function to instanciate an ScadFile instance from a file.
         recursive: (True) instanciate all the referenced files (False) Store filenames.
         (don't set recursive unless you exactly know that you need this.)"""
+        ret = list()
+        for entry in ScadLibrary.findSourceFiles([dirName], traverseSub):
+            ret.append(context.registry.getScadFile(entry, recursive=recursive))
+        return ret
+
+    @staticmethod
+    def findFilesInDirectory(dirName, traverseSub):
+        """Get the paths of all the .scad files in the given directory
+        (and its sub directories if traverseSub is set) in the order
+        buildListFromDirectory() builds them."""
         from os import listdir
         ret = list()
-        files = list()
 
         for entry in listdir(dirName):
             entry = (dirName + os.path.sep + entry)
             if os.path.isdir(entry):
                 if traverseSub:
-                    ret.extend(ScadFileFromFile.buildListFromDirectory(entry, recursive=recursive, traverseSub=traverseSub))
+                    ret.extend(ScadFileFromFile.findFilesInDirectory(entry, traverseSub=traverseSub))
             elif entry.endswith(".scad"):
-                ret.append(ScadFileFromFile.buildFromFile(entry, recursive=recursive, referencedFromScadFile=None))
+                ret.append(entry)
         return ret
 
-    def __init__(self, path, content="", recursive=False, referencedFromScadFile=None, metaData=None):
+    def __init__(self, path, content="", recursive=False, referencedFromScadFile=None, metaData=None, registry=None):
         """path must not be emty because we need to write something to the metadata."""
         self.content = content  # The Text.
 
@@ -981,36 +2300,40 @@ class ScadFileFromFile(ScadFile):
         self.referencedFromScadFile = referencedFromScadFile  # The reference (if any) to another file. (A ScadFileReference insatance)
 
         self.recursive = recursive  # Are we looking for information in the files referenced in this file?
+        self.registry = registry if registry is not None else context.registry  # The referenced files are loaded through this ScadFileRegistry.
 
-        self.__positionLineRangesList = ScadFileFromFile.__txt_getPositionLineRangesList(self.content)  # in which line is the given position?
+        self._callSiteIndex = None  # see getCallSiteIndex()
+
+        self.__lineStartPositions = None  # in which line is the given position? (see _getLineAndPositionInLine())
 
         # Where are the comments in this file?
-        self._commentPositions = frozenset(re_get_occupied_positions_set(self.content, [re_pattern_comment, re_pattern_multilinecomment], "ignore"))
+        self._commentPositions = re_get_occupied_spans(self.content, [re_pattern_comment_outside_string], "ignore")
 
         self.metaData = metaData
 
-        # Extract all the metadata from all comments.
-        unusedMetaData = list()
-        for infoComment, inScadFile in self.__extractInfoComments_inScadFile():  # The raw texts from the info comments
-            metaData = ScadDoc(infoComment, inScadFile=inScadFile)
-            unusedMetaData.append(metaData)
-
-        # Find meta data for this file.
-        for metaData in unusedMetaData:  # find the meta data for this file
-            if metaData.has("filename"):
-                if metaData.getFirst("filename") == os.path.basename(self.path):
-                    metaData.makeFileDoc()
-                    ScadType.__init__(self, metaData)
-                    unusedMetaData.remove(metaData)
+        with context.profiler.phase("metadata"):
+            # Extract all the metadata from all comments.
+            unusedMetaData = list()
+            for infoComment, inScadFile in self.__extractInfoComments_inScadFile():  # The raw texts from the info comments
+                metaData = ScadDoc(infoComment, inScadFile=inScadFile)
+                unusedMetaData.append(metaData)
+
+            # Find meta data for this file.
+            for metaData in unusedMetaData:  # find the meta data for this file
+                if "@filename" in self.content[metaData.inScadFile.startPosition:metaData.inScadFile.endPosition] and metaData.has("filename"):
+                    if metaData.getFirst("filename") == os.path.basename(self.path):
+                        metaData.makeFileDoc()
+                        ScadType.__init__(self, metaData)
+                        unusedMetaData.remove(metaData)
 
-        self.metaDataIsAutoGenerated = False
+            self.metaDataIsAutoGenerated = False
 
-        if self.metaData is None:  # We did not find any metadata.
-            ScadType.__init__(self, ScadDoc("@filename " + os.path.basename(self.path)))
-            self.metaDataIsAutoGenerated = True
-            self.metaData.makeFileDoc()
+            if self.metaData is None:  # We did not find any metadata.
+                ScadType.__init__(self, ScadDoc("@filename " + os.path.basename(self.path)))
+                self.metaDataIsAutoGenerated = True
+                self.metaData.makeFileDoc()
 
-        self._entityContentPositions = list()  # The positions that are occupied by entity content.
+        self._entityContentPositions = PositionSpans()  # The positions that are occupied by entity content.
 
         # find references
         self.referencedFiles = list()
@@ -1018,37 +2341,46 @@ class ScadFileFromFile(ScadFile):
         # find included files
         matchesList = ScadFileFromFile.__getFilteredMatches(self.content, re_pattern_include, relevantGroup=0, forbiddenPositions=self._commentPositions)
         for match in matchesList:
-            self._entityContentPositions.extend(range(match.start(), match.end() + 1))
+            self._entityContentPositions.add(match.start(), match.end() + 1)
             targetPath = match.group("includePath")
             reference = ScadIncludeFileReference(InScadFile(scadFile=self, referencePosition=match.start(), startPosition=match.start(), endPosition=match.end()))
-            targetPath = os.path.dirname(self.path) + os.path.sep + targetPath
+            targetPath = self.registry.searchPath.resolve(os.path.dirname(self.path), targetPath)
 
-            if self.recursive:
-                referenceScadFile = ScadFileFromFile.buildFromFile(path=targetPath, recursive=self.recursive, referencedFromScadFile=reference)
-            else:
-                referenceScadFile = ScadFileDummy(targetPath=targetPath)
-
-            reference.setTarget(referenceScadFile)
+            reference.setLazyTarget(targetPath, recursive=self.recursive, registry=self.registry)
             self.referencedFiles.append(reference)
 
         # find used files
         matchesList = ScadFileFromFile.__getFilteredMatches(self.content, re_pattern_use, relevantGroup=0, forbiddenPositions=self._commentPositions)
         for match in matchesList:
-            self._entityContentPositions.extend(range(match.start(), match.end() + 1))
+            self._entityContentPositions.add(match.start(), match.end() + 1)
             targetPath = match.group("usePath")
             reference = ScadUseFileReference(InScadFile(scadFile=self, referencePosition=match.start(), startPosition=match.start(), endPosition=match.end()))
-            targetPath = os.path.dirname(self.path) + os.path.sep + targetPath
-
-            if self.recursive:
-                referenceScadFile = ScadFileFromFile.buildFromFile(path=targetPath, recursive=self.recursive, referencedFromScadFile=reference)
-            else:
-                referenceScadFile = ScadFileDummy(targetPath=targetPath)
+            targetPath = self.registry.searchPath.resolve(os.path.dirname(self.path), targetPath)
 
-            reference.setTarget(referenceScadFile)
+            reference.setLazyTarget(targetPath, recursive=self.recursive, registry=self.registry)
             self.referencedFiles.append(reference)
 
         self.definedEntities = list()
 
+        # The entities only get the span of their doc comment, body and
+        # value. These are parsed and sliced when they are accessed.
+        unusedMetaDataEnds = [metaData.inScadFile.endPosition for metaData in unusedMetaData]  # sorted, as the comments are found in order.
+
+        def takeMetaDataEndingBefore(position, allowTouching=False, gapEnd=None):
+            """The doc comment that ends right before position (only
+            whitespace in between), or None."""
+            if allowTouching:
+                index = bisect.bisect_right(unusedMetaDataEnds, position) - 1
+            else:
+                index = bisect.bisect_left(unusedMetaDataEnds, position) - 1
+            if index < 0 or unusedMetaData[index] is None:
+                return None
+            if self.content[unusedMetaDataEnds[index]:position if gapEnd is None else gapEnd].strip() != "":
+                return None
+            metaData = unusedMetaData[index]
+            unusedMetaData[index] = None
+            return metaData
+
         # find defined MODULES
         matchesList = ScadFileFromFile.__getFilteredMatches(self.content, re_pattern_module_definition, relevantGroup=0, forbiddenPositions=self._commentPositions)
         for match in matchesList:
@@ -1058,85 +2390,109 @@ class ScadFileFromFile(ScadFile):
             startPos = match.start()
             endPos = txt_get_bracket_close_pos(self.content, startBracketPos, '{', '}', self._commentPositions)
             commentStart = startPos
-            self._entityContentPositions.extend(range(match.start(), endPos + 1))
+            self._entityContentPositions.add(match.start(), endPos + 1)
 
-            entityContent = self.content[startBracketPos + 1:endPos]
-
-            meta = ScadDoc("")
-            for metaData in unusedMetaData:  # find the meta data for the current module
-                if metaData.inScadFile.endPosition < startPos:
-                    if self.content[metaData.inScadFile.endPosition:startPos].strip() == "":
-                        meta = metaData
-                        commentStart = metaData.inScadFile.startPosition
-                        unusedMetaData.remove(metaData)
+            with context.profiler.phase("metadata"):
+                meta = takeMetaDataEndingBefore(startPos)  # find the meta data for the current module
+                if meta is None:
+                    meta = ScadDoc("")
+                else:
+                    commentStart = meta.inScadFile.startPosition
 
-            meta.makeModuleDoc()
-            scadModule = ScadModule(name, arguments, entityContent, meta, InScadFile(self, referencePosition=match.start(), startPosition=commentStart, endPosition=endPos + 1))
+                meta.makeModuleDoc()
+            scadModule = ScadModule(name, arguments, None, meta, InScadFile(self, referencePosition=match.start(), startPosition=commentStart, endPosition=endPos + 1), contentSpan=(startBracketPos + 1, endPos))
             self.definedEntities.append(scadModule)
 
         # find defined FUNCTIONS
-        matchesList = ScadFileFromFile.__getFilteredMatches(self.content, re_pattern_function_definition, relevantGroup=0, forbiddenPositions=(self._commentPositions.union(set(self._entityContentPositions))))
-        for match in matchesList:
+        # The search goes on after the end of each definition, so the
+        # body of a function is not scanned for further definitions.
+        forbiddenPositions = self._commentPositions.union(self._entityContentPositions)
+        searchPos = 0
+        while True:
+            match = ScadFileFromFile.__searchFilteredMatch(self.content, re_pattern_function_definition, searchPos, forbiddenPositions)
+            if match is None:
+                break
+            searchPos = match.end()
+            argumentsEnd = txt_get_statement_end_pos(self.content, match.end())
+            assignment = re_pattern_function_assignment.match(self.content, argumentsEnd + 1)
+            if self.content[argumentsEnd:argumentsEnd + 1] != ")" or assignment is None:
+                continue
+            endPos = txt_get_statement_end_pos(self.content, assignment.end())
+            if self.content[endPos:endPos + 1] != ";":
+                continue
+            definitionEnd = searchPos = endPos + 1
 
             name = match.group("name")
-            arguments = match.group("arguments")
+            arguments = self.content[match.end():argumentsEnd]
             startPos = match.start()
-            statememts = match.group("statememts")
             commentStart = match.start()
 
-            self._entityContentPositions.extend(range(match.start(), match.end()))
+            self._entityContentPositions.add(match.start(), definitionEnd)
 
-            meta = ScadDoc("")
-            for metaData in unusedMetaData:  # find the meta data for the current function
-                if metaData.inScadFile.endPosition < startPos:
-                    if self.content[metaData.inScadFile.endPosition:startPos].strip() == "":
-                        meta = metaData
-                        commentStart = metaData.inScadFile.startPosition
-                        unusedMetaData.remove(metaData)
+            with context.profiler.phase("metadata"):
+                meta = takeMetaDataEndingBefore(startPos)  # find the meta data for the current function
+                if meta is None:
+                    meta = ScadDoc("")
+                else:
+                    commentStart = meta.inScadFile.startPosition
 
-            meta.makeFunctionDoc()
-            scadFunction = ScadFunction(name, arguments, statememts, meta, InScadFile(self, referencePosition=match.start(), startPosition=commentStart, endPosition=match.end()))
+                meta.makeFunctionDoc()
+            scadFunction = ScadFunction(name, arguments, None, meta, InScadFile(self, referencePosition=match.start(), startPosition=commentStart, endPosition=definitionEnd), contentSpan=(assignment.end(), endPos))
             self.definedEntities.append(scadFunction)
 
         # find defined VARIABLES
-        matchesList = ScadFileFromFile.__getFilteredMatches(self.content, re_pattern_variable_definition, relevantGroup=0, forbiddenPositions=(self._commentPositions.union(set(self._entityContentPositions))))
-        for match in matchesList:
+        # Like for functions, the values are not scanned for further
+        # definitions. (Values like the points of a polyhedron can be huge.)
+        forbiddenPositions = self._commentPositions.union(self._entityContentPositions)
+        searchPos = 0
+        while True:
+            match = ScadFileFromFile.__searchFilteredMatch(self.content, re_pattern_variable_definition, searchPos, forbiddenPositions)
+            if match is None:
+                break
+            searchPos = match.end()
+            endPos = txt_get_statement_end_pos(self.content, match.end())
+            if self.content[endPos:endPos + 1] != ";" or self._entityContentPositions.overlaps(match.start(), endPos):
+                continue  # not a statement of its own, like the 'i = [0:3]' of 'for (i = [0:3]) ...'
+            definitionEnd = searchPos = endPos + 1
+
             name = match.group("name")
-            value = match.group("value")
             namePos = match.start("name")
             commentStart = match.start()
 
-            self._entityContentPositions.extend(range(match.start(), match.end()))
+            self._entityContentPositions.add(match.start(), definitionEnd)
 
-            meta = ScadDoc("")
-            for metaData in unusedMetaData:  # find the meta data for the current variable
-                if metaData.inScadFile.endPosition <= namePos:
-                    if self.content[metaData.inScadFile.endPosition:namePos - 1].strip() == "":
-                        meta = metaData
-                        commentStart = metaData.inScadFile.startPosition
-                        unusedMetaData.remove(metaData)
+            with context.profiler.phase("metadata"):
+                meta = takeMetaDataEndingBefore(namePos, allowTouching=True, gapEnd=namePos - 1)  # find the meta data for the current variable
+                if meta is None:
+                    meta = ScadDoc("")
+                else:
+                    commentStart = meta.inScadFile.startPosition
 
-            meta.makeVariableDoc()
-            scadVariable = ScadVariable(name, value, meta, InScadFile(self, referencePosition=match.start(), startPosition=commentStart, endPosition=match.end()))
+                meta.makeVariableDoc()
+            scadVariable = ScadVariable(name, None, meta, InScadFile(self, referencePosition=match.start(), startPosition=commentStart, endPosition=definitionEnd), valueSpan=(match.end(), endPos))
 
             self.definedEntities.append(scadVariable)
 
-            usedPositions = (self._commentPositions.union(set(self._entityContentPositions)))
-            pos = 0
-            self.statements = []
-            for c in self.content:
-                if pos not in usedPositions:
-                    self.statements.append(c)
-                pos = pos + 1
-            self.statements = "".join(self.statements)
-            self.statements = "\n".join(filter(lambda line: line.strip() != "", self.statements.splitlines()))
+        self._statements = None  # see getStatements(), computed on first access.
+
+    def getStatements(self):
+        """The statements are what is left when the comments, references
+        and entity definitions are removed."""
+        if self._statements is None:
+            usedPositions = self._commentPositions.union(self._entityContentPositions)
+            statements = "".join(self.content[start:end] for start, end in usedPositions.gaps(len(self.content)))
+            self._statements = "\n".join(filter(lambda line: line.strip() != "", statements.splitlines()))
+        return self._statements
+
+    def setStatements(self, statements):
+        self._statements = statements
 
     def __extractInfoComments_inScadFile(self):
         """return all the comments that store parsable information.
         returns a tupel of the raw text, the start position and the
         end position in content."""
         ret = list()
-        matchIter = re.finditer(re_pattern_multilinecomment_info, self.content)
+        matchIter = re_pattern_multilinecomment_info.finditer(self.content)
         for match in matchIter:
             span = match.span("info")
             raw = self.content[span[0]:span[1]]
@@ -1144,79 +2500,146 @@ class ScadFileFromFile(ScadFile):
             ret.append((cleaned, InScadFile(self, referencePosition=span[0], startPosition=span[0], endPosition=span[1])))
         return ret
 
+    def _getCodeDirectory(self):
+        return os.path.dirname(self.path)
+
+    def getCallSiteIndex(self):
+        """Get the identifiers used by the statements of this file (key None)
+        and by each defined entity (key id(entity)), as returned by
+        txt_find_identifier_usages().
+        The index is built on first use and kept with the parsed file."""
+        if self._callSiteIndex is None:
+            index = dict()
+            index[None] = txt_find_identifier_usages(self.getCode())
+            for entity in self.definedEntities:
+                index[id(entity)] = entity._findIdentifierUsages()
+            self._callSiteIndex = index
+        return self._callSiteIndex
+
+    def _getIdentifierUsages(self):
+        return self.getCallSiteIndex()[None]
+
     def _getLineAndPositionInLine(self, position):
         """get a dictionary with information about line and position in
         line for the given position in the content string.
         :note: line_num and line_pos start with 1."""
-        line_num = 1
-        for posRange in self.__positionLineRangesList:
-            if position in posRange:
-                return {"position": position, "line_num": line_num, "line_pos": position - posRange[0] + 1}
-            line_num = line_num + 1
-        return None
+        if position < 0 or position >= len(self.content):
+            return None
+        if self.__lineStartPositions is None:
+            self.__lineStartPositions = ScadFileFromFile.__txt_getLineStartPositions(self.content)
+        line_num = bisect.bisect_right(self.__lineStartPositions, position)
+        return {"position": position, "line_num": line_num, "line_pos": position - self.__lineStartPositions[line_num - 1] + 1}
 
     @staticmethod
-    def __txt_getPositionLineRangesList(string):
+    def __txt_getLineStartPositions(string):
         """returns the data for _getLineAndPositionInLine()
 
-        Get a list with an item for each line in the given string.
-        Each item is a range that covers the positions the line given
-        line.
+        Get a sorted list with the position of the first character of
+        each line in the given string.
 
         Example:
-            >>> __txt_getPositionLineRangesList('foo\nbar')
-            [range(0, 4), range(4, 7)]
+            >>> __txt_getLineStartPositions('foo\nbar')
+            [0, 4]
         """
-        lines = str(string).splitlines(True)
         ret = list()
         pos = 0
-        for line in lines:
-            newPos = pos + len(line)
-            ret.append(range(pos, newPos))
-            pos = newPos
+        for line in str(string).splitlines(True):
+            ret.append(pos)
+            pos = pos + len(line)
         return ret
 
     @staticmethod
-    def __getFilteredMatches(content, pattern, relevantGroup=0, forbiddenPositions=set()):
+    def __getFilteredMatches(content, pattern, relevantGroup=0, forbiddenPositions=None):
         """find all the matches for pattern in the given string.
         only return those that do not have positions in common with the
-        set of forbiddenPositions.
+        PositionSpans forbiddenPositions.
 
         'Hey there is an entitiy definition!' - 'oh but it's commented!'"""
-        ret = list()
-        matchList = list(re.finditer(pattern, content))
-        matchList = filter(lambda match: set(range(*match.span(relevantGroup))).isdisjoint(forbiddenPositions), matchList)  # filter matches in ignored sections
-        return matchList
+        if forbiddenPositions is None:
+            forbiddenPositions = PositionSpans()
+        matchList = list(pattern.finditer(content))
+        ret = list(filter(lambda match: not forbiddenPositions.overlaps(*match.span(relevantGroup)), matchList))  # filter matches in ignored sections
+        context.metrics.count("regexMatchesScanned", len(matchList))
+        context.metrics.count("regexMatchesRejectedAsCommented", len(matchList) - len(ret))
+        return ret
+
+    @staticmethod
+    def __searchFilteredMatch(content, pattern, pos, forbiddenPositions):
+        """Like __getFilteredMatches() but only returns the first match
+        at or after pos (or None)."""
+        match = pattern.search(content, pos)
+        while match is not None:
+            context.metrics.count("regexMatchesScanned")
+            if not forbiddenPositions.overlaps(*match.span()):
+                return match
+            context.metrics.count("regexMatchesRejectedAsCommented")
+            match = pattern.search(content, match.end())
+        return None
 
     def asDump(self, recursive=False):
         """Returns the content of this file.
-        If recursive copies the content of included files and the
-        modules from used files."""
+        If recursive copies the content of included and used files
+        (and the files referenced there) into the lines that reference
+        them.
+
+        Each file is copied only once, even if it is reached through
+        several references. A file that is included/used a second time
+        only defines what is already defined, so the later references
+        are kept as comments. The include graph is walked once and the
+        output is produced in a single pass over the lines."""
 
         if not recursive:
             return self.content
 
-        ret = self.content.splitlines()
-        todo = list()
-        for referenced in self.referencedFiles:
-            dump = referenced.toScadFile.asDump()
-            line_num = referenced.inScadFile.line_num
-            todo.append((line_num, dump))
-
-        # Sort reverse so we add lines from the bottom to the top.
-        # This way line numbers dont change.
-        todo = sorted(todo, key=(lambda tpl: tpl[0]), reverse=True)
-
-        for line_num, dump in todo:
-            line_num = line_num - 1  # because line numbers in editors start wit 1 but indices with 0
-            insert = "// ------ INCLUDED/USED ------" + "\n"
-            insert = insert + "//" + ret[line_num] + "\n"
-            insert = insert + "// ---------------------------" + "\n"
-            insert = insert + txt_prefix_each_line(dump, "    ") + "\n"
-            insert = insert + "// ---------------------------" + "\n"
-            ret[line_num] = insert
-
-        return "\n".join(ret)
+        return "\n".join(self._iterRecursiveDumpLines())
+
+    def _iterRecursiveDumpLines(self):
+        """Yield the lines of the recursive dump of this file.
+
+        Every file on the way is represented by a frame on a stack
+        (instead of recursion), so each line is passed through exactly
+        once, no matter how deep the references are nested."""
+        copiedPaths = set([self.path])
+        stack = [(self.__iterDumpItems(), "")]
+        while stack:
+            items, prefix = stack[-1]
+            for item in items:
+                if not isinstance(item, ScadFileReference):
+                    yield prefix + item
+                    continue
+
+                target = item.getTarget(load=item.inScadFile.scadFile.recursive)
+                if not isinstance(target, ScadFileFromFile):
+                    yield prefix + "    // (not loaded, the file was not read recursively)"
+                elif target.path in copiedPaths:
+                    yield prefix + "    // (already copied above, each file is only copied once)"
+                else:
+                    copiedPaths.add(target.path)
+                    stack.append((target.__iterDumpItems(), prefix + "    "))
+                    break  # continue with the referenced file
+            else:
+                stack.pop()
+
+    def __iterDumpItems(self):
+        """Yield the lines of this file. A line that references other
+        files is replaced by a block for each reference, with the
+        reference itself (ScadFileReference) as placeholder for the
+        copied content."""
+        referencesByLine = dict()
+        for reference in sorted(self.referencedFiles, key=(lambda reference: reference.inScadFile.referencePosition)):
+            referencesByLine.setdefault(reference.inScadFile.line_num, []).append(reference)
+
+        for line_num, line in enumerate(self.content.splitlines(), 1):
+            if line_num not in referencesByLine:
+                yield line
+                continue
+            for reference in referencesByLine[line_num]:
+                yield "// ------ INCLUDED/USED ------"
+                yield "//" + line
+                yield "// ---------------------------"
+                yield reference
+                yield "// ---------------------------"
+                yield ""
 
     def asCompilationDump(self, entities):
         """Create a dump that contains the given entities.
@@ -1224,68 +2647,85 @@ class ScadFileFromFile(ScadFile):
         are defined by this reference.
         Entities that are not part of a reference will be put right behind
         the file comment."""
-        ret = self.content.splitlines()
+        lines = self.content.splitlines()
 
         # In which of the references (if any) were the entities defined?
-        linenum_insertString = list()
-        for referencedFile in self.referencedFiles:
-            line_num = referencedFile.inScadFile.line_num
-            dump = ""
-            toRemove = list()
-            for entity in entities:
-                if entity.inScadFile is not None and entity in referencedFile.inScadFile.scadFile.getAvailableEntities():
-                    toRemove.append(entity)
-                    dump = dump + entity.asScad() + "\n\n"
-
-            for r in toRemove:
-                entities.remove(r)
-
-            line_num = line_num - 1  # because line numbers in editors start wit 1 but indices with 0
-            insert = "// ---------- RESOLVED DEPENDENCIES FROM ----------" + "\n"
-            insert = insert + "//" + ret[line_num] + "\n"
-            insert = insert + "// ------------------------------------------------" + "\n"
-            insert = insert + "// (Note that each entity is only copied here once." + "\n"
-            insert = insert + "// If it is needed earlier, it is not in this block.)" + "\n"
-            insert = insert + "// ------------------------------------------------" + "\n"
-            insert = insert + txt_prefix_each_line(dump, "    ") + "\n"
-            insert = insert + "// ------------------------------------------------" + "\n"
-
-            linenum_insertString.append((line_num, insert))
-
-        # The entities that were not found in any references:
-        dump = ""
+        referenceOfFile = self._getReferenceOfFileDict()
+        entitiesOfReference = dict()
+        unreferencedEntities = list()
+        copiedEntities = set()
         for entity in entities:
-            dump = dump + entity.asScad() + "\n\n"
-
-        # put these entities right after the file comment
-        line_num = self._getLineAndPositionInLine(self.metaData.inScadFile.endPosition)["line_num"] - 1
-
-        insert = ret[line_num] + "\n\n"
-        insert = insert + "// ------ AUTOMATICALLY RESOLVED DEPENDENCIES ------" + "\n\n"
-        insert = insert + txt_prefix_each_line(dump, "    ") + "\n"
-        insert = insert + "// -------------------------------------------------" + "\n"
-
-        linenum_insertString.append((line_num, insert))
-
-        # replace the the original file comment wit the current.
-        newFileComment = self.metaData.asScad()
-        oldFileCommentStart = self._getLineAndPositionInLine(self.metaData.inScadFile.startPosition)["line_num"] - 1
-        linenum_insertString.append((line_num, newFileComment))
-        oldFileCommentEnd = self._getLineAndPositionInLine(self.metaData.inScadFile.endPosition)["line_num"]
-        for pos in range(oldFileCommentStart, oldFileCommentEnd):
-            linenum_insertString.append((pos, None))
-
-        # Sort reverse so we add lines from the bottom to the top.
-        # This way line numbers dont change.
-        linenum_insertString = sorted(linenum_insertString, key=(lambda tpl: tpl[0]), reverse=True)
-
-        for line_num, insert in linenum_insertString:
-            ret[line_num] = insert
+            if entity in copiedEntities:  # each entity is only copied once
+                continue
+            copiedEntities.add(entity)
+            reference = None
+            if entity.inScadFile is not None:
+                reference = referenceOfFile.get(entity.inScadFile.scadFile.path)
+            if reference is None:
+                unreferencedEntities.append(entity)
+            else:
+                entitiesOfReference.setdefault(reference, []).append(entity)
+
+        insertsOfLine = dict()  # line index -> lines that replace the line
+        for reference in self.referencedFiles:
+            line_num = reference.inScadFile.line_num - 1  # because line numbers in editors start wit 1 but indices with 0
+            dump = "".join(entity.asScad() + "\n\n" for entity in entitiesOfReference.get(reference, []))
+
+            insert = insertsOfLine.setdefault(line_num, [])
+            insert.append("// ---------- RESOLVED DEPENDENCIES FROM ----------")
+            insert.append("//" + lines[line_num])
+            insert.append("// ------------------------------------------------")
+            insert.append("// (Note that each entity is only copied here once.")
+            insert.append("// If it is needed earlier, it is not in this block.)")
+            insert.append("// ------------------------------------------------")
+            insert.append(txt_prefix_each_line(dump, "    "))
+            insert.append("// ------------------------------------------------")
+            insert.append("")
+
+        # The entities that were not found in any references are put
+        # right after the file comment, which is replaced by the current one.
+        dump = "".join(entity.asScad() + "\n\n" for entity in unreferencedEntities)
+        resolved = list()
+        if unreferencedEntities:
+            resolved.append("")
+            resolved.append("// ------ AUTOMATICALLY RESOLVED DEPENDENCIES ------")
+            resolved.append("")
+            resolved.append(txt_prefix_each_line(dump, "    "))
+            resolved.append("// -------------------------------------------------")
+
+        removedLines = set()
+        if self.metaData.inScadFile is None:  # there is no file comment to replace
+            insertsOfLine.setdefault(0, [])[0:0] = [self.metaData.asScad()] + resolved + [lines[0] if lines else ""]
+        else:
+            oldFileCommentStart = self._getLineAndPositionInLine(self.metaData.inScadFile.startPosition)["line_num"] - 1
+            oldFileCommentEnd = self._getLineAndPositionInLine(self.metaData.inScadFile.endPosition - 1)["line_num"] - 1
+            removedLines.update(range(oldFileCommentStart, oldFileCommentEnd))
+            insertsOfLine[oldFileCommentEnd] = [self.metaData.asScad()] + resolved + insertsOfLine.get(oldFileCommentEnd, [])
 
-        while None in ret:
-            ret.remove(None)
+        ret = list()
+        for line_num, line in enumerate(lines):
+            if line_num in insertsOfLine:
+                ret.extend(insertsOfLine[line_num])
+            elif line_num not in removedLines:
+                ret.append(line)
         return "\n".join(ret)
 
+    def _getReferenceOfFileDict(self):
+        """Get a dictionary that maps the path of each file that is
+        (directly or indirectly) referenced in this file to the reference
+        in THIS file it is reached through. A file reached through
+        several references belongs to the first one."""
+        ret = dict()
+        for reference in self.referencedFiles:
+            todo = [reference.toScadFile]
+            while todo:
+                scadFile = todo.pop()
+                if not isinstance(scadFile, ScadFileFromFile) or scadFile.path in ret or scadFile.path == self.path:
+                    continue
+                ret[scadFile.path] = reference
+                todo.extend(r.toScadFile for r in scadFile.referencedFiles)
+        return ret
+
     def __str__(self):
         meta = txt_prefix_each_line(str(self.metaData), "        ")
         references = txt_prefix_each_line(txt_pretty_print(self.getReferencedFiles()), "        ")
@@ -1314,10 +2754,28 @@ class ScadFileFromFile(ScadFile):
 
 class ScadModule(ScadEntity):
     """Represents a module in scad files."""
-    def __init__(self, name, arguments="", content="", metaData=ScadDoc(""), inScadFile=None):
+    def __init__(self, name, arguments="", content="", metaData=None, inScadFile=None, contentSpan=None):
+        """contentSpan: (start, end) of the content in inScadFile.scadFile.
+        If given, the content is read from there on first access."""
         ScadEntity.__init__(self, name, metaData, inScadFile)
         self.arguments = arguments
         self.content = content
+        self._contentSpan = contentSpan
+
+    @property
+    def content(self):
+        if self._contentSpan is not None:
+            self._content = self._getTextOfSpan(self._contentSpan)
+            self._contentSpan = None
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+        self._contentSpan = None
+
+    def getCode(self):
+        return self.arguments + ";" + self.content  # ';' ends the parameters, so the first call of the body starts a statement
 
     def asScad(self, origin=True):
         """Create a string representation to be used in .scad files."""
@@ -1348,9 +2806,39 @@ module {self.name}({self.arguments}){{{data[origin]}
 
 class ScadVariable(ScadEntity):
     """Represents a variable in scad files."""
-    def __init__(self, name, value="", metaData=ScadDoc(""), inScadFile=None):
+    def __init__(self, name, value="", metaData=None, inScadFile=None, valueSpan=None):
+        """valueSpan: (start, end) of the value in inScadFile.scadFile.
+        If given, the value is read from there on first access."""
         ScadEntity.__init__(self, name, metaData, inScadFile)
         self.value = value
+        self._valueSpan = valueSpan
+
+    @property
+    def value(self):
+        if self._valueSpan is not None:
+            self._value = self._getTextOfSpan(self._valueSpan)
+            self._valueSpan = None
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._valueSpan = None
+        self._numericValue = False  # not parsed yet
+
+    @property
+    def numericValue(self):
+        """The value as ScadNumericVector, if it is a vector that only
+        contains numbers. None otherwise. Parsed on first access."""
+        if self._numericValue is False:
+            self._numericValue = ScadNumericVector.fromText(self.value)
+        return self._numericValue
+
+    def getCode(self):
+        return self.value
+
+    def _findIdentifierUsages(self):
+        return txt_find_identifier_usages(self.getCode(), moduleCalls=False)
 
     def asScad(self, origin=True):
         """Create a string representation to be used in .scad files."""
@@ -1366,12 +2854,151 @@ class ScadVariable(ScadEntity):
         return ScadEntity.__str__(self).format(typeSpecific="\n    Value: '" + str(self.value) + "'")
 
 
+class ScadNumericVector():
+    """A vector literal that only contains numbers ([1, 2.5, -3]) or
+    vectors of numbers (like the points and faces of a polyhedron or a
+    lookup table), stored in an array.array instead of a string.
+    values: all the numbers in one flat array ('q' if they are all
+        integers, 'd' otherwise).
+    rowLengths: the number of values in each inner vector, None if the
+        vector is not nested."""
+    def __init__(self, values, rowLengths=None):
+        self.values = values
+        self.rowLengths = rowLengths
+
+    @staticmethod
+    def fromText(text):
+        """Parse the given vector literal. Returns None if it contains
+        anything but numbers (expressions, variables, ranges, deeper
+        nesting ...)."""
+        text = text.strip()
+        if not text.startswith("[") or not text.endswith("]") or re_pattern_numeric_vector_characters.fullmatch(text) is None:
+            return None
+        body = text[1:-1].strip()
+        if "." in body or "e" in body or "E" in body:
+            typecode, convert = ("d", float)
+        else:
+            typecode, convert = ("q", int)
+        try:
+            if "[" not in body and "]" not in body:
+                return ScadNumericVector(array.array(typecode, map(convert, body.split(",")) if body else ()))
+            if not body.startswith("[") or not body.endswith("]"):
+                return None
+            inner = body[1:-1]
+            rows = re_pattern_numeric_vector_row_separator.split(inner)
+            if inner.count("[") != len(rows) - 1 or inner.count("]") != len(rows) - 1:
+                return None  # nested deeper
+            rowLengths = array.array("L", [count + 1 for count in map(str.count, rows, itertools.repeat(","))])
+            if not all(map(str.strip, rows)):  # there are empty inner vectors
+                rowLengths = array.array("L", (length if row.strip() else 0 for length, row in zip(rowLengths, rows)))
+                rows = [row for row in rows if row.strip()]
+            values = array.array(typecode, map(convert, ",".join(rows).split(",")) if rows else ())
+        except (ValueError, OverflowError):  # not a number, like '1-2' or '2 3', or too large
+            return None
+        return ScadNumericVector(values, rowLengths)
+
+    def rowCount(self):
+        return len(self.values) if self.rowLengths is None else len(self.rowLengths)
+
+    def rows(self):
+        """The inner vectors as arrays."""
+        if self.rowLengths is None:
+            raise ValueError("The vector is not nested.")
+        pos = 0
+        for length in self.rowLengths:
+            yield self.values[pos:pos + length]
+            pos = pos + length
+
+    def rounded(self, precision):
+        """A copy with the numbers rounded to precision decimal places
+        (self if precision is None or the numbers are integers)."""
+        if precision is None or self.values.typecode == "q":
+            return self
+        return ScadNumericVector(array.array("d", map(round, self.values, itertools.repeat(precision))), self.rowLengths)
+
+    def dedupedRows(self):
+        """Remove the inner vectors that are repeated.
+        Returns a tuple of the new vector and a list with the new index of
+        each inner vector. None if the vector is not nested."""
+        if self.rowLengths is None:
+            return None
+        if len(set(self.rowLengths)) == 1:  # the common case (like points), with each row as a tuple of strided slices
+            length = self.rowLengths[0]
+            rows = zip(*(self.values[column::length] for column in range(length))) if length > 0 else [()] * len(self.rowLengths)
+        else:
+            rows = (tuple(row) for row in self.rows())
+        indexOfRow = dict()
+        newIndexOfRow = [indexOfRow.setdefault(row, len(indexOfRow)) for row in rows]
+        values = array.array(self.values.typecode, itertools.chain.from_iterable(indexOfRow))
+        rowLengths = array.array("L", map(len, indexOfRow))
+        return (ScadNumericVector(values, rowLengths), newIndexOfRow)
+
+    def renumbered(self, newIndices):
+        """A copy of this vector of indices (like faces) with each index i
+        replaced by newIndices[i]. None if this is not a vector of
+        integers or an index is out of range."""
+        if self.values.typecode != "q":
+            return None
+        if len(self.values) > 0 and (min(self.values) < 0 or max(self.values) >= len(newIndices)):
+            return None
+        return ScadNumericVector(array.array("q", map(newIndices.__getitem__, self.values)), self.rowLengths)
+
+    def asNumpy(self):
+        """The values as numpy array (without copying them), with a shape
+        of (rows, columns) if all inner vectors have the same length.
+        Needs numpy, which is not required otherwise."""
+        import numpy  # optional dependency, only needed here
+        ret = numpy.frombuffer(self.values, dtype=numpy.int64 if self.values.typecode == "q" else numpy.float64)
+        if self.rowLengths is not None and len(set(self.rowLengths)) == 1:
+            ret = ret.reshape((len(self.rowLengths), self.rowLengths[0]))
+        return ret
+
+    def asScad(self):
+        """Create the shortest vector literal for this vector: no
+        whitespace and numbers like '2' instead of '2.000'.
+        (The numbers are formatted by a single format string, as
+        formatting millions of numbers one by one is slow.)"""
+        formatOfNumber = "%d" if self.values.typecode == "q" else "%r"
+        if self.rowLengths is None:
+            formatString = "[" + ",".join([formatOfNumber] * len(self.values)) + "]"
+        else:
+            formatOfRow = dict()
+            for length in set(self.rowLengths):
+                formatOfRow[length] = "[" + ",".join([formatOfNumber] * length) + "]"
+            formatString = "[" + ",".join([formatOfRow[length] for length in self.rowLengths]) + "]"
+        ret = formatString % tuple(self.values)
+        if self.values.typecode == "d":
+            ret = re_pattern_redundant_decimal_zero.sub("", ret)
+        return ret
+
+
 class ScadFunction(ScadEntity):
     """Represents a function in scad files."""
-    def __init__(self, name, arguments="", content="", metaData=ScadDoc(""), inScadFile=None):
+    def __init__(self, name, arguments="", content="", metaData=None, inScadFile=None, contentSpan=None):
+        """contentSpan: (start, end) of the content in inScadFile.scadFile.
+        If given, the content is read from there on first access."""
         ScadEntity.__init__(self, name, metaData, inScadFile)
         self.arguments = arguments
         self.content = content
+        self._contentSpan = contentSpan
+
+    @property
+    def content(self):
+        if self._contentSpan is not None:
+            self._content = self._getTextOfSpan(self._contentSpan)
+            self._contentSpan = None
+        return self._content
+
+    @content.setter
+    def content(self, content):
+        self._content = content
+        self._contentSpan = None
+
+    def getCode(self):
+        return self.arguments + "\n" + self.content
+
+    def _findIdentifierUsages(self):
+        return txt_find_identifier_usages(self.getCode(), moduleCalls=False)
 
     def asScad(self, origin=True):
         """Create a string representation to be used in .scad files."""
@@ -1405,10 +3032,24 @@ class InScadFile():
         self.startPosition = startPosition
         self.endPosition = endPosition
 
-        d = scadFile._getLineAndPositionInLine(referencePosition)
-        self.line_num = d["line_num"]
-        self.line_pos = d["line_pos"]
-        self.position = d["position"]
+        self.__lineAndPositionInLine = None  # see _getLineAndPositionInLine(), computed on first access.
+
+    def __getLineAndPositionInLine(self):
+        if self.__lineAndPositionInLine is None:
+            self.__lineAndPositionInLine = self.scadFile._getLineAndPositionInLine(self.referencePosition)
+        return self.__lineAndPositionInLine
+
+    @property
+    def line_num(self):
+        return self.__getLineAndPositionInLine()["line_num"]
+
+    @property
+    def line_pos(self):
+        return self.__getLineAndPositionInLine()["line_pos"]
+
+    @property
+    def position(self):
+        return self.__getLineAndPositionInLine()["position"]
 
     def __str__(self):
         return "'{scadFile._printablePath}'({self.line_num}:{self.line_pos})".format(self=self, scadFile=self.scadFile)
@@ -1428,15 +3069,35 @@ class ScadFileReference():
         if not isinstance(toScadFile, ScadFileDummy) and toScadFile is not None:
             raise TypeError("toScadFile must be inherit From ScadFileDummy but is '{}'.".format(type(toScadFile)))
 
-        self.toScadFile = toScadFile
+        self._toScadFile = toScadFile
+        self._lazyTarget = None
 
-    def getTarget(self):
-        if self.toScadFile is None:
+    def setLazyTarget(self, targetPath, recursive, registry):
+        """Reference the file at targetPath without reading it. Until the
+        target is needed (see getTarget) a ScadFileDummy stands in for it.
+        Then it is loaded through the registry (ScadFileRegistry)."""
+        self.setTarget(ScadFileDummy(targetPath=targetPath))
+        self._lazyTarget = (targetPath, recursive, registry)
+
+    def getTarget(self, load=True):
+        """Get the referenced file. A lazy target is loaded on the first
+        call, unless load is False. Then the ScadFileDummy is returned."""
+        if self._toScadFile is None:
             raise RuntimeError("This reference ('{}') does not have a target (yet)!".format(str(self)))
-        return self.toScadFile
+        if load and self._lazyTarget is not None:
+            targetPath, recursive, registry = self._lazyTarget
+            self._toScadFile = registry.getScadFile(targetPath, recursive=recursive, referencedFromScadFile=self)
+            self._lazyTarget = None
+        return self._toScadFile
+
+    @property
+    def toScadFile(self):
+        if self._toScadFile is None:
+            return None
+        return self.getTarget()
 
     def asScad(self):
-        if self.toScadFile is None:
+        if self._toScadFile is None:
             raise RuntimeError("Not target set! self.toScadFile must not be None.")
         # Implementation in ScadIncludeFileReference.asScad and ScadUseFileReference.asScad
 
@@ -1447,10 +3108,10 @@ class ScadFileReference():
         return "JSON EXPORT NOT IMPLEMENTED YET"
 
     def __str__(self):
-        return "{}[in={}, to='{}']".format(type(self).__name__, str(self.inScadFile), self.toScadFile._printablePath)
+        return "{}[in={}, to='{}']".format(type(self).__name__, str(self.inScadFile), self._toScadFile._printablePath)
 
     def __repr__(self):
-        return "{}[to='{}']".format(type(self).__name__, self.toScadFile._printablePath)
+        return "{}[to='{}']".format(type(self).__name__, self._toScadFile._printablePath)
 
 
 class ScadIncludeFileReference(ScadFileReference):
@@ -1460,7 +3121,7 @@ class ScadIncludeFileReference(ScadFileReference):
 
     def asScad(self):
         ScadFileReference.asScad(self)
-        return "include <{}>".format(self.toScadFile._printablePath)
+        return "include <{}>".format(self._toScadFile._printablePath)
 
 
 class ScadUseFileReference(ScadFileReference):
@@ -1470,28 +3131,213 @@ class ScadUseFileReference(ScadFileReference):
 
     def asScad(self):
         ScadFileReference.asScad(self)
-        return "use <{}>".format(self.toScadFile._printablePath)
+        return "use <{}>".format(self._toScadFile._printablePath)
+
+
+class ScadSearchPath():
+    """Finds the targets of include and use statements like OpenSCAD
+    does: relative to the directory of the referencing file, then in the
+    library directories (--lib-path, then the directories in the
+    OPENSCADPATH environment variable).
+
+    Whether a file exists is looked up in a listing of its directory.
+    Each directory is listed only once, so resolving thousands of
+    references does not stat thousands of files (e.g. on a slow shared
+    filesystem)."""
+    def __init__(self, directories=()):
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self._listings = dict()  # absolute directory -> frozenset of the names of its entries
+
+    @staticmethod
+    def fromEnvironment(libPaths=()):
+        """The search path with the given directories and the directories
+        in OPENSCADPATH."""
+        environmentPaths = os.environ.get("OPENSCADPATH", "").split(os.pathsep)
+        return ScadSearchPath(list(libPaths) + [path for path in environmentPaths if path != ""])
+
+    def exists(self, path):
+        """Is there an entry at path (an absolute, normalized path)?"""
+        directory, name = os.path.split(path)
+        listing = self._listings.get(directory)
+        if listing is None:
+            context.metrics.count("directoriesListed")
+            try:
+                listing = frozenset(os.listdir(directory))
+            except OSError:
+                listing = frozenset()
+            self._listings[directory] = listing
+        return name in listing
+
+    def resolve(self, fromDirectory, targetPath):
+        """The path of the file that targetPath (as written in an include
+        or use statement in a file in fromDirectory) refers to.
+        If it is found nowhere, the path relative to fromDirectory is
+        returned (so reading it fails with a helpful message)."""
+        context.metrics.count("searchPathLookups")
+        if os.path.isabs(targetPath):
+            return targetPath
+        candidates = [os.path.normpath(os.path.join(os.path.abspath(directory), targetPath)) for directory in [fromDirectory] + self.directories]
+        for candidate in candidates:
+            if self.exists(candidate):
+                return candidate
+        return candidates[0]
+
+    def clear(self):
+        self._listings = dict()
+
+
+class ScadFileRegistry():
+    """Loads each .scad file only once: Every ScadFileFromFile that is
+    needed (the targets of references, the files of a library) is read
+    through a registry and shared by everything that references it.
+    This also breaks cycles of includes.
+    The targets of references are found with the ScadSearchPath of the
+    registry, the @adopt tags of the docs with its ScadDocAdoptions."""
+    def __init__(self, searchPath=None):
+        self.scadFiles = dict()  # (absolute path, recursive) -> ScadFileFromFile
+        self.scadFileList = list()  # the values of scadFiles, in the order they were read
+        self.searchPath = searchPath if searchPath is not None else ScadSearchPath.fromEnvironment()
+        self.adoptions = ScadDocAdoptions(self)
+
+    def getScadFile(self, path, recursive, referencedFromScadFile=None):
+        """Get the ScadFileFromFile for path, read it if it was not read
+        yet. referencedFromScadFile is only used when the file is read."""
+        key = (os.path.abspath(path), recursive)
+        if key in self.scadFiles:
+            context.metrics.count("parseCacheHits")
+            return self.scadFiles[key]
+        scadFile = ScadFileFromFile.buildFromFile(path, recursive=recursive, referencedFromScadFile=referencedFromScadFile, registry=self)
+        self.scadFiles[key] = scadFile
+        self.scadFileList.append(scadFile)
+        return scadFile
+
+    def clear(self):
+        self.scadFiles = dict()
+        self.scadFileList = list()
+        self.searchPath.clear()
+        self.adoptions.clear()
+
+
+class ScadDocAdoptions():
+    """Resolves the @adopt and @adopt-all tags of the ScadDocs (see
+    ScadDoc) with the entities defined in the files of a ScadFileRegistry.
+
+    A doc is resolved once: ScadDoc._adopt() replaces its tags by the
+    resulting ones. So a doc that is adopted by many entities is resolved
+    only once for all of them, and the -dependency tags of an adopting
+    entity are read like any other tags, without following the chain of
+    adoptions again."""
+    def __init__(self, registry):
+        self.registry = registry
+        self.clear()
+
+    def clear(self):
+        self._entitiesByName = None  # name -> the entities with this name, see getEntitiesByName()
+        self._indexedFiles = 0
+        self._indexedFileIds = set()
+
+    def getEntitiesByName(self):
+        """Index the entities defined in the files of the registry by
+        name. The files that were read since are added to the index."""
+        if self._entitiesByName is None:
+            self._entitiesByName = dict()
+        while self._indexedFiles < len(self.registry.scadFileList):  # (looking at the entities may read more files)
+            scadFile = self.registry.scadFileList[self._indexedFiles]
+            for entity in scadFile.getDefinedEntities():
+                self._entitiesByName.setdefault(entity.name, []).append(entity)
+            self._indexedFileIds.add(id(scadFile))
+            self._indexedFiles = self._indexedFiles + 1
+        return self._entitiesByName
+
+    def findSource(self, name, scadDoc):
+        """Find the doc of the entity named name that scadDoc adopts from.
+        An entity of the same type in the same file is preferred over one
+        of the same type in another file, which is preferred over one of
+        another type in the same file. Returns None if there is none."""
+        scadFile = scadDoc.inScadFile.scadFile if scadDoc.inScadFile is not None else None
+        candidates = list(self.getEntitiesByName().get(name, ()))
+        if scadFile is not None and id(scadFile) not in self._indexedFileIds:  # not read through the registry
+            candidates.extend(entity for entity in scadFile.getDefinedEntities() if entity.name == name)
+        candidates = [entity for entity in candidates if entity.metaData is not scadDoc]
+        if not candidates:
+            return None
+        return min(candidates, key=(lambda entity: (type(entity) is not scadDoc.type, entity.inScadFile is None or entity.inScadFile.scadFile is not scadFile))).metaData
+
+    def resolve(self, scadDoc):
+        """Resolve the adoptions of scadDoc, and before that the ones of
+        the docs it adopts from (depth first, without recursion, so long
+        chains don't hit the recursion limit).
+        Raises a ValueError if the adoptions form a cycle."""
+        stack = [[scadDoc, None, None]]  # [doc, its sources (doc, adopt all, name), the name it is adopted by]
+        onStack = {id(scadDoc): 0}
+        while stack:
+            doc, sources, name = stack[-1]
+            if sources is None:
+                sources = stack[-1][1] = list()
+                for sourceName, adoptAll in doc.getAdoptions():
+                    source = self.findSource(sourceName, doc)
+                    if source is None:
+                        printConsole("No entity '{}' to adopt the tags from for {}.".format(sourceName, doc.inScadFile), 1)
+                        continue
+                    sources.append((source, adoptAll, sourceName))
+            for source, adoptAll, sourceName in sources:
+                if source.isAdoptionResolved():
+                    continue
+                if id(source) in onStack:
+                    chain = [str(scadDoc.inScadFile) if entry[2] is None else "'{}'".format(entry[2]) for entry in stack[onStack[id(source)]:]]
+                    raise ValueError("The adoptions form a cycle: {} -> '{}'.".format(" -> ".join(chain), sourceName))
+                onStack[id(source)] = len(stack)
+                stack.append([source, None, sourceName])
+                break
+            else:
+                doc._adopt([(source, adoptAll) for source, adoptAll, sourceName in sources])
+                context.metrics.count("docsAdopted")
+                del onStack[id(doc)]
+                stack.pop()
 
 
 class ScadLibrary():
 
-    def __init__(self, sources=list(), recursive=False, traverseSub=False):
+    def __init__(self, sources=(), recursive=False, traverseSub=False, registry=None, sourceFiles=None):
+        """registry: the ScadFileRegistry the files are read through
+        (default: the registry of the active ScadToolContext).
+        sourceFiles: the paths of the files of the library, if they were
+        already found with findSourceFiles() (sources and traverseSub are
+        ignored then)."""
+        if registry is None:
+            registry = context.registry
         self.fileList = list()
+        self._dependentsIndex = dict()  # inferDependencies -> index, see getDependentsIndex()
 
-        for source in sources:
-            if (os.path.isdir(source)):
-                self.fileList.extend(ScadFileFromFile.buildListFromDirectory(source, recursive=recursive, traverseSub=traverseSub))
-            else:
-                self.fileList.append(ScadFileFromFile.buildFromFile(source, recursive=recursive, referencedFromScadFile=None))
+        with context.memory.measure("library"):
+            if sourceFiles is None:
+                sourceFiles = ScadLibrary.findSourceFiles(sources, traverseSub)
+            for path in sourceFiles:
+                self.fileList.append(registry.getScadFile(path, recursive=recursive))
 
         printConsole("FILES in Library:", 1)
         for f in self.fileList:
             printConsole("    " + repr(f) + "\n", 1)
 
-    def findResolutions(self, dependencies):
+    @staticmethod
+    def findSourceFiles(sources, traverseSub=False):
+        """Get the paths of the .scad files a library for the given
+        sources (files and directories) consists of, without reading them."""
+        ret = list()
+        with context.profiler.phase("discovery"):
+            for source in sources:
+                if (os.path.isdir(source)):
+                    ret.extend(ScadFileFromFile.findFilesInDirectory(source, traverseSub))
+                else:
+                    ret.append(source)
+        context.metrics.count("filesDiscovered", len(ret))
+        return ret
+
+    def findResolutions(self, dependencies, inferDependencies=None):
         """Finds the entities that resolve the given dependencies.
         returns a tupel of the dependencyTree and a list of the Attributes
         that could not be resolved.
+        inferDependencies: see ScadType.getDependencies()
         """
         dependencyTree = dict()
         unresolvedDependencies = list()
@@ -1499,8 +3345,10 @@ class ScadLibrary():
             fileWithResolution = dependency.findResolution(self.fileList)
             if dependency.hasResolution():
                 resolution = dependency.getResolution()
-                dependencyTree[resolution], unres = resolution.getDependencyTreeAndUnresolvedDependencies([fileWithResolution] + self.fileList)
+                dependencyTree[resolution], unres = resolution.getDependencyTreeAndUnresolvedDependencies([fileWithResolution] + self.fileList, inferDependencies)
                 unresolvedDependencies.extend(unres)
+            elif dependency.isInferred and dependency.scadEntityType is ScadVariable:
+                continue  # probably a local variable or parameter
             else:
                 #  raise RuntimeError("No resolution for '{}' found.".format(repr(dependency)))
                 unresolvedDependencies.append(dependency)
@@ -1547,10 +3395,51 @@ class ScadLibrary():
     def getReferencedFiles(self):
         ret = list()
         for f in self.fileList:
-            ret.extend([r.getTarget() for r in f.getReferencedFiles()])
+            ret.extend([r.getTarget(load=f.recursive) for r in f.getReferencedFiles()])
+        return ret
+
+    def getDependentsIndex(self, inferDependencies=None):
+        """Get the reverse adjacency index of the dependencies in this library:
+        A dictionary that maps (scadEntityType, name) of a dependency to
+        the list of entities and files that have this dependency.
+        inferDependencies: see ScadType.getDependencies()
+
+        The index is built once from the forward edges
+        (ScadType.getDependencies()) of every file and every available
+        entity. Dependencies don't need to be resolved for this."""
+        if inferDependencies not in self._dependentsIndex:
+            index = dict()
+            seen = set()
+            for scadType in self.fileList + self.getReferencedFiles() + self.getAvailableEntities():
+                if id(scadType) in seen or type(scadType) is ScadFileDummy:  # dummies only know their path
+                    continue
+                seen.add(id(scadType))
+                for dependency in scadType.getDependencies(inferDependencies):
+                    index.setdefault((dependency.scadEntityType, dependency.name), []).append(scadType)
+            self._dependentsIndex[inferDependencies] = index
+        return self._dependentsIndex[inferDependencies]
+
+    def findDependents(self, name, transitive=False, inferDependencies=None):
+        """Find the entities and files that depend on the module, function
+        or variable with the given name. If transitive, also find the
+        ones that depend on those (breadth-first, nearest first)."""
+        index = self.getDependentsIndex(inferDependencies)
+        ret = list()
+        seen = set()
+        queue = collections.deque()
+        for scadEntityType in (ScadModule, ScadFunction, ScadVariable):
+            queue.extend(index.get((scadEntityType, name), []))
+        while queue:
+            dependent = queue.popleft()
+            if id(dependent) in seen:
+                continue
+            seen.add(id(dependent))
+            ret.append(dependent)
+            if transitive and isinstance(dependent, ScadEntity):
+                queue.extend(index.get((type(dependent), dependent.name), []))
         return ret
 
-    def findEntity(self, description=dict()):
+    def findEntity(self, description=None):
         # TODO define a json syntax that allows searching for entities
         # based on information given in the ScadDoc.
         pass
@@ -1563,3 +3452,600 @@ class ScadLibrary():
             if subTree is not None:
                 entities.extend(ScadLibrary.reduceRedundanciesInDependencyTree(subTree))
         return list(set(entities))
+
+
+class ScadNameMappingRules():
+    """Rules that map names (see the map command):
+        prefix: "old_*" -> "new_*"
+        suffix: "*_old" -> "*_new"
+        regex: "/old_(.*)_mm/" -> "new_\\1" (matches the whole name, the
+            target is expanded like with re.Match.expand())
+    The first rule (in the order they were added) that matches a name wins.
+
+    The rules are compiled into one regular expression with an alternative
+    per rule, so a name is matched against all the rules at once."""
+    def __init__(self):
+        self.rules = list()  # (kind, pattern, target, data)
+        self._combined = None  # see _compile()
+        self._regexes = dict()  # index of a regex rule -> its compiled pattern
+
+    @staticmethod
+    def isRule(source):
+        """True if source is a prefix, suffix or regex rule (a name of an
+        entity can't contain '*' or '/')."""
+        return "*" in source or (len(source) > 1 and source.startswith("/") and source.endswith("/"))
+
+    def add(self, source, target, data=None):
+        """Add the rule that maps source to target. data is returned with
+        the target names of the names the rule matches."""
+        if len(source) > 1 and source.startswith("/") and source.endswith("/"):
+            kind, pattern = "regex", source[1:-1]
+            self._regexes[len(self.rules)] = re.compile(pattern)
+        elif source.endswith("*") and "*" not in source[:-1]:
+            if not target.endswith("*") or "*" in target[:-1]:
+                raise ValueError("The target of the prefix rule '{}' must end with '*' but is '{}'.".format(source, target))
+            kind, pattern, target = "prefix", source[:-1], target[:-1]
+        elif source.startswith("*") and "*" not in source[1:]:
+            if not target.startswith("*") or "*" in target[1:]:
+                raise ValueError("The target of the suffix rule '{}' must start with '*' but is '{}'.".format(source, target))
+            kind, pattern, target = "suffix", source[1:], target[1:]
+        else:
+            raise ValueError("A rule must be 'PREFIX*', '*SUFFIX' or '/REGEX/' but is '{}'.".format(source))
+        self.rules.append((kind, pattern, target, data))
+        self._combined = None
+
+    def __len__(self):
+        return len(self.rules)
+
+    def _compile(self):
+        """The combined pattern of all rules, or False if the regex rules
+        can't be combined (numbered backreferences would refer to other
+        groups, global flags must be at the start)."""
+        if self._combined is None:
+            alternatives = list()
+            for index, (kind, pattern, target, data) in enumerate(self.rules):
+                if kind == "prefix":
+                    pattern = re.escape(pattern) + ".*"
+                elif kind == "suffix":
+                    pattern = ".*" + re.escape(pattern)
+                elif re_pattern_numbered_backreference.search(pattern):
+                    self._combined = False
+                    return self._combined
+                alternatives.append("(?P<_rule{}>{})".format(index, pattern))
+            try:
+                self._combined = re.compile("|".join(alternatives))
+            except re.error:
+                self._combined = False
+        return self._combined
+
+    def _apply(self, index, name):
+        kind, pattern, target, data = self.rules[index]
+        if kind == "prefix":
+            return (target + name[len(pattern):], data) if name.startswith(pattern) else None
+        if kind == "suffix":
+            return (name[:len(name) - len(pattern)] + target, data) if name.endswith(pattern) else None
+        match = self._regexes[index].fullmatch(name)
+        return (match.expand(target), data) if match is not None else None
+
+    def mapName(self, name):
+        """Get (target name, data) of the first rule that matches name, or None."""
+        combined = self._compile()
+        if combined:
+            match = combined.fullmatch(name)
+            return self._apply(int(match.lastgroup[len("_rule"):]), name) if match is not None else None
+        for index in range(len(self.rules)):
+            ret = self._apply(index, name)
+            if ret is not None:
+                return ret
+        return None
+
+    def mapNames(self, names):
+        """Map each of names. Returns an OrderedDict name -> (target name,
+        data) of the names a rule matched."""
+        ret = collections.OrderedDict()
+        for name in names:
+            mapped = self.mapName(name)
+            if mapped is not None:
+                ret[name] = mapped
+        return ret
+
+
+# ####################### API ########################
+
+
+class ScadToolResult():
+    """What buildLibrary(), compileFile() and compileFiles() produce."""
+    def __init__(self, output, inputFile, entities=None, unresolvedDependencies=None, contributorPaths=None, assetPaths=None, shards=None):
+        self.output = output  # The text of the output file.
+        self.shards = shards  # path -> text of the shards that are used by a sharded output (see shardEntities()), None otherwise.
+        self.inputFile = inputFile  # The ScadFileFromFile the output was made for.
+        self.entities = entities if entities is not None else list()  # The entities copied to the output.
+        self.unresolvedDependencies = unresolvedDependencies if unresolvedDependencies is not None else list()
+        self.contributorPaths = contributorPaths if contributorPaths is not None else list()  # The .scad files that contributed to the output.
+        self.assetPaths = assetPaths if assetPaths is not None else list()  # The files that are imported by the copied code.
+        self.sizeReport = None  # The SizeReport of the output, if it was requested.
+
+
+class SizeReport():
+    """Which entities and source files the bytes and lines of an output
+    come from. Each entity is also shown with the cost of its dependency
+    closure: the entity and all the entities of the output it depends on,
+    directly or indirectly. That is what an output costs, that only needs
+    this entity.
+    Only plain data is kept, so a report can be sent between processes."""
+    def __init__(self, outputName, output, entityTexts, dependencies):
+        """outputName: how the output is called in the report.
+        output: the text of the output (and its shards).
+        entityTexts: a list of (entity, the text of the entity in the output).
+        dependencies: entity -> the entities it depends on directly.
+            Dependencies that are not in entityTexts are ignored."""
+        self.outputName = outputName
+        self.bytes = len(output.encode())
+        self.lines = output.count("\n") + 1 if output else 0
+
+        indexOf = dict()
+        for index, (entity, _) in enumerate(entityTexts):
+            indexOf.setdefault(entity, index)
+        dependencyIndices = [set(indexOf[dependency] for dependency in dependencies.get(entity, ()) if dependency in indexOf) for entity, _ in entityTexts]
+
+        self.entities = list()  # a dict per entity, see asDict()
+        for entity, text in entityTexts:
+            self.entities.append(collections.OrderedDict([
+                ("type", type(entity).__name__),
+                ("name", entity.name),
+                ("source", os.path.relpath(entity.inScadFile.scadFile.path, ScadFileFromFile.referencePath) if entity.inScadFile is not None else "(dummies)"),
+                ("bytes", len(text.encode())),
+                ("lines", text.count("\n") + 1 if text else 0)]))
+        for index, row in enumerate(self.entities):
+            closure = set([index])
+            stack = [index]
+            while stack:
+                for dependency in dependencyIndices[stack.pop()]:
+                    if dependency not in closure:
+                        closure.add(dependency)
+                        stack.append(dependency)
+            row["closureEntities"] = len(closure)
+            row["closureBytes"] = sum(self.entities[member]["bytes"] for member in closure)
+            row["closureLines"] = sum(self.entities[member]["lines"] for member in closure)
+
+        self.sources = collections.OrderedDict()  # source -> a dict, see asDict()
+        for row in self.entities:
+            source = self.sources.setdefault(row["source"], collections.OrderedDict([("source", row["source"]), ("entities", 0), ("bytes", 0), ("lines", 0)]))
+            source["entities"] += 1
+            source["bytes"] += row["bytes"]
+            source["lines"] += row["lines"]
+
+    def asDict(self, top=None):
+        """The report as a dict (for json): the totals, the bytes and lines
+        that are not part of an entity (file comments, statements ...) and
+        the (top) entities and sources, the biggest first."""
+        entities = sorted(self.entities, key=(lambda row: (-row["bytes"], row["source"], row["name"])))
+        sources = sorted(self.sources.values(), key=(lambda row: (-row["bytes"], row["source"])))
+        ret = collections.OrderedDict()
+        ret["output"] = self.outputName
+        ret["bytes"] = self.bytes
+        ret["lines"] = self.lines
+        # entities share lines when the output is minified, so the lines are not exact
+        ret["otherBytes"] = max(0, self.bytes - sum(row["bytes"] for row in self.entities))
+        ret["otherLines"] = max(0, self.lines - sum(row["lines"] for row in self.entities))
+        ret["entities"] = entities[:top]
+        ret["sources"] = sources[:top]
+        return ret
+
+    def asText(self, top=20):
+        """The report as a human readable table with the top entities and sources."""
+        data = self.asDict(top)
+        ret = ["SIZE REPORT: '{}': {} bytes, {} lines ({} bytes, {} lines not in entities)".format(data["output"], data["bytes"], data["lines"], data["otherBytes"], data["otherLines"])]
+        ret.append("")
+        ret.append("{:>10} {:>8} {:>14} {:>9}  {}".format("BYTES", "LINES", "CLOSURE BYTES", "ENTITIES", "BIGGEST ENTITIES"))
+        for row in data["entities"]:
+            ret.append("{:>10} {:>8} {:>14} {:>9}  {} {} ({})".format(row["bytes"], row["lines"], row["closureBytes"], row["closureEntities"], row["type"][4:], row["name"], row["source"]))
+        ret.append("")
+        ret.append("{:>10} {:>8} {:>14} {:>9}  {}".format("BYTES", "LINES", "", "ENTITIES", "BIGGEST SOURCES"))
+        for row in data["sources"]:
+            ret.append("{:>10} {:>8} {:>14} {:>9}  {}".format(row["bytes"], row["lines"], "", row["entities"], row["source"]))
+        return "\n".join(ret)
+
+
+def flattenDependencyTree(dependencyTree):
+    """entity -> the set of entities it depends on directly, for all the
+    entities in the dependencyTree (see getDependencyTreeAndUnresolvedDependencies())."""
+    ret = dict()
+    stack = [dependencyTree] if dependencyTree is not None else []
+    while stack:
+        for entity, subTree in stack.pop().items():
+            ret.setdefault(entity, set())
+            if subTree is not None:
+                ret[entity].update(subTree)
+                stack.append(subTree)
+    return ret
+
+
+def resolveEntityDependencies(entities, inferDependencies="merge"):
+    """entity -> the entities of the given ones it depends on directly,
+    resolved by type and name, the first definition wins (like in
+    ScadFile.getReachableEntities())."""
+    availableEntities = dict()
+    for entity in entities:
+        availableEntities.setdefault((type(entity), entity.name), entity)
+    ret = dict()
+    for entity in entities:
+        dependencies = ret.setdefault(entity, set())
+        for dependency in entity.getDependencies(inferDependencies):
+            resolution = availableEntities.get((dependency.scadEntityType, dependency.name))
+            if resolution is not None:
+                dependencies.add(resolution)
+    return ret
+
+
+def uniquePaths(scadFilesOrPaths):
+    """The paths of the given files (or the given paths) without
+    duplicates, in order."""
+    return list(collections.OrderedDict.fromkeys(getattr(scadFile, "path", scadFile) for scadFile in scadFilesOrPaths))
+
+
+def compactNumericData(code, compactNumbers=False, precision=None, dedupeVertices=False):
+    """Rewrite the numeric vectors in the code for the output:
+    compactNumbers: without any whitespace and with the shortest numbers.
+    precision: rounded to precision decimal places (implies compactNumbers).
+    dedupeVertices: without repeated points in polyhedrons (implies
+        compactNumbers).
+    See txt_compact_numeric_data(). Returns the code unchanged if none of
+    them is given."""
+    if not compactNumbers and precision is None and not dedupeVertices:
+        return code
+    return txt_compact_numeric_data(code, precision, dedupeVertices)
+
+
+def transformOutput(code, compactNumbers=False, precision=None, dedupeVertices=False, minify=False, checkMinified=True):
+    """Apply compactNumericData() and (if minify) minify the code. Without
+    checkMinified, the minified code is not checked (see minifyCode())."""
+    code = compactNumericData(code, compactNumbers, precision, dedupeVertices)
+    if not minify:
+        return code
+    return minifyCode(code) if checkMinified else txt_minify(code)
+
+
+def minifyCode(code, checkPath="minified.scad"):
+    """Minify the code for the output (see txt_minify()) and check that
+    the minified code defines the same modules, functions and variables
+    (with the same arguments) as the code. Raises a ValueError if not.
+    checkPath: the path the code is parsed as for the check."""
+    minified = txt_minify(code)
+    with context.profiler.phase("minify check"):
+        entitiesBefore = getEntitySignatures(code, checkPath)
+        entitiesAfter = getEntitySignatures(minified, checkPath)
+    if entitiesBefore != entitiesAfter:
+        raise ValueError("The minified code does not define the same entities as the code. Missing: {} Added: {}".format(
+            sorted(set(entitiesBefore) - set(entitiesAfter)), sorted(set(entitiesAfter) - set(entitiesBefore))))
+    context.metrics.count("minifiedBytesRemoved", len(code) - len(minified))
+    return minified + "\n"
+
+
+def getEntitySignatures(code, path):
+    """The type, name and arguments (without whitespace) of each entity
+    defined in code, sorted. (The file is not read recursively.)"""
+    scadFile = ScadFileFromFile(content=code, path=path, recursive=False)
+    return sorted((type(entity).__name__, entity.name, re.sub(r"\s+", "", getattr(entity, "arguments", ""))) for entity in scadFile.getDefinedEntities())
+
+
+def shardEntities(entities, dependencyTree, topLevelPath, shardDir, transform=None):
+    """Split the entities of a library into shards: one file for the
+    modules and functions of each library file they come from (and one for
+    the dummies), and a top-level file that use<>s all the shards and
+    defines the variables.
+    As use<> does not make variables visible, each shard gets a copy of
+    the variables its entities depend on and use<>s the shards of the
+    modules and functions they depend on (see the dependencyTree).
+
+    The shards are content-addressed: the name contains a hash of the
+    entities in it (and of the entities in the shards it uses). Parts that
+    need the same entities of a library file share the shard.
+    transform: a function applied to the code of each file (e.g. minifying).
+    Returns a tuple of the text of the top-level file and an OrderedDict
+    of the shards (path -> text)."""
+    import hashlib
+    if transform is None:
+        transform = (lambda code: code)
+
+    dependenciesOf = flattenDependencyTree(dependencyTree)
+
+    def sourceOf(entity):
+        """The path of the file the entity comes from, None for dummies."""
+        return entity.inScadFile.scadFile.path if entity.inScadFile is not None else None
+
+    def sortKey(entity):  # the order of the definitions, so the same entities always give the same shard
+        return (sourceOf(entity) or "", entity.inScadFile.startPosition if entity.inScadFile is not None else 0, type(entity).__name__, entity.name)
+
+    entities = sorted(entities, key=sortKey)
+    membersOfShard = collections.OrderedDict()  # source path -> modules and functions
+    for entity in entities:
+        if not isinstance(entity, ScadVariable):
+            membersOfShard.setdefault(sourceOf(entity), []).append(entity)
+    shardOfEntity = dict((entity, source) for source, members in membersOfShard.items() for entity in members)
+
+    codeOfShard = dict()  # source path -> code of the copied variables and the members
+    usesOfShard = dict()  # source path -> the source paths of the shards it uses
+    hashOfShard = dict()  # source path -> hash of the code
+    for source, members in membersOfShard.items():
+        variables = list()
+        uses = set()
+        if source is not None and None in membersOfShard:
+            uses.add(None)  # the dummies could be needed anywhere
+        stack = list(members)
+        visited = set(members)
+        while stack:
+            for dependency in dependenciesOf.get(stack.pop(), ()):
+                if isinstance(dependency, ScadVariable):
+                    if dependency not in visited:
+                        visited.add(dependency)
+                        variables.append(dependency)
+                        stack.append(dependency)
+                elif shardOfEntity.get(dependency, source) != source:
+                    uses.add(shardOfEntity[dependency])
+        codeOfShard[source] = transform("\n\n".join(entity.asScad() for entity in sorted(variables, key=sortKey) + members))
+        usesOfShard[source] = uses
+        hashOfShard[source] = hashlib.sha1(codeOfShard[source].encode()).hexdigest()
+
+    pathOfShard = dict()
+    for source in membersOfShard:
+        key = hashlib.sha1("\n".join([hashOfShard[source]] + sorted(hashOfShard[used] for used in usesOfShard[source])).encode()).hexdigest()
+        stem = os.path.splitext(os.path.basename(source))[0] if source is not None else "dummies"
+        pathOfShard[source] = os.path.join(shardDir, "{}-{}.scad".format(stem, key[:12]))
+
+    def useReferences(scadFile, sources, fromDirectory):
+        for source in sorted(sources, key=(lambda source: pathOfShard[source])):
+            path = pathOfShard[source]
+            scadFile.referencedFiles.append(ScadUseFileReference(InScadFile(scadFile, 0, 0, 0), ScadFileDummy(path, printablePath=os.path.relpath(path, fromDirectory))))
+
+    shards = collections.OrderedDict()
+    for source in membersOfShard:
+        path = pathOfShard[source]
+        description = "Generated by scadtool: the entities of a library that are needed from '{}'.".format(os.path.relpath(source, ScadFileFromFile.referencePath) if source is not None else "dummies")
+        shardFile = ScadFile(metaData=ScadDoc(description, ScadFile))
+        shardFile.metaData.add("filename", os.path.basename(path))
+        useReferences(shardFile, usesOfShard[source], os.path.dirname(path))
+        shards[path] = transform(shardFile.asScad()) + "\n" + codeOfShard[source] + "\n"
+        context.metrics.count("shardsCreated")
+
+    topLevelDirectory = os.path.dirname(os.path.abspath(topLevelPath)) if topLevelPath is not None else os.path.abspath(os.path.curdir)
+    topLevelFile = ScadFile(definedEntities=[entity for entity in entities if isinstance(entity, ScadVariable)])
+    if topLevelPath is not None:
+        topLevelFile.metaData.add("filename", topLevelPath)
+    useReferences(topLevelFile, list(membersOfShard), topLevelDirectory)
+    return (transform(topLevelFile.asScad(dummiesFirst=True)), shards)
+
+
+def buildLibrary(inputPath, librarySources=(), recursive=False, traverseSub=False, inferDependencies=None, createDummies=True, outFileName=None, scadLibrary=None, compactNumbers=False, precision=None, dedupeVertices=False, minify=False, shardDir=None, sizeReport=False, context=None):
+    """Build the library file for the file at inputPath: Resolve the
+    dependencies the input file can't resolve itself with the entities in
+    the library and return a ScadToolResult.
+    librarySources, recursive, traverseSub: see ScadLibrary
+    scadLibrary: an existing ScadLibrary to use instead of reading the
+        librarySources (e.g. to reuse it for several input files).
+    inferDependencies: see ScadType.getDependencies()
+    createDummies: create dummies for dependencies without a resolution.
+    outFileName: the name the output is written to (for the @filename tag).
+    compactNumbers, precision, dedupeVertices: see compactNumericData()
+    minify: remove comments and unneeded whitespace (see minifyCode()).
+    shardDir: split the output into shards in this directory (see
+        shardEntities()). The output is the top-level file then.
+    sizeReport: attach a SizeReport to the result.
+    context: the ScadToolContext to use instead of the active one."""
+    with (context if context is not None else getActiveContext()).activate() as context:
+        if scadLibrary is None:
+            scadLibrary = ScadLibrary(librarySources, recursive, traverseSub)
+
+        printConsole("PROGRESS: Building the library for: '{}'".format(repr(inputPath)), 1)
+        inputFile = context.registry.getScadFile(inputPath, recursive=True)
+
+        if inputFile.metaDataIsAutoGenerated:
+            raise ValueError("'{}' did not have a @filename tag with the correct name. IS THE FILENAME TAG CORRECT? We can't build a library without knowing the dependencies.".format(inputPath))
+
+        printConsole("PROGRESS: Checking the internal structure of the input file. Trying to resolve dependencies internally...", 1)
+
+        with context.profiler.phase("resolution"), context.memory.measure("resolution"):
+            dependencyTree, unresolvedDependencies = inputFile.getDependencyTreeAndUnresolvedDependencies([inputFile], inferDependencies)
+        printConsole("INFO: Internal Dependency Tree:\n" + txt_pretty_print(dependencyTree, kvsep=" depends on: "), 2)
+        printConsole("INFO: Internally Unresolved Dependencies:\n" + txt_pretty_print(unresolvedDependencies), 2)
+
+        if unresolvedDependencies:  # unresolvedDependencies is not empty
+            printConsole("PROGRESS: Resolving the dependencies by searching the library...", 2)
+            with context.profiler.phase("resolution"), context.memory.measure("resolution"):
+                t, u = scadLibrary.findResolutions(unresolvedDependencies, inferDependencies)
+            if t is not None:
+                if dependencyTree is None:
+                    dependencyTree = dict()
+                dependencyTree.update(t)
+            unresolvedDependencies = u
+
+        if dependencyTree is None:
+            printConsole("""\nWARNING: The dependency tree is empty!
+    This means NONE of the defined dependencies could be resolved.
+
+    Possible Reason 0: There are no models for the given entities.
+        That would be sad...
+
+    Possible Reason 1: No dependencies are defined.
+        Is there a @module-dependency tag in the input file?
+
+    Possible Reason 2: The library is empty
+        Often the --traverse (-t) flag is forgotten. This flag makes
+        sure sub-directories are used to create the library.
+
+    Possible Reason 3: The mapping is missing
+        Is there a file containing the mapping to the module names used
+        in the library?
+
+    Possible Reason 4: Some includes are missing.
+        I once forgot t include the file that defines the model and
+        therefore all the dependencies.
+
+    Dummies will be created...""", 1)
+            dependencyTree = dict()
+
+        printConsole("INFO: Complete Dependency Tree:\n" + txt_pretty_print(dependencyTree, kvsep=" depends on: "), 2)
+
+        with context.profiler.phase("resolution"), context.memory.measure("resolution"):
+            neededEntities = ScadLibrary.reduceRedundanciesInDependencyTree(dependencyTree)
+
+        if len(unresolvedDependencies) > 0:
+            printConsole("INFO: Still Unresolved Dependencies:\n" + txt_pretty_print(unresolvedDependencies), 2)
+            dummyResolutions = list()
+            if createDummies:
+                printConsole("INFO: Creating Dummies for the Unresolved Dependencies", 2)
+                with context.profiler.phase("dummy creation"):
+                    for dependency in unresolvedDependencies:
+                        dummyResolutions.append(dependency.getDummyResolution())
+            printConsole(txt_prefix_each_line(txt_pretty_print(dummyResolutions), "    "), 3)
+            neededEntities = neededEntities + dummyResolutions
+            neededEntities = list(set(neededEntities))  # should be unnecessary as there should be no duplicates.
+
+        context.metrics.count("unresolvedDependencies", len(unresolvedDependencies))
+
+        # remove entities that are defined in the input file
+        neededEntities = list(filter(lambda entity: entity not in inputFile.getAvailableEntities(), neededEntities))
+        printConsole("INFO: Entities in library:\n" + txt_prefix_each_line(txt_pretty_print(neededEntities), "    "), 2)
+
+        def transform(code, checkMinified=True):
+            return transformOutput(code, compactNumbers, precision, dedupeVertices, minify, checkMinified)
+
+        shards = None
+        with context.profiler.phase("emission"), context.memory.measure("emission"):
+            if shardDir is None:
+                outScadFile = ScadFile(definedEntities=neededEntities)
+                if outFileName is not None:
+                    outScadFile.metaData.add("filename", outFileName)
+                outString = transform(outScadFile.asScad(dummiesFirst=True))
+            else:
+                outString, shards = shardEntities(neededEntities, dependencyTree, outFileName, shardDir, transform)
+
+        # The input file, the files it references and the files the
+        # needed entities come from. If there are unresolved dependencies
+        # any file of the library could resolve them in the future.
+        contributors = [inputFile] + inputFile.getReferencedFilesDeep()
+        contributors.extend(entity.inScadFile.scadFile for entity in neededEntities if entity.inScadFile is not None)
+        if unresolvedDependencies:
+            for libraryFile in scadLibrary.fileList:
+                contributors.append(libraryFile)
+                contributors.extend(libraryFile.getReferencedFilesDeep())
+        assets = [asset for entity in neededEntities for asset in entity.getImportedAssets()]
+
+        result = ScadToolResult(outString, inputFile, neededEntities, unresolvedDependencies, uniquePaths(contributors), uniquePaths(assets), shards)
+        if sizeReport:
+            entityTexts = [(entity, transform(entity.asScad(), checkMinified=False)) for entity in neededEntities]
+            result.sizeReport = SizeReport(outFileName or inputPath, outString + "".join(shards.values() if shards else ()), entityTexts, flattenDependencyTree(dependencyTree))
+        return result
+
+
+def compileFile(inputPath, minimal=False, compactNumbers=False, precision=None, dedupeVertices=False, minify=False, sizeReport=False, context=None):
+    """Compile the file at inputPath and the files it references to a
+    single file and return a ScadToolResult.
+    minimal: only copy the entities that are reachable from the input
+        file (see ScadFile.getReachableEntities()).
+    compactNumbers, precision, dedupeVertices: see compactNumericData()
+    minify: remove comments and unneeded whitespace (see minifyCode()).
+    sizeReport: attach a SizeReport to the result.
+    context: the ScadToolContext to use instead of the active one."""
+    with (context if context is not None else getActiveContext()).activate() as context:
+        inputFile = context.registry.getScadFile(inputPath, recursive=True)
+        if minimal:
+            printConsole("PROGRESS: Looking for the entities that are reachable from the statements in '{}'".format(inputPath), 1)
+            with context.profiler.phase("resolution"), context.memory.measure("resolution"):
+                neededEntities = inputFile.getReachableEntities(followCallSites=True)
+                # entities defined in the input file stay where they are.
+                neededEntities = [entity for entity in neededEntities if entity.inScadFile is None or entity.inScadFile.scadFile is not inputFile]
+            printConsole("INFO: Reachable entities from referenced files:\n" + txt_prefix_each_line(txt_pretty_print(neededEntities), "    "), 2)
+            with context.profiler.phase("emission"), context.memory.measure("emission"):
+                outString = inputFile.asCompilationDump(neededEntities)
+            assetSources = [inputFile] + inputFile.getDefinedEntities() + neededEntities
+        else:
+            with context.profiler.phase("emission"), context.memory.measure("emission"):
+                outString = inputFile.asDump(recursive=True)
+            neededEntities = None
+            assetSources = [inputFile] + inputFile.getReferencedFilesDeep()
+            assetSources = assetSources + [entity for scadFile in assetSources for entity in scadFile.getDefinedEntities()]
+        with context.profiler.phase("emission"), context.memory.measure("emission"):
+            outString = transformOutput(outString, compactNumbers, precision, dedupeVertices, minify)
+
+        contributors = [inputFile] + inputFile.getReferencedFilesDeep()
+        assets = [asset for assetSource in assetSources for asset in assetSource.getImportedAssets()]
+        result = ScadToolResult(outString, inputFile, neededEntities, None, uniquePaths(contributors), uniquePaths(assets))
+        if sizeReport:
+            # The copied entities are emitted with asScad(), the entities
+            # of the files that are dumped as they are.
+            if minimal:
+                entityTexts = [(entity, entity.asDump()) for entity in inputFile.getDefinedEntities()] + [(entity, entity.asScad()) for entity in neededEntities]
+            else:
+                entityTexts = [(entity, entity.asDump()) for scadFile in contributors for entity in scadFile.getDefinedEntities()]
+            entityTexts = [(entity, transformOutput(text, compactNumbers, precision, dedupeVertices, minify, checkMinified=False)) for entity, text in entityTexts]
+            result.sizeReport = SizeReport(determineOutFile(inputPath, "comp.", "scad") or inputPath, outString, entityTexts, resolveEntityDependencies([entity for entity, _ in entityTexts]))
+        return result
+
+
+def compileFiles(inputPaths, minimal=False, compactNumbers=False, precision=None, dedupeVertices=False, minify=False, sizeReport=False, jobs=None, context=None):
+    """Compile each of the files at inputPaths like compileFile() and
+    return a list of ScadToolResults in the same order.
+    All the files referenced by the inputs are read and parsed once,
+    through the registry of the context, before the outputs are produced
+    by a pool of jobs worker processes (default: the number of CPUs).
+    The workers are forked, so they share the parsed files. Where fork is
+    not available (or with a single job) the outputs are produced one
+    after the other. The times and counters of the workers are added to
+    the PhaseProfiler and the RunMetrics of the context, so the phase
+    times are the sum over all workers."""
+    import multiprocessing
+    options = dict(minimal=minimal, compactNumbers=compactNumbers, precision=precision, dedupeVertices=dedupeVertices, minify=minify, sizeReport=sizeReport)
+    with (context if context is not None else getActiveContext()).activate() as context:
+        printConsole("PROGRESS: Reading the files referenced by {} input files".format(len(inputPaths)), 1)
+        for inputPath in inputPaths:
+            context.registry.getScadFile(inputPath, recursive=True).getReferencedFilesDeep()
+
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+        jobs = min(jobs, len(inputPaths))
+        if jobs <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            return [compileFile(inputPath, **options) for inputPath in inputPaths]
+
+        printConsole("PROGRESS: Compiling {} files in {} worker processes".format(len(inputPaths), jobs), 1)
+        with multiprocessing.get_context("fork").Pool(jobs) as pool:
+            workerResults = pool.map(_compileFileInWorker, [(inputPath, options) for inputPath in inputPaths], chunksize=1)
+
+        results = list()
+        for inputPath, (output, entityKeys, contributorPaths, assetPaths, report, profiler, metrics) in zip(inputPaths, workerResults):
+            context.profiler.merge(profiler)
+            context.metrics.merge(metrics)
+            inputFile = context.registry.getScadFile(inputPath, recursive=True)
+            neededEntities = None
+            if entityKeys is not None:
+                fileOfPath = dict((scadFile.path, scadFile) for scadFile in [inputFile] + inputFile.getReferencedFilesDeep())
+                neededEntities = [fileOfPath[key[0]].getDefinedEntities()[key[1]] if isinstance(key, tuple) else key for key in entityKeys]
+            results.append(ScadToolResult(output, inputFile, neededEntities, None, contributorPaths, assetPaths))
+            results[-1].sizeReport = report
+        return results
+
+
+def _compileFileInWorker(task):
+    """Compile a file in a worker process of compileFiles().
+    Only the text, the paths and the SizeReport of the result are sent back, the entities
+    as (path of their file, index in its defined entities). Entities
+    without a file are sent as they are."""
+    inputPath, options = task
+    context.profiler = PhaseProfiler(context.profiler.enabled)
+    context.metrics = RunMetrics(context.metrics.enabled)
+    result = compileFile(inputPath, **options)
+    entityKeys = None
+    if result.entities is not None:
+        entityKeys = list()
+        indexOfEntity = dict()  # id(entity) -> index in the defined entities of its file, filled once per file
+        indexedFiles = set()
+        for entity in result.entities:
+            if entity.inScadFile is None:
+                entityKeys.append(entity)
+                continue
+            scadFile = entity.inScadFile.scadFile
+            if id(scadFile) not in indexedFiles:
+                indexedFiles.add(id(scadFile))
+                indexOfEntity.update((id(definedEntity), index) for index, definedEntity in enumerate(scadFile.getDefinedEntities()))
+            entityKeys.append((scadFile.path, indexOfEntity[id(entity)]))
+    return (result.output, entityKeys, result.contributorPaths, result.assetPaths, result.sizeReport, context.profiler, context.metrics)
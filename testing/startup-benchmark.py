@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Measures the startup cost of scadtool.py and compares it to a budget.
+
+Runs a short scadtool.py invocation several times with `python -X importtime`
+and reports
+ * the cumulative import time of scadtoolLib (as reported by -X importtime)
+ * the median wall time of the whole invocation minus the median wall time
+   of a bare interpreter (`python -c pass`).
+
+Exits with 1 if one of the numbers exceeds its budget, so it can be used in CI.
+By default the budgets are multiples of the wall time of the bare
+interpreter, so they fit slow and fast machines alike. The factors leave
+room for noise (measured: the import takes 0.6-0.9 times and the overhead
+2-2.6 times the bare interpreter).
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+SCADTOOL = os.path.join(os.path.dirname(TESTING_DIR), "scadtool.py")
+DEFAULT_INVOCATION = ["-q", "compile", os.path.join(TESTING_DIR, "information-extraction-example.scad")]
+
+re_pattern_importtime = re.compile(r"^import time:\s*(?P<self>\d+)\s*\|\s*(?P<cumulative>\d+)\s*\|\s*(?P<name>.*?)\s*$", re.MULTILINE)
+
+
+def run(cmd):
+    """Runs cmd and returns (wall time in ms, stderr)."""
+    start = time.perf_counter()
+    done = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = (time.perf_counter() - start) * 1000
+    if done.returncode != 0:
+        sys.stderr.write(done.stderr)
+        raise SystemExit("'{}' failed with exit code {}".format(" ".join(cmd), done.returncode))
+    return wall, done.stderr
+
+
+def importTimeOf(moduleName, importtimeOutput):
+    """Returns the cumulative import time in ms of moduleName from the -X importtime output."""
+    for match in re_pattern_importtime.finditer(importtimeOutput):
+        if match.group("name") == moduleName:
+            return int(match.group("cumulative")) / 1000
+    raise SystemExit("'{}' was not imported".format(moduleName))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the startup time of scadtool.py.")
+    parser.add_argument("-n", "--runs", type=int, default=20, help="The number of runs (default: %(default)s).")
+    parser.add_argument("--import-budget-ms", type=float, default=None, help="The budget for the cumulative import time of scadtoolLib (default: --import-budget-factor times the bare interpreter).")
+    parser.add_argument("--import-budget-factor", type=float, default=1.5, help="The budget for the import time as a multiple of the median wall time of a bare interpreter (default: %(default)s).")
+    parser.add_argument("--overhead-budget-ms", type=float, default=None, help="The budget for the median wall time over a bare interpreter (default: --overhead-budget-factor times the bare interpreter).")
+    parser.add_argument("--overhead-budget-factor", type=float, default=4.0, help="The budget for the overhead as a multiple of the median wall time of a bare interpreter (default: %(default)s).")
+    parser.add_argument("invocation", nargs="*", help="The arguments passed to scadtool.py (default: {}).".format(" ".join(DEFAULT_INVOCATION)))
+    args = parser.parse_args()
+
+    invocation = args.invocation or DEFAULT_INVOCATION
+
+    # warm up: write the .pyc file of scadtoolLib (py_compile also writes it
+    # with PYTHONDONTWRITEBYTECODE set), so compiling it is not measured
+    run([sys.executable, "-m", "py_compile", os.path.join(os.path.dirname(TESTING_DIR), "scadtoolLib.py")])
+    run([sys.executable, SCADTOOL] + invocation)
+
+    importTimes = []
+    walls = []
+    bareWalls = []
+    for _ in range(args.runs):
+        bareWalls.append(run([sys.executable, "-c", "pass"])[0])
+        wall, stderr = run([sys.executable, "-X", "importtime", SCADTOOL] + invocation)
+        importTimes.append(importTimeOf("scadtoolLib", stderr))
+        walls.append(run([sys.executable, SCADTOOL] + invocation)[0])
+
+    importTime = statistics.median(importTimes)
+    bareWall = statistics.median(bareWalls)
+    overhead = statistics.median(walls) - bareWall
+    importBudget = args.import_budget_ms if args.import_budget_ms is not None else args.import_budget_factor * bareWall
+    overheadBudget = args.overhead_budget_ms if args.overhead_budget_ms is not None else args.overhead_budget_factor * bareWall
+
+    rows = [
+        ("scadtoolLib import", importTime, importBudget),
+        ("overhead over 'python -c pass'", overhead, overheadBudget),
+    ]
+    print("{:<32} {:>10} {:>10}".format("median of {} runs".format(args.runs), "ms", "budget"))
+    overBudget = False
+    for name, value, budget in rows:
+        over = value > budget
+        overBudget = overBudget or over
+        print("{:<32} {:>10.1f} {:>10.1f}{}".format(name, value, budget, "  OVER BUDGET" if over else ""))
+    print("{:<32} {:>10.1f}".format("bare interpreter", bareWall))
+
+    return 1 if overBudget else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
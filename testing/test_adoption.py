@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Tests for the @adopt and @adopt-all tags of ScadDoc and the tag
+operators (-replace, -append, -prepend, -remove) applied to the adopted tags.
+
+Run with `python -m unittest discover testing` or `python -m pytest testing`.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTING_DIR))
+
+import scadtoolLib as lib  # noqa: E402
+
+
+SOURCE = """/**
+ * the source
+ * @author foo bar
+ * @author bla blubb
+ * @tag-list apples, oranges, bananas
+ * @param size the size
+ * @module-dependency helper
+ */
+module source(size) {}
+"""
+
+
+class AdoptionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.context = lib.ScadToolContext(quiet=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def readDoc(self, adoptingDoc, name="target", source=SOURCE):
+        """Read a file with the source module and a module name with the
+        given doc (without the comment markers) and return its ScadDoc."""
+        path = os.path.join(self.directory, "adoption.scad")
+        with open(path, "w") as f:
+            f.write("/** @filename adoption.scad */\n" + source + "/**\n" + adoptingDoc + "\n */\nmodule " + name + "() {}\n")
+        with self.context.activate():
+            scadFile = self.context.registry.getScadFile(path, recursive=False)
+            entity = [entity for entity in scadFile.getDefinedEntities() if entity.name == name][0]
+            entity.metaData._metaData  # resolve the adoptions while the context is active
+            return entity.metaData
+
+
+class TestTagOperators(AdoptionTestCase):
+
+    def test_default_replaces(self):
+        doc = self.readDoc(" * @adopt source\n * @author xyz abc")
+        self.assertEqual(doc.getList("author"), ["xyz abc"])
+        self.assertEqual(doc.getList("description"), ["the source"])
+
+    def test_replace(self):
+        doc = self.readDoc(" * @adopt source\n * @author-replace xyz abc\n * @tag-list-replace grapes, pineapple")
+        self.assertEqual(doc.getList("author"), ["xyz abc"])
+        self.assertEqual([item.strip() for item in doc.getList("tag-list")], ["grapes", "pineapple"])
+
+    def test_list_replace_item(self):
+        doc = self.readDoc(" * @adopt source\n * @tag-list-replace apples   grapes, pineapple")
+        self.assertEqual([item.strip() for item in doc.getList("tag-list")], ["grapes", "pineapple", "oranges", "bananas"])
+
+    def test_append(self):
+        doc = self.readDoc(" * @adopt source\n * @author-append xyz abc\n * @tag-list-append grapes")
+        self.assertEqual(doc.getList("author"), ["foo bar", "bla blubb", "xyz abc"])
+        self.assertEqual([item.strip() for item in doc.getList("tag-list")], ["apples", "oranges", "bananas", "grapes"])
+
+    def test_prepend(self):
+        doc = self.readDoc(" * @adopt source\n * @author-prepend xyz abc\n * @tag-list-prepend grapes")
+        self.assertEqual(doc.getList("author"), ["xyz abc", "foo bar", "bla blubb"])
+        self.assertEqual([item.strip() for item in doc.getList("tag-list")], ["grapes", "apples", "oranges", "bananas"])
+
+    def test_remove_without_items(self):
+        doc = self.readDoc(" * @adopt source\n * @author-remove")
+        self.assertFalse(doc.has("author"))
+        self.assertTrue(doc.has("tag-list"))
+
+    def test_remove_without_items_before_another_tag(self):
+        doc = self.readDoc(" * @adopt source\n * @author-remove\n * @tag-list-remove oranges, bananas")
+        self.assertFalse(doc.has("author"))
+        self.assertEqual([item.strip() for item in doc.getList("tag-list")], ["apples"])
+
+    def test_remove_items(self):
+        doc = self.readDoc(" * @adopt source\n * @tag-list-remove oranges")
+        self.assertEqual([item.strip() for item in doc.getList("tag-list")], ["apples", "bananas"])
+
+    def test_remove_without_items_as_scad(self):
+        doc = self.readDoc(" * @adopt source\n * @author-remove")
+        with self.context.activate():
+            self.assertNotIn("@author", doc.asScad())
+
+
+class TestAdoption(AdoptionTestCase):
+
+    def test_adopt_skips_params_and_dependencies(self):
+        doc = self.readDoc(" * @adopt source")
+        self.assertFalse(doc.has("param"))
+        self.assertFalse(doc.has("module-dependency"))
+        self.assertEqual(doc.getList("author"), ["foo bar", "bla blubb"])
+
+    def test_adopt_all_adopts_params_and_dependencies(self):
+        doc = self.readDoc(" * @adopt-all source")
+        self.assertEqual(doc.getList("param"), ["size"])
+        self.assertEqual(doc.getList("module-dependency"), ["helper"])
+
+    def test_filename_is_not_adopted(self):
+        doc = self.readDoc(" * @adopt-all source", source="/**\n * @filename other.scad\n */\nmodule source() {}\n")
+        self.assertFalse(doc.has("filename"))
+
+    def test_cycle(self):
+        source = "/**\n * @adopt target\n */\nmodule source() {}\n"
+        with self.assertRaisesRegex(ValueError, "cycle"):
+            self.readDoc(" * @adopt source", source=source)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Regression tests for telling module instantiations from function calls
+(txt_find_identifier_usages) and for compile --minimal, which relies on it.
+
+Run with `python -m unittest discover testing` or `python -m pytest testing`.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTING_DIR))
+
+import scadtoolLib as lib  # noqa: E402
+
+
+LIBRARY = """/** @filename lib.scad */
+function helper(x) = x * 2;
+module base(size) { cube(helper(size)); }
+function h(x) = x + 1;
+function sq(x) = x * x;
+module shaped(s) {
+    cube([helper(s) * h(s), 1, 1]);
+    points = [for (i = [0:3]) sq(i)];
+}
+module derived(size) {
+    base(size);
+    shaped(size);
+    if (size < 2) base(1); else translate([1, 0, 0]) base(size < 5 ? helper(size) : size);
+}
+module unused() { cube(1); }
+"""
+
+MAIN = """/** @filename main.scad */
+include <lib.scad>
+derived(3);
+"""
+
+
+class TestIdentifierUsages(unittest.TestCase):
+
+    def test_first_call_in_parameterized_module(self):
+        module = lib.ScadModule("m", "size", " base(size); ")
+        self.assertEqual(module._findIdentifierUsages(), (["base"], [], ["size"]))
+
+    def test_ternary_else_branch_is_a_function_call(self):
+        self.assertEqual(lib.txt_find_identifier_usages("x = a < 2 ? g(a) : h(a);"), ([], ["g", "h"], ["a"]))
+
+    def test_calls_in_expressions_after_a_bracket_are_function_calls(self):
+        self.assertEqual(lib.txt_find_identifier_usages("cube([w(s) * h(s), 1, 1]);"), ([], ["w", "h"], ["s"]))
+        self.assertEqual(lib.txt_find_identifier_usages("x = g(1) % h(2); m();"), (["m"], ["g", "h"], []))
+
+    def test_calls_in_list_comprehensions_are_function_calls(self):
+        self.assertEqual(lib.txt_find_identifier_usages("points = [for (i=[0:3]) f(i)];"), ([], ["f"], ["i"]))
+        self.assertEqual(lib.txt_find_identifier_usages("for (i=[0:3]) f(i);"), (["f"], [], ["i"]))
+
+    def test_statements(self):
+        self.assertEqual(lib.txt_find_identifier_usages("translate(v) *a(); %b(); if (c) d(); else e(f(1));"), (["a", "b", "d", "e"], ["f"], ["v", "c"]))
+
+    def test_functions_and_variables_do_not_instantiate_modules(self):
+        function = lib.ScadFunction("f", "a", "let(b = a) f2(b)")
+        variable = lib.ScadVariable("v", "let(n = 2) g(n)")
+        self.assertEqual(function._findIdentifierUsages(), ([], ["f2"], ["a", "b"]))
+        self.assertEqual(variable._findIdentifierUsages(), ([], ["g"], ["n"]))
+
+
+class TestMinimalCompile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, content in (("lib.scad", LIBRARY), ("main.scad", MAIN)):
+            with open(os.path.join(self.directory, name), "w") as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_copies_what_a_module_needs(self):
+        context = lib.ScadToolContext(quiet=True)
+        output = lib.compileFile(os.path.join(self.directory, "main.scad"), minimal=True, context=context).output
+        self.assertIn("module derived(", output)
+        self.assertIn("module base(", output)
+        self.assertIn("function helper(", output)
+        self.assertIn("module shaped(", output)
+        self.assertIn("function h(", output)
+        self.assertIn("function sq(", output)
+        self.assertNotIn("module unused(", output)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""Checks that the stages of scadtoolLib scale (at most) like n log n.
+
+Each stage (parsing a file, extracting its statements, line lookups,
+ScadDoc parsing, resolution, asDump ...) runs on generated inputs of size
+N, 2N and 4N. The time for 4N divided by the time for N is compared to
+the growth of the bound of the stage (4 for linear, 4 * log(4N) / log(N)
+for n log n) times a tolerance for noise. A quadratic stage grows by 16.
+(Only the dump of an include chain may grow quadratically, as its output
+does.)
+
+As a unittest module (`python -m unittest discover testing`) the base
+sizes N are scaled down (SCADTOOL_SCALING_SCALE, default 0.25), so it runs
+in a few seconds. SCADTOOL_SCALING_SCALE=1 runs the full sizes, like
+running this file as a script, which prints a table of the times:
+
+    $ python testing/test_scaling.py --scale 4 --repeats 5 resolution
+
+Everything is generated in a temporary directory, nothing is downloaded.
+The script exits with 1 if a stage grows faster than its bound.
+"""
+
+import argparse
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+TESTING_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTING_DIR))
+
+import scadtoolLib as lib  # noqa: E402
+
+
+# ####################### GENERATED INPUTS ########################
+
+
+def scadCode(n, prefix="e", filename="scaling.scad"):
+    """A file with n modules, functions and variables with documentation,
+    comments and statements between them."""
+    parts = ["/** @filename {} */".format(filename)]
+    for i in range(n):
+        parts.append("""/**
+ * module {p}m{i} does things
+ * @param a the a
+ * @module-dependency {p}m{j}
+ * @function-dependency {p}f{i}
+ */
+module {p}m{i}(a=1) {{
+    // a comment with a ; and a {{
+    translate([{i}, 2, 3]) cube([a, {p}f{i}(2), 3]);
+}}
+/** a value */
+{p}v{i} = [{i}, 2.50, 3];
+/** a function */
+function {p}f{i}(x) = x * {i} + {p}v{i}[0];
+{p}m{i}(a={i});
+""".format(p=prefix, i=i, j=max(i - 1, 0)))
+    return "\n".join(parts)
+
+
+def parseCode(code, path="scaling.scad"):
+    return lib.ScadFileFromFile(content=code, path=path, recursive=False)
+
+
+def writeLibrary(directory, files, entitiesPerFile):
+    """Write files .scad files with entitiesPerFile entities each and
+    return their paths."""
+    paths = list()
+    for i in range(files):
+        path = os.path.join(directory, "lib{}.scad".format(i))
+        with open(path, 'w') as f:
+            f.write(scadCode(entitiesPerFile, prefix="l{}_".format(i), filename=os.path.basename(path)))
+        paths.append(path)
+    return paths
+
+
+def writeInput(directory, name, references):
+    """Write a file that includes the given files (relative paths)."""
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        f.write("/** @filename {} */\n".format(name))
+        for reference in references:
+            f.write("include <{}>\n".format(reference))
+        f.write("cube(1);\n")
+    return path
+
+
+# ####################### STAGES ########################
+# Each stage is (name, bound, base size, setup). setup(n, directory)
+# prepares the input of size n and returns the function that is measured.
+
+
+def setupParse(n, directory):
+    code = scadCode(n)
+    return lambda: parseCode(code)
+
+
+def setupStatements(n, directory):
+    scadFile = parseCode(scadCode(n))
+    return scadFile.getStatements
+
+
+def setupLineLookup(n, directory):
+    scadFile = parseCode(scadCode(n))
+    positions = [entity.inScadFile.startPosition for entity in scadFile.getDefinedEntities()]
+
+    def run():
+        for position in positions:
+            scadFile._getLineAndPositionInLine(position)
+    return run
+
+
+def setupScadDoc(n, directory):
+    text = "\n".join(["A long documentation."] + ["@param p{0} the parameter {0}\n@module-dependency m{0} the module {0}".format(i) for i in range(n)])
+    return lambda: lib.ScadDoc(text, lib.ScadModule).getList("param")
+
+
+def setupAdoptionChain(n, directory):
+    parts = ["/** @filename adoption.scad */", "/**\n * the root\n * @param a the a\n * @module-dependency helper\n */\nmodule a0() {}"]
+    for i in range(1, n):
+        parts.append("/**\n * @adopt-all a{}\n * @author author {}\n */\nmodule a{}() {{}}".format(i - 1, i, i))
+    path = os.path.join(directory, "adoption.scad")
+    with open(path, 'w') as f:
+        f.write("\n".join(parts))
+    entities = lib.ScadLibrary([path]).getAvailableEntities()
+    return lambda: [entity.getDependencies() for entity in reversed(entities)]
+
+
+def setupResolution(dependencies, files):
+    def setup(n, directory):
+        libraryFiles, dependencyCount = (files, n) if dependencies else (n, files)
+        paths = writeLibrary(directory, libraryFiles, 5)
+        library = lib.ScadLibrary(paths)
+        for scadFile in library.fileList:  # the docs are parsed before the measurement
+            for entity in scadFile.getDefinedEntities():
+                entity.getDependencies()
+        wanted = [lib.ScadEntityDependency("l{}_m{}".format(i % libraryFiles, i % 5), "scaling", lib.ScadModule) for i in range(dependencyCount)]
+        return lambda: library.findResolutions(wanted)
+    return setup
+
+
+def setupDumpFan(n, directory):
+    paths = writeLibrary(directory, n, 2)
+    inputFile = lib.getActiveContext().registry.getScadFile(writeInput(directory, "fan.scad", [os.path.basename(path) for path in paths]), recursive=True)
+    inputFile.getReferencedFilesDeep()  # the files are read before the measurement
+    return lambda: inputFile.asDump(recursive=True)
+
+
+def setupDumpChain(n, directory):
+    for i in range(n):
+        writeInput(directory, "chain{}.scad".format(i), ["chain{}.scad".format(i + 1)] if i + 1 < n else [])
+    inputFile = lib.getActiveContext().registry.getScadFile(os.path.join(directory, "chain0.scad"), recursive=True)
+    inputFile.getReferencedFilesDeep()
+    return lambda: inputFile.asDump(recursive=True)
+
+
+def setupCompilationDump(n, directory):
+    paths = writeLibrary(directory, n, 2)
+    inputFile = lib.getActiveContext().registry.getScadFile(writeInput(directory, "minimal.scad", [os.path.basename(path) for path in paths]), recursive=True)
+    entities = [entity for scadFile in inputFile.getReferencedFilesDeep() for entity in scadFile.getDefinedEntities()]
+    return lambda: inputFile.asCompilationDump(entities)
+
+
+STAGES = [
+    ("parse (ScadFileFromFile)", "n", 200, setupParse),
+    ("statements", "n", 400, setupStatements),
+    ("line lookup", "n log n", 2000, setupLineLookup),
+    ("ScadDoc parsing", "n", 2000, setupScadDoc),
+    ("ScadDoc adoption chain", "n", 500, setupAdoptionChain),
+    ("resolution (dependencies)", "n", 100, setupResolution(True, 20)),
+    ("resolution (library files)", "n", 25, setupResolution(False, 50)),
+    ("asDump (included files)", "n", 800, setupDumpFan),
+    ("asDump (include chain)", "n^2", 800, setupDumpChain),  # each file is indented one level deeper, so the output itself grows with n^2
+    ("asCompilationDump", "n", 100, setupCompilationDump),
+]
+
+
+# ####################### MEASUREMENT ########################
+
+
+def measure(setup, n, repeats):
+    """The best time of repeats runs of the stage on an input of size n.
+    Each run is set up again with a new context (so nothing is cached
+    between the runs) and a new directory."""
+    best = None
+    for _ in range(repeats):
+        directory = tempfile.mkdtemp(prefix="scadtool-scaling-")
+        try:
+            with lib.ScadToolContext(quiet=True).activate():
+                run = setup(n, directory)
+                start = time.perf_counter()
+                run()
+                seconds = time.perf_counter() - start
+        finally:
+            shutil.rmtree(directory)
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def expectedGrowth(bound, n, factor):
+    """How much a stage with the given bound grows, when n grows by factor."""
+    if bound == "n":
+        return factor
+    if bound == "n^2":
+        return factor ** 2
+    return factor * math.log(factor * n) / math.log(n)
+
+
+def measureGrowth(bound, baseSize, setup, scale, repeats, tolerance):
+    """Measure a stage with the base size N scaled by scale.
+    Returns (N, times for N, 2N and 4N, growth from N to 4N, limit)."""
+    n = max(2, int(baseSize * scale))
+    times = [measure(setup, n * factor, repeats) for factor in (1, 2, 4)]
+    limit = expectedGrowth(bound, n, 4) * tolerance
+    growth = times[2] / times[0] if times[0] > 0 else float("inf")
+    return (n, times, growth, limit)
+
+
+class TestScaling(unittest.TestCase):
+    """The stages with CI sized inputs, see the module documentation."""
+    scale = float(os.environ.get("SCADTOOL_SCALING_SCALE", "0.25"))
+    repeats = int(os.environ.get("SCADTOOL_SCALING_REPEATS", "3"))
+    tolerance = float(os.environ.get("SCADTOOL_SCALING_TOLERANCE", "2.0"))
+
+    def test_stages(self):
+        for name, bound, baseSize, setup in STAGES:
+            with self.subTest(stage=name):
+                n, times, growth, limit = measureGrowth(bound, baseSize, setup, self.scale, self.repeats, self.tolerance)
+                self.assertLessEqual(growth, limit, "'{}' ({}) grows {:.2f} times from N={} to 4N ({:.2f} ms to {:.2f} ms).".format(name, bound, growth, n, times[0] * 1000, times[2] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks that the stages of scadtoolLib scale (at most) like n log n.")
+    parser.add_argument("-r", "--repeats", type=int, default=3, help="Run each measurement this many times and take the best (default: %(default)s).")
+    parser.add_argument("-s", "--scale", type=float, default=1.0, help="Multiply the base sizes N of the stages by this factor (default: %(default)s).")
+    parser.add_argument("-t", "--tolerance", type=float, default=2.0, help="Fail if the growth from N to 4N is more than the growth of the bound times this factor (default: %(default)s).")
+    parser.add_argument("stages", nargs="*", help="Only run the stages whose names contain one of these words.")
+    args = parser.parse_args()
+
+    print("{:<28} {:>8} {:>10} {:>10} {:>10} {:>8} {:>8} {:>8}".format("STAGE", "BOUND", "N", "N ms", "4N ms", "2N/N", "4N/N", "LIMIT"))
+    overBound = False
+    for name, bound, baseSize, setup in STAGES:
+        if args.stages and not any(word in name for word in args.stages):
+            continue
+        n, times, growth, limit = measureGrowth(bound, baseSize, setup, args.scale, args.repeats, args.tolerance)
+        over = growth > limit
+        overBound = overBound or over
+        print("{:<28} {:>8} {:>10} {:>10.2f} {:>10.2f} {:>8.2f} {:>8.2f} {:>8.2f}{}".format(
+            name, bound, n, times[0] * 1000, times[2] * 1000, times[1] / times[0] if times[0] > 0 else float("inf"), growth, limit, "  TOO FAST GROWING" if over else ""))
+
+    return 1 if overBound else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())